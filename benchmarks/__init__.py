@@ -0,0 +1,8 @@
+# Copyright (c) 2015 Codenomicon Ltd.
+# License: MIT
+"""Performance benchmarks for protecodesc
+
+Run from the repository root:
+
+    python -m benchmarks.run --output results.json
+"""
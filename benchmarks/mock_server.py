@@ -0,0 +1,245 @@
+# Copyright (c) 2015 Codenomicon Ltd.
+# License: MIT
+"""Local stand-in for the Protecode SC HTTP API
+
+Implements the routes of protecodesc.protecodesc.API_URL_MAP closely enough
+for benchmarking the client. Uploads are "scanned" for a configurable time,
+every request can be delayed, and a fraction of requests can be failed
+with 503 responses.
+
+    with MockServer(latency=0.02, scan_duration=1.0) as server:
+        appcheck = ProtecodeSC(creds=('user', 'pass'), host=server.url)
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import hashlib
+import json
+import random
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+except ImportError:  # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class MockServer(object):
+    """Protecode SC API stand-in running in a background thread"""
+
+    def __init__(self, latency=0.0, scan_duration=1.0, failure_rate=0.0,
+                 components=10, apps=0, seed=0):
+        """
+
+        :param latency: Seconds added to every response
+        :param scan_duration: Seconds an upload stays busy
+        :param failure_rate: Fraction of requests answered with 503
+        :param components: Components in every scan result
+        :param apps: Extra finished apps listed and served besides uploads
+        :param seed: Random seed for failure injection
+        """
+        self.latency = latency
+        self.scan_duration = scan_duration
+        self.failure_rate = failure_rate
+        self.components = components
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.scans = {}  # id and sha1 -> scan
+        self._next_id = 1
+        self.stats = {'requests': 0, 'failures': 0, 'uploads': 0,
+                      'bytes_received': 0}
+        for i in range(apps):
+            self._add_scan(hashlib.sha1(str(i).encode()).hexdigest(),
+                           'app{i}'.format(i=i), ready_at=0)
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://{host}:{port}'.format(
+            host=self._server.server_address[0],
+            port=self._server.server_address[1])
+
+    def start(self):
+        self._server = _ThreadingHTTPServer(('127.0.0.1', 0),
+                                            _make_handler(self))
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _add_scan(self, sha1, filename, ready_at=None):
+        with self.lock:
+            scan = self.scans.get(sha1)
+            if scan is None:
+                scan_id = self._next_id
+                self._next_id += 1
+                scan = {'id': scan_id, 'sha1sum': sha1, 'filename': filename}
+                self.scans[sha1] = self.scans[str(scan_id)] = scan
+            if ready_at is None:
+                ready_at = time.time() + self.scan_duration
+            scan['ready_at'] = ready_at
+            return scan
+
+    def ready_at(self, id_or_sha1):
+        """Time when scan becomes ready"""
+        return self.scans[str(id_or_sha1)]['ready_at']
+
+    def result(self, scan):
+        ready = time.time() >= scan['ready_at']
+        results = {'id': scan['id'],
+                   'sha1sum': scan['sha1sum'],
+                   'filename': scan['filename'],
+                   'status': 'R' if ready else 'B',
+                   'report_url': '{url}/products/{id}/'.format(
+                       url=self.url, id=scan['id']),
+                   'summary': {'verdict': {'short': 'Vulns',
+                                           'detailed': 'Mock result'}},
+                   'components': []}
+        if ready:
+            results['components'] = [
+                {'lib': 'lib{i}'.format(i=i),
+                 'version': '1.{i}'.format(i=i),
+                 'license': {'name': 'MIT' if i % 2 else 'GPL-2.0'},
+                 'vulns': [{'vuln': {'cve': 'CVE-2015-{i:04d}'.format(i=i)}}]
+                 if i % 3 == 0 else []}
+                for i in range(self.components)]
+        return {'results': results}
+
+
+def _make_handler(server):
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def _send(self, code, obj=None):
+            body = json.dumps(obj if obj is not None else {}).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _read_body(self):
+            if self.headers.get('Transfer-Encoding', '') == 'chunked':
+                digest = hashlib.sha1()
+                size = 0
+                while True:
+                    length = int(self.rfile.readline().strip(), 16)
+                    if length == 0:
+                        self.rfile.readline()
+                        break
+                    chunk = self.rfile.read(length)
+                    digest.update(chunk)
+                    size += len(chunk)
+                    self.rfile.readline()
+                return digest.hexdigest(), size
+            remaining = int(self.headers.get('Content-Length', 0))
+            digest = hashlib.sha1()
+            size = remaining
+            while remaining:
+                chunk = self.rfile.read(min(remaining, 2**16))
+                digest.update(chunk)
+                remaining -= len(chunk)
+            return digest.hexdigest(), size
+
+        def _handle(self, method):
+            with server.lock:
+                server.stats['requests'] += 1
+                fail = server.random.random() < server.failure_rate
+            if method == 'PUT':
+                # Always consume the body to keep the connection usable
+                sha1, size = self._read_body()
+            if server.latency:
+                time.sleep(server.latency)
+            if fail:
+                with server.lock:
+                    server.stats['failures'] += 1
+                return self._send(503)
+
+            path = urlparse(self.path)
+            query = parse_qs(path.query)
+            parts = [p for p in path.path.split('/') if p]
+            if parts[:1] != ['api'] or len(parts) < 2:
+                return self._send(404)
+            route = parts[1]
+            arg = parts[2] if len(parts) > 2 else None
+
+            if route == 'upload' and method == 'PUT':
+                scan = server._add_scan(sha1, arg)
+                with server.lock:
+                    server.stats['uploads'] += 1
+                    server.stats['bytes_received'] += size
+                return self._send(200, server.result(scan))
+            if route == 'app' and method in ('GET', 'DELETE'):
+                scan = server.scans.get(arg)
+                if scan is None:
+                    return self._send(404)
+                if method == 'DELETE':
+                    with server.lock:
+                        server.scans.pop(scan['sha1sum'], None)
+                        server.scans.pop(str(scan['id']), None)
+                    return self._send(200)
+                return self._send(200, server.result(scan))
+            if route == 'rescan' and method == 'POST':
+                scan = server.scans.get(arg)
+                if scan is None:
+                    return self._send(404)
+                server._add_scan(scan['sha1sum'], scan['filename'])
+                return self._send(200)
+            if route == 'groups' and method == 'GET':
+                return self._send(200, {'groups': [{'id': 1,
+                                                    'name': 'Mock'}]})
+            if route == 'apps' and method == 'GET':
+                page = int(query.get('page', ['1'])[0])
+                per_page = int(query.get('per_page', ['100'])[0])
+                scans = sorted(dict((s['id'], s) for s in
+                                    list(server.scans.values())).values(),
+                               key=lambda s: s['id'])
+                products = [{'id': s['id'], 'name': s['filename'],
+                             'sha1sum': s['sha1sum']}
+                            for s in scans[(page-1)*per_page:page*per_page]]
+                return self._send(200, {'products': products})
+            if route == 'components' and method == 'GET':
+                version = query.get('version', [None])[0]
+                return self._send(200, {'component': arg,
+                                        'version': version,
+                                        'vulns': []})
+            return self._send(404)
+
+        def do_GET(self):
+            self._handle('GET')
+
+        def do_PUT(self):
+            self._handle('PUT')
+
+        def do_POST(self):
+            self._handle('POST')
+
+        def do_DELETE(self):
+            self._handle('DELETE')
+
+    return Handler
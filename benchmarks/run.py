@@ -0,0 +1,265 @@
+# Copyright (c) 2015 Codenomicon Ltd.
+# License: MIT
+"""Run protecodesc benchmarks against a local mock server
+
+    python -m benchmarks.run --output results.json
+    python -m benchmarks.run --compare results.json
+
+Results are written as JSON: one entry per benchmark with its metrics, and
+the parameters and protecodesc version they were measured with.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import os.path
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+
+import protecodesc
+from protecodesc.protecodesc import ProtecodeSC
+from protecodesc.utils import file_sha1, zip_directory_stream
+
+from benchmarks.mock_server import MockServer
+
+from zipfile import ZIP_DEFLATED, ZIP_STORED
+
+MB = 2**20
+
+
+def _write_random_file(path, size):
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining:
+            block = os.urandom(min(remaining, MB))
+            f.write(block)
+            remaining -= len(block)
+
+
+def _write_tree(path, files, file_size):
+    """Directory of compressible text files"""
+    line = b'The quick brown fox jumps over the lazy dog 0123456789\n'
+    for i in range(files):
+        subdir = os.path.join(path, 'd{n:02d}'.format(n=i % 16))
+        if not os.path.isdir(subdir):
+            os.makedirs(subdir)
+        with open(os.path.join(subdir, 'f{i}.txt'.format(i=i)), 'wb') as f:
+            f.write((line * (file_size // len(line) + 1))[:file_size])
+
+
+def _client(server, workers=1):
+    return ProtecodeSC(creds=('bench', 'bench'), host=server.url,
+                       workers=workers)
+
+
+def bench_file_sha1(workdir, params):
+    path = os.path.join(workdir, 'sha1.bin')
+    _write_random_file(path, params['hash_mb'] * MB)
+    start = time.time()
+    file_sha1(path)
+    elapsed = time.time() - start
+    return {'mb': params['hash_mb'], 'seconds': elapsed,
+            'mb_per_s': params['hash_mb'] / elapsed}
+
+
+def bench_zip_directory(workdir, params):
+    tree = os.path.join(workdir, 'tree')
+    _write_tree(tree, params['zip_files'], params['zip_file_kb'] * 1024)
+    total_mb = params['zip_files'] * params['zip_file_kb'] / 1024
+    results = {'input_mb': total_mb}
+    for name, compression, level in (('stored', ZIP_STORED, None),
+                                     ('deflated', ZIP_DEFLATED, 6)):
+        start = time.time()
+        size = 0
+        for chunk in zip_directory_stream(tree, compression=compression,
+                                          compresslevel=level,
+                                          reproducible=True):
+            size += len(chunk)
+        elapsed = time.time() - start
+        results[name] = {'seconds': elapsed, 'archive_mb': size / MB,
+                         'mb_per_s': total_mb / elapsed}
+    return results
+
+
+def bench_upload_file(workdir, params):
+    path = os.path.join(workdir, 'upload.bin')
+    _write_random_file(path, params['upload_mb'] * MB)
+    with MockServer(latency=params['latency']) as server:
+        appcheck = _client(server)
+        start = time.time()
+        appcheck.upload_file(path, dedupe=False)
+        elapsed = time.time() - start
+    return {'mb': params['upload_mb'], 'seconds': elapsed,
+            'mb_per_s': params['upload_mb'] / elapsed}
+
+
+def bench_poll_latency(workdir, params):
+    """Delay between a scan becoming ready and the client noticing"""
+    count = params['artifacts']
+    with MockServer(latency=params['latency'],
+                    scan_duration=params['scan_duration']) as server:
+        appcheck = _client(server)
+        sha1s = []
+        for i in range(count):
+            path = os.path.join(workdir, 'poll{i}.bin'.format(i=i))
+            _write_random_file(path, 1024)
+            data = appcheck.upload_file(path)
+            sha1s.append(data['results']['sha1sum'])
+        delays = []
+        for sha1, data in appcheck.poll_results(sha1s):
+            delays.append(time.time() - server.ready_at(sha1))
+    delays.sort()
+    return {'results': count,
+            'mean_s': sum(delays) / len(delays),
+            'median_s': delays[len(delays) // 2],
+            'max_s': delays[-1]}
+
+
+def bench_scan(workdir, params):
+    """Upload N artifacts in parallel and wait for all results, as scan"""
+    count = params['artifacts']
+    paths = []
+    for i in range(count):
+        path = os.path.join(workdir, 'scan{i}.bin'.format(i=i))
+        _write_random_file(path, params['artifact_kb'] * 1024)
+        paths.append(path)
+    with MockServer(latency=params['latency'],
+                    scan_duration=params['scan_duration'],
+                    failure_rate=params['failure_rate']) as server:
+        appcheck = _client(server, workers=params['jobs'])
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=params['jobs']) as executor:
+            results = list(executor.map(appcheck.upload_file, paths))
+        uploaded = time.time() - start
+        sha1s = [data['results']['sha1sum'] for data in results]
+        for _ in appcheck.poll_results(sha1s):
+            pass
+        elapsed = time.time() - start
+        stats = dict(server.stats)
+    return {'artifacts': count, 'jobs': params['jobs'],
+            'upload_seconds': uploaded, 'seconds': elapsed,
+            'server_requests': stats['requests'],
+            'server_failures': stats['failures'],
+            'connections': appcheck.connection_stats()}
+
+
+def _time_command(args, runs, env=None):
+    """Median wall time of running a command, in seconds"""
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(runs):
+            start = time.time()
+            subprocess.check_call(args, stdout=devnull, env=env)
+            times.append(time.time() - start)
+    times.sort()
+    return times[len(times) // 2]
+
+
+def bench_startup(workdir, params):
+    """Wall time of short CLI invocations, as run by CI jobs"""
+    runs = params['startup_runs']
+    cli = [sys.executable, '-m', 'protecodesc.cli']
+    results = {
+        'python_s': _time_command([sys.executable, '-c', 'pass'], runs),
+        'import_s': _time_command(
+            [sys.executable, '-c', 'import protecodesc.cli'], runs),
+        'help_s': _time_command(cli + ['--help'], runs)}
+    # Credentials from environment, so keyring is never touched
+    home = os.path.join(workdir, 'home')
+    os.makedirs(home)
+    with MockServer(latency=params['latency']) as server:
+        with open(os.path.join(home, '.protecodesc'), 'w') as f:
+            f.write('[protecodesc]\nalternate_host = {host}\n'.format(
+                host=server.url))
+        env = dict(os.environ, HOME=home,
+                   XDG_CACHE_HOME=os.path.join(home, 'cache'),
+                   PROTECODESC_USERNAME='bench', PROTECODESC_PASSWORD='bench')
+        results['groups_s'] = _time_command(cli + ['groups'], runs, env=env)
+    return results
+
+
+BENCHMARKS = [('file_sha1', bench_file_sha1),
+              ('zip_directory', bench_zip_directory),
+              ('upload_file', bench_upload_file),
+              ('poll_latency', bench_poll_latency),
+              ('scan', bench_scan),
+              ('startup', bench_startup)]
+
+
+def _compare(old, new, prefix=''):
+    """Print numeric metrics of new next to old"""
+    for key, value in sorted(new.items()):
+        name = prefix + key
+        if isinstance(value, dict):
+            _compare(old.get(key, {}), value, name + '.')
+        elif isinstance(value, (int, float)) and \
+                isinstance(old.get(key), (int, float)) and old[key]:
+            click.echo("{name:40s} {old:12.3f} {new:12.3f} {ratio:7.2f}x"
+                       .format(name=name, old=old[key], new=value,
+                               ratio=value / old[key]))
+
+
+@click.command()
+@click.option('--output', '-o', type=click.Path(),
+              help="Write results to FILE instead of stdout")
+@click.option('--compare', type=click.File('r'),
+              help="Compare with results from an earlier run")
+@click.option('--only', multiple=True,
+              type=click.Choice([name for name, _ in BENCHMARKS]),
+              help="Run only the named benchmark; repeatable")
+@click.option('--latency', default=0.005, help="Mock server latency, seconds")
+@click.option('--scan-duration', default=0.5,
+              help="Mock scan duration, seconds")
+@click.option('--failure-rate', default=0.0,
+              help="Fraction of failed requests in the scan benchmark")
+@click.option('--artifacts', default=20, help="Artifacts to scan")
+@click.option('--artifact-kb', default=64, help="Size of each artifact")
+@click.option('--jobs', default=8, help="Parallel uploads in scan benchmark")
+@click.option('--hash-mb', default=256, help="Size of file to hash")
+@click.option('--upload-mb', default=64, help="Size of file to upload")
+@click.option('--zip-files', default=2000, help="Files in zipped directory")
+@click.option('--zip-file-kb', default=32, help="Size of each zipped file")
+@click.option('--startup-runs', default=10,
+              help="CLI invocations per startup measurement")
+def main(output, compare, only, **params):
+    """Benchmark protecodesc against a local mock server"""
+    workdir = tempfile.mkdtemp(prefix='protecodesc-bench-')
+    report = {'version': protecodesc.__version__,
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'timestamp': time.time(),
+              'params': params,
+              'results': {}}
+    try:
+        for name, bench in BENCHMARKS:
+            if only and name not in only:
+                continue
+            click.echo("Running {name}...".format(name=name), err=True)
+            report['results'][name] = bench(workdir, params)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
+    elif not compare:
+        click.echo(text)
+    if compare:
+        old = json.load(compare)
+        click.echo("{name:40s} {old:>12s} {new:>12s} {ratio:>8s}".format(
+            name='metric', old=old.get('version', 'old'),
+            new=report['version'], ratio='ratio'))
+        _compare(old.get('results', {}), report['results'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,316 @@
+# Copyright (c) 2015 Codenomicon Ltd.
+# License: MIT
+
+from __future__ import absolute_import, division, print_function
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+import json
+import logging
+import os
+import os.path
+import socket
+import threading
+
+try:
+    import socketserver
+except ImportError:  # Python 2
+    import SocketServer as socketserver
+
+from protecodesc import exceptions
+
+logger = logging.getLogger(__name__)
+
+AGENT_JOBS = 4  # jobs run concurrently
+AGENT_MAX_REQUEST = 2**16  # bytes
+AGENT_CONNECT_TIMEOUT = 5  # seconds
+
+
+class Agent(object):
+    """Run jobs for local clients with one long-lived ProtecodeSC client
+
+    Clients connect to a Unix socket and send one job per connection as a
+    JSON object on a single line: scan a path, get a result or request a
+    rescan, optionally waiting until the result is ready, for at most
+    "timeout" seconds if given. The response is
+    a JSON line {"ok": true, "data": ...} or {"ok": false, "error": ...,
+    "type": exception name}.
+
+    Identical jobs that are queued or running are run only once, and
+    clients waiting for results share one ResultPoller.
+    """
+
+    def __init__(self, appcheck, socket_path, max_jobs=AGENT_JOBS):
+        """
+
+        :param appcheck: ProtecodeSC instance
+        :param socket_path: Unix socket to listen on
+        :param max_jobs: Number of jobs run concurrently
+        """
+        from protecodesc.protecodesc import ResultPoller
+        self.appcheck = appcheck
+        self.socket_path = socket_path
+        self._executor = ThreadPoolExecutor(max_workers=max_jobs)
+        self._lock = threading.RLock()
+        self._jobs = {}  # job key -> Future
+        self._waiting = {}  # id_or_sha1 -> [Future]
+        self._poller = ResultPoller(appcheck)
+        self._server = None
+
+    def submit(self, key, func, *args):
+        """Run func(*args) unless a job with the same key is in progress
+
+        Returns a Future shared by all submitters of the job.
+        """
+        with self._lock:
+            future = self._jobs.get(key)
+            if future is None:
+                future = self._executor.submit(func, *args)
+                self._jobs[key] = future
+                future.add_done_callback(
+                    lambda done: self._forget(key, done))
+            return future
+
+    def _forget(self, key, future):
+        with self._lock:
+            if self._jobs.get(key) is future:
+                del self._jobs[key]
+
+    def wait(self, id_or_sha1):
+        """Future for result data once the scan is no longer busy"""
+        future = Future()
+        with self._lock:
+            waiters = self._waiting.setdefault(id_or_sha1, [])
+            waiters.append(future)
+            if len(waiters) == 1:
+                self._poller.add(id_or_sha1)
+        return future
+
+    def _poll(self):
+        """Resolve waiting clients as results become ready"""
+        while True:
+            try:
+                for id_or_sha1, data in self._poller.results(follow=True):
+                    with self._lock:
+                        waiters = self._waiting.pop(id_or_sha1, [])
+                    for future in waiters:
+                        if data is None:
+                            future.set_exception(exceptions.ResultNotFound(
+                                "Object was not found"))
+                        else:
+                            future.set_result(data)
+                return  # closed
+            except exceptions.AppcheckException as e:
+                logger.error("Polling results failed: {error}".format(
+                    error=e))
+                with self._lock:
+                    waiting, self._waiting = self._waiting, {}
+                    # A later wait() adds the result again
+                    self._poller.discard(waiting)
+                for waiters in waiting.values():
+                    for future in waiters:
+                        future.set_exception(e)
+
+    def _scan(self, path, group, dedupe, reproducible, compress_level):
+        if os.path.isdir(path):
+            return self.appcheck.upload_directory(
+                path, group=group, dedupe=dedupe, reproducible=reproducible,
+                compresslevel=compress_level)
+        return self.appcheck.upload_file(path, group=group, dedupe=dedupe)
+
+    def status(self):
+        """Jobs in progress, results waited for and connection statistics"""
+        with self._lock:
+            return {'jobs': len(self._jobs),
+                    'waiting': len(self._waiting),
+                    'connections': self.appcheck.connection_stats()}
+
+    def handle(self, request):
+        """Run job described by request dict, return response data"""
+        job = request.get('job')
+        if job == 'status':
+            return self.status()
+        if job == 'scan':
+            path = os.path.realpath(request['path'])
+            if not os.path.exists(path):
+                raise exceptions.AgentError(
+                    "No such file or directory: {path}".format(path=path))
+            options = (request.get('group'),
+                       bool(request.get('dedupe', True)),
+                       bool(request.get('reproducible', True)),
+                       int(request.get('compress_level', 0)))
+            data = self.submit(('scan', path) + options, self._scan,
+                               path, *options).result()
+            id_or_sha1 = data['results']['sha1sum']
+        elif job in ('result', 'rescan'):
+            id_or_sha1 = str(request['id_or_sha1'])
+            if job == 'rescan':
+                self.submit(('rescan', id_or_sha1), self.appcheck.rescan,
+                            id_or_sha1).result()
+            data = self.submit(('result', id_or_sha1),
+                               self.appcheck.get_result, id_or_sha1).result()
+        else:
+            raise exceptions.AgentError("Unknown job {job}".format(job=job))
+
+        status = data.get('results', {}).get('status')
+        if request.get('wait') and status == self.appcheck.STATUS_BUSY:
+            timeout = request.get('timeout')
+            try:
+                data = self.wait(id_or_sha1).result(
+                    timeout=None if timeout is None else float(timeout))
+            except FutureTimeout:
+                raise exceptions.PollTimeout(
+                    "Result of {id} not ready after {timeout} seconds".format(
+                        id=id_or_sha1, timeout=timeout))
+        return data
+
+    def serve_forever(self):
+        """Accept jobs until shutdown() is called or interrupted"""
+        self._bind()
+        poll_thread = threading.Thread(target=self._poll)
+        poll_thread.daemon = True
+        poll_thread.start()
+        try:
+            self._server.serve_forever()
+        finally:
+            self.close()
+
+    def shutdown(self):
+        """Stop serve_forever() running in another thread"""
+        if self._server is not None:
+            self._server.shutdown()
+
+    def close(self):
+        self._poller.close()
+        self._executor.shutdown(wait=False)
+        if self._server is not None:
+            self._server.server_close()
+            self._server = None
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+
+    def _bind(self):
+        if os.path.exists(self.socket_path):
+            try:
+                AgentClient(self.socket_path, timeout=5).status()
+            except exceptions.AgentError:
+                os.unlink(self.socket_path)  # left behind by a dead agent
+            else:
+                raise exceptions.AgentError(
+                    "Agent already running on {path}".format(
+                        path=self.socket_path))
+        socket_dir = os.path.dirname(self.socket_path)
+        if socket_dir and not os.path.isdir(socket_dir):
+            os.makedirs(socket_dir)
+        # Only the owner may connect
+        umask = os.umask(0o177)
+        try:
+            self._server = _AgentServer(self.socket_path, _AgentHandler)
+        finally:
+            os.umask(umask)
+        self._server.agent = self
+
+
+class _AgentServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class _AgentHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        try:
+            request = json.loads(
+                self.rfile.readline(AGENT_MAX_REQUEST).decode('utf-8'))
+            response = {'ok': True, 'data': self.server.agent.handle(request)}
+        except exceptions.AppcheckException as e:
+            response = {'ok': False, 'error': str(e),
+                        'type': type(e).__name__}
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            response = {'ok': False, 'type': 'AgentError',
+                        'error': "Invalid request: {error}".format(error=e)}
+        try:
+            self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+        except socket.error:
+            pass  # client went away
+
+
+class AgentClient(object):
+    """Send jobs to a running Agent"""
+
+    def __init__(self, socket_path, timeout=None):
+        """
+
+        :param socket_path: Unix socket the agent listens on
+        :param timeout: Seconds to wait for the response to a job,
+                        including its upload; default: no limit. Waiting
+                        for results is limited by the wait_timeout of
+                        the job instead.
+        """
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    def request(self, job, **params):
+        """Send job, return response data
+
+        Errors reported by the agent are raised as the same exceptions
+        ProtecodeSC would raise.
+        """
+        params['job'] = job
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(AGENT_CONNECT_TIMEOUT)
+            try:
+                sock.connect(self.socket_path)
+            except socket.error as e:
+                raise exceptions.AgentError(
+                    "No agent listening on {path}: {error}".format(
+                        path=self.socket_path, error=e))
+            sock.settimeout(self.timeout)
+            sock.sendall((json.dumps(params) + '\n').encode('utf-8'))
+            reader = sock.makefile('rb')
+            try:
+                line = reader.readline()
+            except socket.timeout:
+                raise exceptions.PollTimeout("No response from agent")
+            finally:
+                reader.close()
+        finally:
+            sock.close()
+        if not line:
+            raise exceptions.AgentError("Agent closed connection")
+        response = json.loads(line.decode('utf-8'))
+        if not response.get('ok'):
+            error = getattr(exceptions, response.get('type', ''), None)
+            if not (isinstance(error, type) and
+                    issubclass(error, exceptions.AppcheckException)):
+                error = exceptions.AgentError
+            raise error(response.get('error'))
+        return response['data']
+
+    def scan(self, path, group=None, dedupe=True, reproducible=True,
+             compress_level=0, wait=False, wait_timeout=None):
+        """Upload file or directory, return result data
+
+        :param wait: Wait until the result is ready
+        :param wait_timeout: Seconds to wait for the result at most;
+                             raises PollTimeout [optional]
+        """
+        return self.request('scan', path=os.path.abspath(path), group=group,
+                            dedupe=dedupe, reproducible=reproducible,
+                            compress_level=compress_level, wait=wait,
+                            timeout=wait_timeout)
+
+    def result(self, id_or_sha1, wait=False, wait_timeout=None):
+        """Get result data"""
+        return self.request('result', id_or_sha1=id_or_sha1, wait=wait,
+                            timeout=wait_timeout)
+
+    def rescan(self, id_or_sha1, wait=False, wait_timeout=None):
+        """Request rescan, return result data"""
+        return self.request('rescan', id_or_sha1=id_or_sha1, wait=wait,
+                            timeout=wait_timeout)
+
+    def status(self):
+        return self.request('status')
@@ -0,0 +1,413 @@
+# Copyright (c) 2015 Codenomicon Ltd.
+# License: MIT
+
+from __future__ import absolute_import, division, print_function
+
+import asyncio
+import hashlib
+import logging
+import os.path
+import random
+import re
+import time
+from tempfile import TemporaryFile
+from zipfile import ZIP_DEFLATED, ZIP_STORED
+
+try:
+    import aiohttp
+except ImportError:  # Optional dependency: pip install protecodesc[aio]
+    aiohttp = None
+
+from protecodesc import exceptions
+from protecodesc.protecodesc import (API_URL_MAP, HTTP_TIMEOUT,
+                                     POLL_BACKOFF, POLL_INITIAL_DELAY,
+                                     POLL_MAX_DELAY, ProtecodeSC)
+from protecodesc.retry import RetryPolicy
+from protecodesc.utils import file_sha1, zip_directory_stream
+
+logger = logging.getLogger(__name__)
+
+AIO_MAX_CONCURRENCY = 32  # requests in flight
+AIO_UPLOAD_CHUNK_SIZE = 2**20  # bytes read from disk at a time
+
+
+def _spool_zip(dir_path, tmp_file, reproducible, compresslevel, workers):
+    """Write ZIP archive of directory to tmp_file, return its SHA1"""
+    digest = hashlib.sha1()
+    for chunk in zip_directory_stream(
+            dir_path, compression=ZIP_DEFLATED if compresslevel else
+            ZIP_STORED, reproducible=reproducible,
+            compresslevel=compresslevel or None, workers=workers):
+        digest.update(chunk)
+        tmp_file.write(chunk)
+    return digest.hexdigest()
+
+
+class AsyncProtecodeSC(object):
+    """Protecode SC HTTP API client for asyncio
+
+    Has the operations of ProtecodeSC as coroutines and raises the same
+    exceptions. At most `max_concurrency` requests are in flight at once;
+    waiting for results needs no threads, so thousands of results can be
+    polled together. Hashing, archiving and the SQLite cache lookups run
+    in the default executor, so they do not block the event loop.
+
+    Requires aiohttp. Use as an async context manager, or call close()::
+
+        async with AsyncProtecodeSC(creds, host) as appcheck:
+            data = await appcheck.upload_file('app.apk')
+    """
+
+    STATUS_BUSY = ProtecodeSC.STATUS_BUSY
+    STATUS_READY = ProtecodeSC.STATUS_READY
+
+    def __init__(self, creds, host, insecure=False, hash_cache=None,
+                 result_cache=None, component_cache=None,
+                 max_concurrency=AIO_MAX_CONCURRENCY, retry_policy=None):
+        """
+
+        :param creds: Tuple (username, password)
+        :param host: URI to appliance ('https://appliance.example.com'
+        :param hash_cache: HashCache for file checksums [optional]
+        :param result_cache: ResultCache for completed results [optional]
+        :param component_cache: ComponentCache for component information
+                                [optional]
+        :param max_concurrency: Number of requests in flight at once
+        :param retry_policy: RetryPolicy, may be shared with ProtecodeSC
+                             clients [optional]
+        """
+        if aiohttp is None:
+            raise ImportError("AsyncProtecodeSC requires aiohttp: "
+                              "pip install protecodesc[aio]")
+        super(AsyncProtecodeSC, self).__init__()
+        self.host = host
+        self.creds = creds
+        self.insecure = insecure
+        self.hash_cache = hash_cache
+        self.result_cache = result_cache
+        self.component_cache = component_cache
+        self.max_concurrency = max_concurrency
+        self.retry_policy = (retry_policy if retry_policy is not None
+                             else RetryPolicy())
+        self._semaphore = None
+        self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _get_session(self):
+        # Created on first use, inside the running event loop
+        if self._session is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            connector = aiohttp.TCPConnector(
+                limit=self.max_concurrency,
+                ssl=False if self.insecure else None)
+            timeout = aiohttp.ClientTimeout(sock_connect=HTTP_TIMEOUT,
+                                            sock_read=HTTP_TIMEOUT)
+            self._session = aiohttp.ClientSession(
+                connector=connector, timeout=timeout,
+                auth=aiohttp.BasicAuth(*self.creds))
+        return self._session
+
+    def _uri(self, target, **params):
+        route = API_URL_MAP[target]
+        params.setdefault('host', self.host)
+        return route.format(**params)
+
+    async def _request(self, method, uri, body=None, **kwargs):
+        """Send request with retry on failure, return decoded JSON
+
+        Retries follow retry_policy, as in ProtecodeSC.
+        :param method: HTTP method
+        :param uri: Request URI
+        :param body: Function returning request body; called again for
+                     every retry [optional]
+        :param kwargs: Arguments for aiohttp request
+        """
+        policy = self.retry_policy
+        session = self._get_session()
+        policy.budget.deposit()
+        attempt = 0
+        while True:
+            # Retries are part of the request let through by the breaker,
+            # unless other requests have opened it meanwhile
+            if attempt == 0:
+                allowed = policy.breaker.allow()
+            else:
+                allowed = not policy.breaker.is_open()
+            if not allowed:
+                raise exceptions.CircuitOpenError(
+                    "Server is failing, {reason}".format(
+                        reason=policy.breaker.describe()))
+            response = None
+            try:
+                async with self._semaphore:
+                    if body is not None:
+                        kwargs['data'] = body()
+                    async with session.request(method, uri,
+                                               **kwargs) as response:
+                        if not policy.should_retry(response.status):
+                            if policy.breaker.is_failure(response.status):
+                                policy.breaker.record_failure()
+                            else:
+                                policy.breaker.record_success()
+                            ProtecodeSC._check_status(response.status)
+                            return await response.json(content_type=None)
+            except (aiohttp.ClientConnectionError,
+                    aiohttp.ClientPayloadError,
+                    asyncio.TimeoutError) as e:
+                logger.warning(u"Connection failed: {exception!r}".format(
+                    exception=e))
+                response = None
+            except exceptions.AppcheckException:
+                raise
+            except BaseException:
+                policy.breaker.release()
+                raise
+            if response is not None:
+                logger.warning(u"Server busy or failing: status {code}".format(
+                    code=response.status))
+
+            attempt += 1
+            retry_delay = None
+            if attempt < policy.max_retries:
+                retry_delay = policy.delay(attempt, response)
+            if retry_delay is None or not policy.budget.withdraw():
+                break
+            await asyncio.sleep(retry_delay)
+
+        if response is None or policy.breaker.is_failure(response.status):
+            policy.breaker.record_failure()
+        else:
+            policy.breaker.release()
+        error = "Out of HTTP request retry attempts"
+        if response is not None:
+            error = "{error} (status {code})".format(
+                error=error, code=response.status)
+        raise exceptions.OutOfRetriesError(error)
+
+    async def _run_in_executor(self, func, *args):
+        return await asyncio.get_event_loop().run_in_executor(
+            None, func, *args)
+
+    async def _read_chunks(self, file_fd):
+        """Upload body from file, read in executor
+
+        aiohttp closes file objects passed as body, so they could not be
+        sent again on retry.
+        """
+        file_fd.seek(0)
+        while True:
+            chunk = await self._run_in_executor(file_fd.read,
+                                                AIO_UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+    async def _upload(self, display_name, group, body):
+        display_name = re.sub(r"[^\w._-]", "_", display_name)
+        headers = {}
+        if group:
+            headers['Group'] = str(group)
+        return await self._request('PUT', self._uri('upload',
+                                                    filename=display_name),
+                                   body=body, headers=headers)
+
+    async def upload_file(self, file_path, display_name=None, group=None,
+                          poll=False, dedupe=True):
+        """Upload file to Appcheck
+
+        :param file_path: File to upload
+        :param display_name: Name of uploaded file [optional]
+        :param group: Group ID to upload to [optional]
+        :param poll: Wait until the scan is ready
+        :param dedupe: Return existing result instead of uploading a file
+                       that has been scanned before
+        :return: Result data as returned by get_result
+        """
+        if not display_name:
+            display_name = os.path.basename(file_path)
+
+        data = None
+        if dedupe:
+            sha1 = await self._run_in_executor(file_sha1, file_path,
+                                               self.hash_cache)
+            try:
+                data = await self.get_result(sha1)
+            except exceptions.ResultNotFound:  # upload as new
+                pass
+        if data is None:
+            with open(file_path, 'rb') as file_fd:
+                data = await self._upload(
+                    display_name, group, lambda: self._read_chunks(file_fd))
+        if poll:
+            data = await self._poll_result(data)
+        return data
+
+    async def upload_directory(self, dir_path, display_name=None, group=None,
+                               dedupe=True, reproducible=False,
+                               compresslevel=0, zip_workers=None):
+        """Upload directory to Appcheck as ZIP archive
+
+        The archive is spooled to an anonymous temporary file.
+
+        :param dir_path: Directory to upload
+        :param display_name: Name of uploaded archive [optional]
+        :param group: Group ID to upload to [optional]
+        :param dedupe: Return existing result instead of uploading an archive
+                       that has been scanned before
+        :param reproducible: Build a reproducible archive, so an unchanged
+                             directory matches its earlier result
+        :param compresslevel: Deflate level 1-9, or 0 to store files
+                              uncompressed
+        :param zip_workers: Number of compression threads; default: number
+                            of CPUs
+        :return: Result data as returned by get_result
+        """
+        if not display_name:
+            display_name = "{dirname}.zip".format(
+                dirname=os.path.basename(dir_path.rstrip(os.path.sep)))
+
+        with TemporaryFile() as tmp_file:
+            sha1 = await self._run_in_executor(
+                _spool_zip, dir_path, tmp_file, reproducible, compresslevel,
+                zip_workers)
+            if dedupe:
+                try:
+                    return await self.get_result(sha1)
+                except exceptions.ResultNotFound:  # upload as new
+                    pass
+            return await self._upload(
+                display_name, group, lambda: self._read_chunks(tmp_file))
+
+    async def get_result(self, id_or_sha1, refresh=False):
+        """Get scan result
+
+        Completed results are served from result_cache when available.
+
+        :param id_or_sha1: scan ID or SHA1 checksum (hex string)
+        :param refresh: Bypass result_cache and fetch the result again
+        """
+        if self.result_cache is not None and not refresh:
+            data = await self._run_in_executor(self.result_cache.get,
+                                               id_or_sha1)
+            if data is not None:
+                return data
+        data = await self._request('GET', self._uri('result',
+                                                    id_or_sha1=id_or_sha1))
+        if self.result_cache is not None:
+            if data.get('results', {}).get('status') == self.STATUS_READY:
+                await self._run_in_executor(self.result_cache.put, data)
+            else:
+                await self._run_in_executor(self.result_cache.invalidate,
+                                            id_or_sha1)
+        return data
+
+    async def _poll_result(self, data):
+        results = data.get('results', {})
+        if results.get('status', '') != self.STATUS_BUSY:
+            return data
+        _, data = await self.poll_result(results.get('sha1sum'))
+        return data
+
+    async def poll_result(self, id_or_sha1, timeout=None):
+        """Wait until result is no longer busy
+
+        Returns tuple (id_or_sha1, data), where data is as returned by
+        get_result or None if the result was not found. Checks are spaced
+        as by ResultPoller.
+
+        :param id_or_sha1: scan ID or SHA1 checksum (hex string)
+        :param timeout: Timeout in seconds [optional]
+        :raises PollTimeout: if result is not ready before timeout
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        delay = POLL_INITIAL_DELAY
+        while True:
+            try:
+                data = await self.get_result(id_or_sha1)
+            except exceptions.ResultNotFound:
+                return id_or_sha1, None
+            if data.get('results', {}).get('status') != self.STATUS_BUSY:
+                return id_or_sha1, data
+            wait = delay / 2 + random.uniform(0, delay / 2)
+            delay = min(POLL_MAX_DELAY, delay * POLL_BACKOFF)
+            if deadline is not None:
+                if time.time() >= deadline:
+                    raise exceptions.PollTimeout(
+                        "Results not ready: {id_or_sha1}".format(
+                            id_or_sha1=id_or_sha1))
+                # Last check happens at the deadline
+                wait = min(wait, max(0, deadline - time.time()))
+            await asyncio.sleep(wait)
+
+    def poll_results(self, ids, timeout=None):
+        """Wait for many results together
+
+        Returns an iterator of awaitables in the order results become
+        ready, each giving a tuple (id_or_sha1, data) as poll_result::
+
+            for ready in appcheck.poll_results(ids):
+                id_or_sha1, data = await ready
+
+        :param ids: scan IDs or SHA1 checksums (hex strings)
+        :param timeout: Overall timeout in seconds [optional]
+        """
+        return asyncio.as_completed([self.poll_result(id_or_sha1, timeout)
+                                     for id_or_sha1 in ids])
+
+    async def rescan(self, id_or_sha1):
+        """Request a rescan for result
+
+        :param id_or_sha1: scan ID or SHA1 checksum (hex string)
+        """
+        if self.result_cache is not None:
+            await self._run_in_executor(self.result_cache.invalidate,
+                                        id_or_sha1)
+        return await self._request('POST', self._uri('rescan',
+                                                     id_or_sha1=id_or_sha1))
+
+    async def delete(self, id_or_sha1):
+        """Delete scan result and scanned file
+
+        :param id_or_sha1: scan ID or SHA1 checksum (hex string)
+        """
+        if self.result_cache is not None:
+            await self._run_in_executor(self.result_cache.invalidate,
+                                        id_or_sha1)
+        return await self._request('DELETE', self._uri('result',
+                                                       id_or_sha1=id_or_sha1))
+
+    async def list_groups(self):
+        """List groups"""
+        return await self._request('GET', self._uri('groups'))
+
+    async def component(self, component, version=None):
+        """Get component information
+
+        Served from component_cache when available.
+
+        :param component: component
+        :param version: version
+        """
+        if self.component_cache is not None:
+            data = await self._run_in_executor(self.component_cache.get,
+                                               component, version)
+            if data is not None:
+                return data
+        params = {'version': version} if version else None
+        data = await self._request('GET', self._uri('components',
+                                                    component=component),
+                                   params=params)
+        if self.component_cache is not None:
+            await self._run_in_executor(self.component_cache.put,
+                                        component, version, data)
+        return data
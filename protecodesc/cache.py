@@ -0,0 +1,453 @@
+# Copyright (c) 2015 Codenomicon Ltd.
+# License: MIT
+
+from __future__ import absolute_import, division, print_function
+
+import json
+import logging
+import os
+import os.path
+import sqlite3
+import threading
+import time
+
+from protecodesc.config import USER_CACHE_DIR
+
+logger = logging.getLogger(__name__)
+
+HASH_CACHE_FILE = os.path.join(USER_CACHE_DIR, 'sha1.sqlite')
+HASH_CACHE_MAX_ENTRIES = 100000
+HASH_CACHE_BATCH_SIZE = 1000  # changes written in one transaction
+HASH_CACHE_FLUSH_INTERVAL = 10  # seconds changes are held at most
+RESULT_CACHE_FILE = os.path.join(USER_CACHE_DIR, 'results.sqlite')
+RESULT_CACHE_TTL = 60 * 60  # seconds
+RESULT_CACHE_MAX_SIZE = 256 * 2**20  # bytes of result JSON
+RESULT_CACHE_MAX_ENTRY_SIZE = 16 * 2**20  # bytes of JSON of one result
+COMPONENT_CACHE_FILE = os.path.join(USER_CACHE_DIR, 'components.sqlite')
+COMPONENT_CACHE_TTL = 24 * 60 * 60  # seconds
+COMPONENT_CACHE_MAX_ENTRIES = 100000
+WATCH_STATE_FILE = os.path.join(USER_CACHE_DIR, 'watch.sqlite')
+
+
+def stat_mtime_ns(st):
+    """Modification time of stat result in nanoseconds"""
+    try:
+        return st.st_mtime_ns
+    except AttributeError:  # Python 2
+        return int(st.st_mtime * 10**9)
+
+
+class _SQLiteCache(object):
+    """Thread-safe access to an SQLite cache database, opened on first use"""
+
+    SCHEMA = ()
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = None
+
+    def _connect(self):
+        if self._db is None:
+            cache_dir = os.path.dirname(self.path)
+            if cache_dir and not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            db = sqlite3.connect(self.path, check_same_thread=False)
+            for statement in self.SCHEMA:
+                db.execute(statement)
+            db.commit()
+            self._db = db
+        return self._db
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+class HashCache(_SQLiteCache):
+    """Persistent SHA1 index of local files
+
+    Entries are keyed by absolute path, size, modification time and inode,
+    so a cached checksum is only returned for a file that has not changed
+    since it was hashed. The least recently used entries are evicted when
+    the index grows beyond max_entries.
+
+    New checksums and use times are held in memory and written in one
+    transaction per batch_size changes, after HASH_CACHE_FLUSH_INTERVAL
+    seconds, or on flush() and close().
+
+    Failures to read or write the index are logged and treated as cache
+    misses.
+    """
+
+    SCHEMA = ('CREATE TABLE IF NOT EXISTS sha1 ('
+              'path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, '
+              'inode INTEGER, sha1 TEXT, last_used REAL)',
+              'CREATE INDEX IF NOT EXISTS sha1_last_used ON sha1 (last_used)')
+
+    def __init__(self, path=HASH_CACHE_FILE,
+                 max_entries=HASH_CACHE_MAX_ENTRIES,
+                 batch_size=HASH_CACHE_BATCH_SIZE):
+        super(HashCache, self).__init__(path)
+        self.max_entries = max_entries
+        self.batch_size = batch_size
+        self._added = {}  # path -> row to insert
+        self._used = {}  # path -> last used time
+        self._written = time.time()
+
+    @staticmethod
+    def _key(file_path, st):
+        return (os.path.abspath(file_path), st.st_size, stat_mtime_ns(st),
+                st.st_ino)
+
+    def get(self, file_path, st=None):
+        """Return cached SHA1 of file or None if unknown or changed
+
+        :param file_path: Path to file
+        :param st: os.stat() result of file [optional]
+        """
+        if st is None:
+            st = os.stat(file_path)
+        key = self._key(file_path, st)
+        try:
+            with self._lock:
+                added = self._added.get(key[0])
+                if added is not None:
+                    return added[4] if added[:4] == key else None
+                db = self._connect()
+                row = db.execute('SELECT sha1 FROM sha1 WHERE path = ? AND '
+                                 'size = ? AND mtime_ns = ? AND inode = ?',
+                                 key).fetchone()
+                if row is None:
+                    return None
+                self._used[key[0]] = time.time()
+                self._write_due()
+                return row[0]
+        except (sqlite3.Error, OSError) as e:
+            logger.warning(u"Hash cache lookup failed: {exception}"
+                           .format(exception=e))
+            return None
+
+    def put(self, file_path, sha1, st=None):
+        """Store SHA1 of file
+
+        :param file_path: Path to file
+        :param sha1: SHA1 checksum (hex string)
+        :param st: os.stat() result of file at time of hashing [optional]
+        """
+        if st is None:
+            st = os.stat(file_path)
+        key = self._key(file_path, st)
+        with self._lock:
+            self._added[key[0]] = key + (sha1, time.time())
+            self._used.pop(key[0], None)
+            try:
+                self._write_due()
+            except (sqlite3.Error, OSError) as e:
+                logger.warning(u"Hash cache update failed: {exception}"
+                               .format(exception=e))
+
+    def flush(self):
+        """Write checksums and use times held in memory"""
+        with self._lock:
+            try:
+                self._write()
+            except (sqlite3.Error, OSError) as e:
+                logger.warning(u"Hash cache update failed: {exception}"
+                               .format(exception=e))
+
+    def close(self):
+        self.flush()
+        super(HashCache, self).close()
+
+    def _write_due(self):
+        if (len(self._added) + len(self._used) >= self.batch_size or
+                time.time() - self._written >= HASH_CACHE_FLUSH_INTERVAL):
+            self._write()
+
+    def _write(self):
+        added, self._added = self._added, {}
+        used, self._used = self._used, {}
+        self._written = time.time()
+        if not (added or used):
+            return
+        db = self._connect()
+        with db:
+            db.executemany('INSERT OR REPLACE INTO sha1 (path, size, '
+                           'mtime_ns, inode, sha1, last_used) '
+                           'VALUES (?, ?, ?, ?, ?, ?)', list(added.values()))
+            db.executemany('UPDATE sha1 SET last_used = ? WHERE path = ?',
+                           [(t, path) for path, t in used.items()])
+            if added:
+                self._evict(db)
+
+    def _evict(self, db):
+        count = db.execute('SELECT COUNT(*) FROM sha1').fetchone()[0]
+        excess = count - self.max_entries
+        if excess > 0:
+            db.execute('DELETE FROM sha1 WHERE path IN (SELECT path FROM sha1 '
+                       'ORDER BY last_used ASC LIMIT ?)', (excess,))
+
+
+class ResultCache(_SQLiteCache):
+    """Persistent cache of completed scan results
+
+    A result is stored under both its scan ID and SHA1 checksum, and is
+    returned for up to ttl seconds after it was fetched. Results whose
+    JSON is larger than max_entry_size bytes are not stored. When the
+    stored JSON exceeds max_size bytes, the least recently used results
+    are evicted.
+
+    Failures to read or write the cache are logged and treated as cache
+    misses.
+    """
+
+    SCHEMA = ('CREATE TABLE IF NOT EXISTS results ('
+              'key TEXT PRIMARY KEY, entry TEXT, data TEXT, size INTEGER, '
+              'stored REAL, last_used REAL)',
+              'CREATE INDEX IF NOT EXISTS results_entry ON results (entry)',
+              'CREATE INDEX IF NOT EXISTS results_last_used '
+              'ON results (last_used)')
+
+    def __init__(self, path=RESULT_CACHE_FILE, ttl=RESULT_CACHE_TTL,
+                 max_size=RESULT_CACHE_MAX_SIZE,
+                 max_entry_size=RESULT_CACHE_MAX_ENTRY_SIZE):
+        super(ResultCache, self).__init__(path)
+        self.ttl = ttl
+        self.max_size = max_size
+        self.max_entry_size = max_entry_size
+
+    def get(self, id_or_sha1):
+        """Return cached result data or None if missing or expired
+
+        :param id_or_sha1: scan ID or SHA1 checksum (hex string)
+        """
+        try:
+            with self._lock:
+                db = self._connect()
+                row = db.execute('SELECT data FROM results WHERE key = ? '
+                                 'AND stored >= ?',
+                                 (str(id_or_sha1),
+                                  time.time() - self.ttl)).fetchone()
+                if row is None:
+                    return None
+                db.execute('UPDATE results SET last_used = ? WHERE key = ?',
+                           (time.time(), str(id_or_sha1)))
+                db.commit()
+                return json.loads(row[0])
+        except (sqlite3.Error, OSError, ValueError) as e:
+            logger.warning(u"Result cache lookup failed: {exception}"
+                           .format(exception=e))
+            return None
+
+    def put(self, data, text=None):
+        """Store result data as returned by get_result
+
+        :param data: Result data; only its scan ID and SHA1 are used if
+                     text is given
+        :param text: JSON of data as received [optional]
+        """
+        results = data.get('results', {})
+        keys = [str(k) for k in (results.get('id'), results.get('sha1sum'))
+                if k is not None]
+        if not keys:
+            return
+        if text is None:
+            text = json.dumps(data)
+        if len(text) > self.max_entry_size:
+            return
+        now = time.time()
+        try:
+            with self._lock:
+                db = self._connect()
+                for key in keys:
+                    db.execute('INSERT OR REPLACE INTO results (key, entry, '
+                               'data, size, stored, last_used) '
+                               'VALUES (?, ?, ?, ?, ?, ?)',
+                               (key, keys[0], text, len(text), now, now))
+                self._evict(db)
+                db.commit()
+        except (sqlite3.Error, OSError) as e:
+            logger.warning(u"Result cache update failed: {exception}"
+                           .format(exception=e))
+
+    def invalidate(self, id_or_sha1):
+        """Forget result stored under scan ID or SHA1 checksum
+
+        :param id_or_sha1: scan ID or SHA1 checksum (hex string)
+        """
+        try:
+            with self._lock:
+                db = self._connect()
+                db.execute('DELETE FROM results WHERE entry IN '
+                           '(SELECT entry FROM results WHERE key = ?)',
+                           (str(id_or_sha1),))
+                db.commit()
+        except (sqlite3.Error, OSError) as e:
+            logger.warning(u"Result cache update failed: {exception}"
+                           .format(exception=e))
+
+    def _evict(self, db):
+        db.execute('DELETE FROM results WHERE stored < ?',
+                   (time.time() - self.ttl,))
+        total = db.execute('SELECT SUM(size) FROM results').fetchone()[0] or 0
+        excess = total - self.max_size
+        if excess <= 0:
+            return
+        evicted = []
+        for key, size in db.execute('SELECT key, size FROM results '
+                                    'ORDER BY last_used ASC'):
+            evicted.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        db.executemany('DELETE FROM results WHERE key = ?', evicted)
+
+
+class ComponentCache(_SQLiteCache):
+    """Persistent cache of component information
+
+    Entries are keyed by component name and version, returned for up to
+    ttl seconds after they were fetched, and evicted least recently used
+    first when there are more than max_entries.
+
+    Failures to read or write the cache are logged and treated as cache
+    misses.
+    """
+
+    SCHEMA = ('CREATE TABLE IF NOT EXISTS components ('
+              'component TEXT, version TEXT, data TEXT, stored REAL, '
+              'last_used REAL, PRIMARY KEY (component, version))',
+              'CREATE INDEX IF NOT EXISTS components_last_used '
+              'ON components (last_used)')
+
+    def __init__(self, path=COMPONENT_CACHE_FILE, ttl=COMPONENT_CACHE_TTL,
+                 max_entries=COMPONENT_CACHE_MAX_ENTRIES):
+        super(ComponentCache, self).__init__(path)
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+    def get(self, component, version=None):
+        """Return cached component information or None if missing or expired
+
+        :param component: Component name
+        :param version: Component version [optional]
+        """
+        key = (component, version or '')
+        try:
+            with self._lock:
+                db = self._connect()
+                row = db.execute('SELECT data FROM components WHERE '
+                                 'component = ? AND version = ? AND '
+                                 'stored >= ?',
+                                 key + (time.time() - self.ttl,)).fetchone()
+                if row is None:
+                    return None
+                db.execute('UPDATE components SET last_used = ? WHERE '
+                           'component = ? AND version = ?',
+                           (time.time(),) + key)
+                db.commit()
+                return json.loads(row[0])
+        except (sqlite3.Error, OSError, ValueError) as e:
+            logger.warning(u"Component cache lookup failed: {exception}"
+                           .format(exception=e))
+            return None
+
+    def put(self, component, version, data):
+        """Store component information
+
+        :param component: Component name
+        :param version: Component version or None
+        :param data: Component information as returned by the API
+        """
+        now = time.time()
+        try:
+            with self._lock:
+                db = self._connect()
+                db.execute('INSERT OR REPLACE INTO components (component, '
+                           'version, data, stored, last_used) '
+                           'VALUES (?, ?, ?, ?, ?)',
+                           (component, version or '', json.dumps(data),
+                            now, now))
+                self._evict(db)
+                db.commit()
+        except (sqlite3.Error, OSError) as e:
+            logger.warning(u"Component cache update failed: {exception}"
+                           .format(exception=e))
+
+    def _evict(self, db):
+        db.execute('DELETE FROM components WHERE stored < ?',
+                   (time.time() - self.ttl,))
+        count = db.execute('SELECT COUNT(*) FROM components').fetchone()[0]
+        excess = count - self.max_entries
+        if excess > 0:
+            db.execute('DELETE FROM components WHERE rowid IN (SELECT rowid '
+                       'FROM components ORDER BY last_used ASC LIMIT ?)',
+                       (excess,))
+
+
+class WatchState(_SQLiteCache):
+    """Persistent record of files scanned by watch
+
+    Stores size, modification time and inode of each file as it was when
+    uploaded, so a restarted watch only uploads files changed since.
+
+    Failures to read or write the state are logged; files are then
+    treated as not scanned yet.
+    """
+
+    SCHEMA = ('CREATE TABLE IF NOT EXISTS watched ('
+              'path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, '
+              'inode INTEGER, sha1 TEXT, scanned_at REAL)',)
+
+    def __init__(self, path=WATCH_STATE_FILE):
+        super(WatchState, self).__init__(path)
+
+    def snapshot(self, root):
+        """Dict of path: (size, mtime_ns, inode) for files under root"""
+        prefix = os.path.join(os.path.abspath(root), '')
+        try:
+            with self._lock:
+                db = self._connect()
+                rows = db.execute('SELECT path, size, mtime_ns, inode '
+                                  'FROM watched WHERE substr(path, 1, ?) = ?',
+                                  (len(prefix), prefix)).fetchall()
+        except (sqlite3.Error, OSError) as e:
+            logger.warning(u"Watch state lookup failed: {exception}"
+                           .format(exception=e))
+            return {}
+        return dict((row[0], tuple(row[1:])) for row in rows)
+
+    def put(self, file_path, signature, sha1):
+        """Record file as scanned
+
+        :param file_path: Path to file
+        :param signature: (size, mtime_ns, inode) of file when uploaded
+        :param sha1: SHA1 checksum (hex string)
+        """
+        try:
+            with self._lock:
+                db = self._connect()
+                db.execute('INSERT OR REPLACE INTO watched (path, size, '
+                           'mtime_ns, inode, sha1, scanned_at) '
+                           'VALUES (?, ?, ?, ?, ?, ?)',
+                           (os.path.abspath(file_path),) + tuple(signature) +
+                           (sha1, time.time()))
+                db.commit()
+        except (sqlite3.Error, OSError) as e:
+            logger.warning(u"Watch state update failed: {exception}"
+                           .format(exception=e))
+
+    def remove(self, paths):
+        """Forget files, e.g. after they were deleted"""
+        try:
+            with self._lock:
+                db = self._connect()
+                db.executemany('DELETE FROM watched WHERE path = ?',
+                               [(os.path.abspath(p),) for p in paths])
+                db.commit()
+        except (sqlite3.Error, OSError) as e:
+            logger.warning(u"Watch state update failed: {exception}"
+                           .format(exception=e))
@@ -3,18 +3,23 @@
 
 from __future__ import absolute_import, division, print_function
 
+import csv
+import io
+import itertools
 import json
 import os.path
-from tempfile import NamedTemporaryFile
-from zipfile import ZipFile
+import shutil
+from tempfile import SpooledTemporaryFile
 import click
 import time
 import functools
 import sys
 
-from protecodesc.protecodesc import ProtecodeSC
-from protecodesc.config import ClientConfig
-from protecodesc.utils import clean_version, zip_directory
+# requests, keyring and their dependencies are imported only by commands
+# that need them, to keep startup fast
+from protecodesc.config import AGENT_SOCKET, ClientConfig
+from protecodesc.metrics import Metrics
+from protecodesc.retry import MAX_HTTP_RETRIES, RateLimiter, RetryPolicy
 from protecodesc import exceptions
 
 import logging
@@ -25,12 +30,27 @@ VERDICT_PASS_SYMBOL = u"\U0001F60A"  # SMILING FACE WITH SMILING EYES
 VERDICT_FAIL_SYMBOL = u"\U0001F622"  # CRYING FACE
 VERDICT_VERIFY_SYMBOL = u"\U0001f440"  # EYES
 
+# Raw JSON results up to this size are kept in memory for --json output
+RESULT_SPOOL_SIZE = 8 * 2**20
+
 # Default to Codenomicon online service
 DEFAULT_APPCHECK_HOST = 'https://protecode-sc.com'
 
 
-def get_appcheck(insecure=False):
-    config = ClientConfig()
+def get_config():
+    """ClientConfig shared by the current invocation"""
+    ctx = click.get_current_context(silent=True)
+    if ctx is None or ctx.obj is None:
+        return ClientConfig()
+    if 'config' not in ctx.obj:
+        ctx.obj['config'] = ClientConfig()
+    return ctx.obj['config']
+
+
+def get_appcheck(insecure=False, workers=1, metrics=None, retry_policy=None):
+    from protecodesc.cache import ResultCache
+    from protecodesc.protecodesc import ProtecodeSC
+    config = get_config()
     username, password = config.credentials()
     if not (username and password):
         click.echo("Login required.")
@@ -38,16 +58,34 @@ def get_appcheck(insecure=False):
     # Support alternate Appcheck address, e.g. appliance.
     appcheck_host = config.get_host() or DEFAULT_APPCHECK_HOST
     appcheck = ProtecodeSC(creds=(username, password), host=appcheck_host,
-                        insecure=insecure)
+                        insecure=insecure, result_cache=ResultCache(),
+                        workers=workers, metrics=metrics,
+                        retry_policy=retry_policy)
     return appcheck
 
 
+agent_option = click.option(
+    '--agent', 'agent_socket', metavar="SOCKET", envvar='PROTECODESC_AGENT',
+    help="Send job to protecodesc agent listening on SOCKET")
+
+
+progress_option = click.option(
+    '--progress/--no-progress', default=None,
+    help="Report bytes sent, throughput and ETA of uploads on stderr; "
+         "default: when stderr is a terminal")
+
+
 def use_appcheck(f):
-    """Decorator that initializes Appcheck instance"""
+    """Decorator that initializes Appcheck instance
+
+    Commands with an agent_socket option get None instead when it is set.
+    """
 
     @click.option('--insecure/--verify-ssl', help="Do not verify TLS certificate for HTTPS")
     @functools.wraps(f)
     def inner(insecure, **kwargs):
+        if kwargs.get('agent_socket'):
+            return f(None, **kwargs)
         if insecure:
             # If user chose to use insecure explicitly, ignore warnings...
             try:
@@ -56,15 +94,41 @@ def use_appcheck(f):
                 click.echo("Warning: Not verifying TLS certificates.")
             except ImportError:
                 pass  # If requests moves urllib3 around
-        appcheck = get_appcheck(insecure=insecure)
-        f(appcheck, **kwargs)
+        # Size connection pool for commands running parallel jobs
+        obj = click.get_current_context().obj or {}
+        workers = (kwargs.get('jobs') or 1) * (kwargs.get('shard_jobs') or 1)
+        appcheck = get_appcheck(insecure=insecure, workers=workers,
+                                metrics=obj.get('metrics'),
+                                retry_policy=obj.get('retry_policy'))
+        try:
+            f(appcheck, **kwargs)
+        finally:
+            if appcheck.hash_cache is not None:
+                appcheck.hash_cache.close()
     return inner
 
 
 @click.group(help="Protecode SC commandline tools. To use this tool you need "
                   "to have an account on the service.")
-def cli():
+@click.option('--metrics', 'metrics_file', metavar="FILE",
+              type=click.Path(dir_okay=False, writable=True),
+              help="Write request timings and counters to FILE on exit")
+@click.option('--metrics-format', type=click.Choice(['json', 'prometheus']),
+              default='json', show_default=True,
+              help="Format of metrics FILE")
+@click.option('--retries', type=click.IntRange(1, None),
+              default=MAX_HTTP_RETRIES, show_default=True,
+              help="Attempts per HTTP request before giving up")
+@click.pass_context
+def cli(ctx, metrics_file, metrics_format, retries):
     """Protecode SC command line utility"""
+    if ctx.obj is None:
+        ctx.obj = {}
+    ctx.obj['retry_policy'] = RetryPolicy(max_retries=retries)
+    if metrics_file:
+        metrics = ctx.obj['metrics'] = Metrics()
+        ctx.call_on_close(
+            lambda: metrics.dump(metrics_file, fmt=metrics_format))
 
 
 @cli.add_command
@@ -81,19 +145,24 @@ def groups(appcheck):
 
 @cli.add_command
 @click.option('--group', help="Show applications in GROUP", metavar="GROUP")
+@click.option('json_output', '--jsonl', is_flag=True,
+              help="Output one JSON object per line")
 @click.command()
 @use_appcheck
-def list(appcheck, group):
+def list(appcheck, group, json_output):
     """List apps"""
-    apps = appcheck.list_apps(group=group)
-
     app_format = u"{id:5s}  {name}"
-    if len(apps['products']) > 0:
-        click.echo(app_format.format(id="ID", name="Application name"))
-        for p in apps['products']:
-            click.echo(app_format.format(id=str(p['id']),
-                                         name=p['name']))
-    else:
+    found = False
+    for p in appcheck.list_apps(group=group):
+        if json_output:
+            click.echo(json.dumps(p))
+            continue
+        if not found:
+            click.echo(app_format.format(id="ID", name="Application name"))
+        found = True
+        click.echo(app_format.format(id=str(p['id']),
+                                     name=p['name']))
+    if not found and not json_output:
         click.echo("No apps found.")
 
 @cli.add_command
@@ -102,64 +171,465 @@ def list(appcheck, group):
 @use_appcheck
 def group(appcheck, default_group):
     """Set default group"""
-    config = ClientConfig()
+    config = get_config()
     config.set_default_group(int(default_group))
 
 @cli.add_command
 @click.argument('id_or_sha1', 'Analysis ID or file SHA1 hash')
 @click.option('json_output', '--json/--human', default=False,
               help='Output in machine-readable JSON or human')
+@click.option('--refresh', is_flag=True,
+              help="Fetch result from server even if cached locally")
+@agent_option
 @click.command()
 @use_appcheck
-def result(appcheck, id_or_sha1, json_output):
+def result(appcheck, id_or_sha1, json_output, refresh, agent_socket):
     """Get scan result"""
-    _print_result(appcheck, id_or_sha1=id_or_sha1, json_output=json_output)
+    if agent_socket:
+        _print_agent_result(_agent_client(agent_socket), id_or_sha1,
+                            json_output)
+        return
+    _print_result(appcheck, id_or_sha1=id_or_sha1, json_output=json_output,
+                  refresh=refresh)
 
 
 @cli.add_command
-@click.argument('id_or_sha1', 'Analysis ID or file SHA1 hash')
+@click.option('--group', help="Summarize applications in GROUP",
+              metavar="GROUP", required=True)
+@click.option('--jobs', '-j', help="Fetch N results in parallel; default: 8",
+              metavar="N", type=click.IntRange(1, None), default=8)
+@click.option('output_format', '--format', default='table',
+              type=click.Choice(['table', 'json', 'csv']),
+              help="Output format; default: table")
+@click.command()
+@use_appcheck
+def rollup(appcheck, group, jobs, output_format):
+    """Summarize vulnerabilities and licenses of a group"""
+    from protecodesc.rollup import rollup_group
+    report = rollup_group(appcheck, group, workers=jobs).report()
+    if output_format == 'json':
+        click.echo(json.dumps(report))
+        return
+    if output_format == 'csv':
+        out = io.StringIO() if sys.version_info[0] >= 3 else io.BytesIO()
+        writer = csv.writer(out)
+        writer.writerow(['lib', 'version', 'apps', 'vulnerable_apps',
+                         'vulns'])
+        for row in report['components']:
+            writer.writerow([row['lib'], row['version'] or '', row['apps'],
+                             row['vulnerable_apps'], row['vulns']])
+        click.echo(out.getvalue(), nl=False)
+        return
+
+    click.echo("Group {group}: {apps} apps, {ready} ready, {vuln} with "
+               "vulnerable components, {failed} failed"
+               .format(group=group, apps=report['apps'],
+                       ready=report['ready'], vuln=report['vulnerable_apps'],
+                       failed=len(report['failed'])))
+    click.echo()
+    row_format = u"{apps:>6} {vulnerable_apps:>6} {vulns:>7}  {name}"
+    click.echo(row_format.format(apps='Apps', vulnerable_apps='Vuln',
+                                 vulns='Vulns', name='Component'))
+    for row in report['components']:
+        name = row['lib']
+        if row['version']:
+            name = u"{lib} ({version})".format(**row)
+        click.echo(row_format.format(name=name, **row))
+    click.echo()
+    click.echo(u"{count:>6}  {name}".format(count='Count', name='License'))
+    for name, count in sorted(report['licenses'].items(),
+                              key=lambda item: (-item[1], item[0])):
+        click.echo(u"{count:>6}  {name}".format(count=count, name=name))
+
+
+def _read_component_pairs(input_file, input_format='auto'):
+    """Read (component, version) pairs from CSV or JSON Lines
+
+    CSV rows are "component,version", with an optional header row. JSON
+    Lines objects have keys "component" (or "name" or "lib") and
+    "version".
+    """
+    lines = (line for line in input_file if line.strip())
+    first = next(lines, None)
+    if first is None:
+        return
+    lines = itertools.chain([first], lines)
+    if input_format == 'auto':
+        input_format = 'jsonl' if first.lstrip().startswith('{') else 'csv'
+
+    if input_format == 'jsonl':
+        for line in lines:
+            obj = json.loads(line)
+            name = obj.get('component') or obj.get('name') or obj.get('lib')
+            yield name, obj.get('version')
+        return
+
+    for i, row in enumerate(csv.reader(lines)):
+        if not row:
+            continue
+        if i == 0 and row[0].strip().lower() in ('component', 'name', 'lib'):
+            continue  # header
+        yield row[0].strip(), row[1].strip() if len(row) > 1 else None
+
+
+@cli.add_command
+@click.option('--group', help="Sync only applications in GROUP",
+              metavar="GROUP")
+@click.option('--jobs', '-j', help="Fetch N results in parallel; default: 8",
+              metavar="N", type=click.IntRange(1, None), default=8)
+@click.option('--full', is_flag=True,
+              help="Fetch all results, also those that have not changed")
+@click.option('--max-age', help="Fetch results synced more than HOURS ago "
+              "again, as rescans and vulnerability updates do not show in "
+              "the application list; default: 24", metavar="HOURS",
+              type=float, default=24)
+@click.command()
+@use_appcheck
+def sync(appcheck, group, jobs, full, max_age):
+    """Copy results to the local store for query.
+
+    Only results that changed since the last sync, were rescanned or are
+    older than --max-age are fetched, and applications deleted on the
+    server are removed from the store.
+    """
+    from protecodesc.store import ResultStore, sync_results
+    store = ResultStore()
+    stats = sync_results(appcheck, store, group=group, workers=jobs,
+                         full=full, max_age=max_age * 60 * 60)
+    click.echo("Synced {apps} apps: {fetched} fetched, {unchanged} "
+               "unchanged, {removed} removed, {failed} failed".format(**stats))
+    if stats['failed']:
+        raise click.ClickException(
+            "{failed} results could not be fetched".format(**stats))
+
+
+@cli.add_command
+@click.option('--component', '-c', help="Component name, e.g. openssl",
+              metavar="NAME")
+@click.option('--version', '-v', help="Component version; * matches any "
+              "characters, e.g. 1.0.2*", metavar="VERSION")
+@click.option('--license', '-l', help="License name", metavar="NAME")
+@click.option('--vuln', help="Vulnerability ID, e.g. CVE-2016-2107",
+              metavar="ID")
+@click.option('--vulnerable', is_flag=True,
+              help="Only components with known vulnerabilities")
+@click.option('--group', help="Only applications synced from GROUP",
+              metavar="GROUP")
+@click.option('json_output', '--jsonl', is_flag=True,
+              help="Output one JSON object per line")
+@click.command()
+def query(component, version, license, vuln, vulnerable, group,
+          json_output):
+    """Find applications by component, license or vulnerability.
+
+    Searches results copied to the local store by sync, without
+    contacting the server. Lists each matching component of each
+    application.
+    """
+    from protecodesc.store import ResultStore
+    store = ResultStore()
+    if not store.stats()['apps']:
+        raise click.ClickException("Local store is empty, run sync first")
+    row_format = u"{id:>6}  {name:30}  {component:30} {vulns:>5}  {license}"
+    found = False
+    for row in store.query(component=component, version=version,
+                           license=license, vuln=vuln, vulnerable=vulnerable,
+                           group=group):
+        if json_output:
+            click.echo(json.dumps(row))
+            continue
+        if not found:
+            click.echo(row_format.format(id='ID', name='Application',
+                                         component='Component',
+                                         vulns='Vulns', license='License'))
+        found = True
+        name = row['lib']
+        if row['version']:
+            name = u"{lib} ({version})".format(**row)
+        click.echo(row_format.format(id=row['id'], name=row['name'] or '',
+                                     component=name, vulns=row['vulns'],
+                                     license=row['license'] or ''))
+    if not found and not json_output:
+        click.echo("No matching components found.")
+
+
+@cli.add_command
+@click.argument('input_file', type=click.File('r'), default='-',
+                required=False)
+@click.option('input_format', '--input-format', default='auto',
+              type=click.Choice(['auto', 'csv', 'jsonl']),
+              help="Format of INPUT_FILE; default: detect")
+@click.option('--jobs', '-j', help="Look up N components in parallel; "
+                                   "default: 8",
+              metavar="N", type=click.IntRange(1, None), default=8)
+@click.option('--component-cache/--no-component-cache', default=True,
+              help="Reuse earlier answers; default: enabled")
+@click.command()
+@use_appcheck
+def components(appcheck, input_file, input_format, jobs, component_cache):
+    """Look up components listed in a file.
+
+    INPUT_FILE (default: stdin) lists component,version pairs as CSV or
+    JSON Lines. Each distinct component is looked up once, and the answers
+    are written as JSON Lines.
+    """
+    if component_cache:
+        from protecodesc.cache import ComponentCache
+        appcheck.component_cache = ComponentCache()
+    pairs = _read_component_pairs(input_file, input_format)
+    for (name, version), data in appcheck.components(pairs, workers=jobs):
+        click.echo(json.dumps({'component': name, 'version': version,
+                               'found': data is not None, 'info': data}))
+
+
+def bulk_options(f):
+    """Options of commands that act on many IDs"""
+    f = click.option('report_file', '--report', metavar="FILE",
+                     type=click.File('w'),
+                     help="Write outcome for each ID to FILE as JSON "
+                          "Lines")(f)
+    f = click.option('--rate', help="Send at most N requests per second",
+                     metavar="N", type=click.IntRange(1, None))(f)
+    f = click.option('--jobs', '-j', help="Send N requests in parallel; "
+                                          "default: 4",
+                     metavar="N", type=click.IntRange(1, None), default=4)(f)
+    f = click.option('input_file', '--input', metavar="FILE",
+                     type=click.File('r'),
+                     help="Read IDs from FILE, one per line; - for stdin")(f)
+    return f
+
+
+def _read_ids(args, input_file=None):
+    """IDs from arguments and input_file without duplicates
+
+    Blank lines and lines starting with # in input_file are skipped.
+    """
+    ids = []
+    seen = set()
+    lines = (line.strip() for line in input_file or ())
+    for id_or_sha1 in itertools.chain(args, lines):
+        if not id_or_sha1 or id_or_sha1.startswith('#'):
+            continue
+        if id_or_sha1 not in seen:
+            seen.add(id_or_sha1)
+            ids.append(id_or_sha1)
+    if not ids:
+        raise click.UsageError("No IDs given")
+    return ids
+
+
+def _call_each(func, ids, jobs, rate=None, metrics=None):
+    """Call func(id_or_sha1) for many IDs in parallel
+
+    Yields tuples (id_or_sha1, data, error) in order of ids, where error
+    is the exception if the call failed. Login and agent errors are
+    raised, as they would fail all the other calls too.
+
+    :param rate: Requests started per second at most [optional]
+    :param metrics: Metrics to record time waited for rate limit
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    limiter = RateLimiter(rate) if rate else None
+
+    def _call(id_or_sha1):
+        if limiter is not None:
+            waited = limiter.acquire()
+            if waited and metrics is not None:
+                metrics.add_sleep('rate_limit', waited)
+        try:
+            return func(id_or_sha1), None
+        except (exceptions.InvalidLoginError, exceptions.AgentError):
+            raise
+        except exceptions.AppcheckException as e:
+            return None, e
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(_call, id_or_sha1) for id_or_sha1 in ids]
+        try:
+            for id_or_sha1, future in zip(ids, futures):
+                data, error = future.result()
+                yield id_or_sha1, data, error
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+def _run_bulk(func, ids, jobs, rate, report_file, done_message,
+              metrics=None):
+    """Call func for every ID, print and report the outcome of each
+
+    Returns a tuple (IDs that succeeded, number of failures).
+
+    :param done_message: Format string for success, e.g. "Deleted {id}"
+    """
+    succeeded = []
+    failed = 0
+    for id_or_sha1, _, error in _call_each(func, ids, jobs, rate=rate,
+                                           metrics=metrics):
+        if error is None:
+            succeeded.append(id_or_sha1)
+            click.echo(done_message.format(id=id_or_sha1))
+        else:
+            failed += 1
+            click.echo("{id} - FAILED: {error}".format(id=id_or_sha1,
+                                                       error=error))
+        if report_file is not None:
+            report_file.write(json.dumps({
+                'id_or_sha1': id_or_sha1, 'ok': error is None,
+                'error': None if error is None else str(error)}) + '\n')
+            report_file.flush()
+    if len(ids) > 1:
+        click.echo("Summary: {ok} succeeded, {failed} failed".format(
+            ok=len(succeeded), failed=failed))
+    return succeeded, failed
+
+
+@cli.add_command
+@click.argument('id_or_sha1', nargs=-1)
 @click.option('--background/--wait', help="Scan in background; default: wait for results", default=False)
+@click.option('--timeout', help="Give up waiting after SECONDS",
+              metavar="SECONDS", type=float)
+@bulk_options
+@agent_option
 @click.command()
 @use_appcheck
-def rescan(appcheck, id_or_sha1, background):
-    """Request rescan of existing result"""
-    appcheck.rescan(id_or_sha1)
-    click.echo("Requested rescan of {id_or_sha1}".format(id_or_sha1=id_or_sha1))
-    if not background:
-        _print_result(appcheck, id_or_sha1=id_or_sha1, json_output=False, wait=True)
+def rescan(appcheck, id_or_sha1, background, timeout, input_file, jobs, rate,
+           report_file, agent_socket):
+    """Request rescan of existing results.
+
+    IDs or SHA1 hashes are given as arguments or read from --input FILE,
+    one per line. Rescans are requested in parallel, and results are
+    waited for together.
+    """
+    ids = _read_ids(id_or_sha1, input_file)
+    if agent_socket:
+        client = _agent_client(agent_socket)
+        succeeded, failed = _run_bulk(client.rescan, ids, jobs, rate,
+                                      report_file, "Requested rescan of {id}")
+        _invalidate_stored(succeeded)
+        if not background:
+            # The agent polls the results waited for together
+            wait = functools.partial(client.result, wait=True,
+                                     wait_timeout=timeout)
+            for id_or_sha1, data, error in _call_each(wait, succeeded, jobs):
+                if error is not None:
+                    click.echo("{id} - FAILED: {error}".format(
+                        id=id_or_sha1, error=error))
+                    continue
+                _print_result_data(data, json_output=False,
+                                   separator=len(ids) > 1)
+    else:
+        succeeded, failed = _run_bulk(appcheck.rescan, ids, jobs, rate,
+                                      report_file, "Requested rescan of {id}",
+                                      metrics=appcheck.metrics)
+        _invalidate_stored(succeeded)
+        if not background and succeeded:
+            _print_results(appcheck, succeeded, json_output=False,
+                           timeout=timeout, separator=len(ids) > 1)
+    if failed:
+        raise click.ClickException("{count} of {total} rescans failed".format(
+            count=failed, total=len(ids)))
+
+
+def _invalidate_stored(ids):
+    """Make sync fetch results of rescanned apps again"""
+    from protecodesc.store import RESULT_STORE_FILE, ResultStore
+    if ids and os.path.exists(RESULT_STORE_FILE):
+        ResultStore().invalidate(ids)
 
 
-def _print_result(appcheck, id_or_sha1, json_output, wait=True):
-    wait_printed = False
-    while True:
+def _print_result(appcheck, id_or_sha1, json_output, wait=True,
+                  timeout=None, refresh=False):
+    with SpooledTemporaryFile(RESULT_SPOOL_SIZE) as raw_file:
         try:
-            data = appcheck.get_result(id_or_sha1=id_or_sha1)
-            res = data.get('results', {})
-            if wait and res['status'] == ProtecodeSC.STATUS_BUSY:
-                if not wait_printed:
-                    wait_printed = True
-                    click.echo("Waiting for result for {id_or_sha1}"
-                               .format(id_or_sha1=id_or_sha1))
-                time.sleep(5)
-                continue
-            break
+            stream = appcheck.stream_result(
+                id_or_sha1=id_or_sha1, refresh=refresh,
+                raw_file=raw_file if json_output else None)
+            summary = _summarize_components(stream)
         except exceptions.ResultNotFound:
             click.echo("Result not found")
             return
+        res = stream.document.get('results', {})
+        if wait and res.get('status') == appcheck.STATUS_BUSY:
+            click.echo("Waiting for result for {id_or_sha1}"
+                       .format(id_or_sha1=id_or_sha1))
+            _print_results(appcheck, [id_or_sha1], json_output,
+                           timeout=timeout)
+            return
+        if json_output:
+            # Pass the response through as is
+            raw_file.seek(0)
+            stdout = click.get_binary_stream('stdout')
+            shutil.copyfileobj(raw_file, stdout)
+            stdout.write(b'\n')
+            stdout.flush()
+            return
+        _echo_result(res, summary)
 
+
+def _print_results(appcheck, ids, json_output, timeout=None,
+                   separator=False, sharded=()):
+    """Wait for many results together, print each as soon as it is ready
+
+    :param sharded: List of (name, shard IDs) of directories uploaded in
+                    shards; their results are printed combined once all
+                    shards are ready
+    """
+    from protecodesc.rollup import merge_results
+    shard_ready = [{} for _ in sharded]
+    shard_groups = {}  # shard ID -> indexes in sharded
+    for i, (_, shard_ids) in enumerate(sharded):
+        for shard_id in shard_ids:
+            shard_groups.setdefault(shard_id, []).append(i)
+    # Note: list is shadowed by the list command in this module
+    poll_ids = tuple(ids) + tuple(shard_id for shard_id in shard_groups
+                                  if shard_id not in ids)
+    try:
+        for id_or_sha1, data in appcheck.poll_results(poll_ids,
+                                                      timeout=timeout):
+            for i in shard_groups.get(id_or_sha1, []):
+                name, shard_ids = sharded[i]
+                shard_ready[i][id_or_sha1] = data
+                if len(shard_ready[i]) == len(set(shard_ids)):
+                    merged = merge_results(name, [
+                        shard_ready[i][shard_id] for shard_id in shard_ids
+                        if shard_ready[i][shard_id] is not None])
+                    _print_result_data(merged, json_output, separator)
+            if id_or_sha1 not in ids:
+                continue
+            if data is None:
+                click.echo("Result not found: {id_or_sha1}"
+                           .format(id_or_sha1=id_or_sha1))
+                continue
+            _print_result_data(data, json_output, separator)
+    except exceptions.PollTimeout as e:
+        raise click.ClickException("Timed out waiting for results. {error}"
+                                   .format(error=e))
+
+
+def _print_result_data(data, json_output, separator=False):
     if json_output:
         click.echo(json.dumps(data))
-        return
+    else:
+        res = data.get('results', {})
+        _echo_result(res, _summarize_components(res.get('components', [])))
+    if separator:
+        click.echo("="*50)
 
-    summary = res['summary']
-    filename = res.get('filename', "")
-    sha1 = res.get('sha1sum')
-    components = res.get('components', [])
-    report_url = res.get('report_url')
 
-    # Component analysis
+def _summarize_components(components):
+    """Component, license and vulnerability summary in one pass
+
+    :param components: Iterable of components, e.g. a JSONArrayStream
+    """
+    from protecodesc.utils import clean_version
     component_texts = set()
+    licenses = set()
+    vuln_components = 0
+    total_components = 0
+    lic_unknown = {'name': 'UNKNOWN'}
     for c in components:
+        # Component analysis
         c_lib = c.get('lib')
         c_version = c.get('version')
         if c_version:
@@ -168,21 +638,41 @@ def _print_result(appcheck, id_or_sha1, json_output, wait=True):
         else:
             c_text = "{lib}".format(lib=c_lib)
         component_texts.add(c_text)
-    # Number of vulnerable components
-    vuln_components = sum([1 for c in components if c['vulns']])
-    total_components = len(components)
+        # Number of vulnerable components
+        if c['vulns']:
+            vuln_components += 1
+        total_components += 1
+        # License analysis
+        licenses.add((c.get('license') or lic_unknown)['name'])
+    return {'component_texts': component_texts,
+            'licenses': licenses,
+            'vuln_components': vuln_components,
+            'total_components': total_components}
 
-    # License analysis
-    lic_unknown = {'name': 'UNKNOWN'}
-    licenses = [x.get('license', lic_unknown)['name'] for x in components]
+
+def _echo_result(res, components_summary):
+    summary = res['summary']
+    filename = res.get('filename', "")
+    sha1 = res.get('sha1sum')
+    report_url = res.get('report_url')
+    component_texts = components_summary['component_texts']
+    licenses = components_summary['licenses']
+    vuln_components = components_summary['vuln_components']
+    total_components = components_summary['total_components']
 
     # Print output
     click.echo("Analysis results")
     click.echo("    File:   {name}".format(name=filename))
-    click.echo("    SHA1:   {sha1}".format(sha1=sha1))
+    if sha1:
+        click.echo("    SHA1:   {sha1}".format(sha1=sha1))
     if report_url:
         click.echo("    Report: {uri}".format(uri=report_url))
+    for shard in res.get('shards', []):
+        click.echo("    Shard:  {name} {sha1} {uri}".format(
+            name=shard['filename'], sha1=shard['sha1sum'],
+            uri=shard['report_url'] or ''))
 
+    from protecodesc.protecodesc import ProtecodeSC
     if not res['status'] == ProtecodeSC.STATUS_READY:
         click.echo("Result not yet ready.")
         return
@@ -197,7 +687,7 @@ def _print_result(appcheck, id_or_sha1, json_output, wait=True):
     if licenses:
         click.echo()
         click.echo('License analysis:')
-        click.echo('    ' + ' '.join(sorted(set(licenses))))
+        click.echo('    ' + ' '.join(sorted(licenses)))
 
     click.echo()
     verdict = summary['verdict']['short']
@@ -217,85 +707,545 @@ def _print_result(appcheck, id_or_sha1, json_output, wait=True):
     click.echo(u'    ' + summary['verdict']['detailed'])
 
 
+def _upload_artifact(appcheck, path, group, dedupe, reproducible,
+                     compress_level, shard_size=None, shard_jobs=1):
+    """Upload a single file or directory, return result data
+
+    A directory is split into archives of at most shard_size bytes if
+    given; then a list of result data of the shards is returned.
+    """
+    if os.path.isdir(path) and shard_size:
+        logger.info("Zipping directory in shards...")
+        return appcheck.upload_directory_shards(
+            path, max_size=shard_size, group=group, dedupe=dedupe,
+            compresslevel=compress_level, workers=shard_jobs)
+    if os.path.isdir(path):
+        # Upload directory as ZIP
+        logger.info("Zipping directory...")
+        return appcheck.upload_directory(path, group=group, dedupe=dedupe,
+                                         reproducible=reproducible,
+                                         compresslevel=compress_level)
+    # Regular file, upload as is
+    return appcheck.upload_file(path, group=group, dedupe=dedupe)
+
+
 @cli.add_command
 @click.argument('file', 'file to analyze', nargs=-1, required=True, type=click.Path(exists=True))
 @click.option('--group', help="Upload to group id GROUP (see group)",
               metavar="GROUP", type=int)
 @click.option('--background/--wait', help="Scan in background; default: wait for results", default=False)
+@click.option('--jobs', '-j', help="Upload N objects in parallel; default: 1",
+              metavar="N", type=click.IntRange(1, None), default=1)
+@click.option('--fail-fast/--keep-going', default=True,
+              help="Stop on first failed upload; default: fail fast")
+@click.option('--hash-cache/--no-hash-cache', default=True,
+              help="Reuse checksums of unchanged files; default: enabled")
+@click.option('--dedupe/--no-dedupe', default=True,
+              help="Skip upload of objects scanned before; with --no-dedupe "
+                   "directories are streamed without a temporary file; "
+                   "default: dedupe")
+@click.option('--reproducible/--no-reproducible', default=True,
+              help="Zip directories with sorted entries and normalized "
+                   "timestamps and permissions, so unchanged directories "
+                   "are not scanned again; default: reproducible")
+@click.option('--compress-level', '-z', default=0, type=click.IntRange(0, 9),
+              help="Deflate level 1-9 for zipped directories, compressed on "
+                   "all CPUs; already compressed files (.jar, .apk, .gz, "
+                   "...) are stored as is; default: 0, store only")
+@click.option('--shard-size', help="Split directories into archives of at "
+              "most MB megabytes, uploaded in parallel and reported "
+              "together", metavar="MB", type=click.IntRange(1, None))
+@click.option('--shard-jobs', help="Upload N shards of a directory in "
+              "parallel; default: 4", metavar="N",
+              type=click.IntRange(1, None), default=4)
+@click.option('--timeout', help="Give up waiting for results after SECONDS",
+              metavar="SECONDS", type=float)
+@progress_option
+@click.option('--spool', is_flag=True,
+              help="Queue uploads on disk when the service is unreachable, "
+                   "to be sent later with flush")
+@click.option('--spool-by-path', is_flag=True,
+              help="Queue only the path of an upload instead of a copy")
+@agent_option
 @click.command()
 @use_appcheck
-def scan(appcheck, file, group, background):
+def scan(appcheck, file, group, background, jobs, fail_fast, hash_cache,
+         dedupe, reproducible, compress_level, shard_size, shard_jobs, timeout,
+         progress, spool, spool_by_path, agent_socket):
     """Analyze a file or directory.
 
     If a directory is analyzed, it will be compressed to a ZIP archive before
-    upload.
+    upload. With --shard-size, it is split into several archives instead,
+    whose results are combined.
+
+    With --spool, uploads that fail because the service is unreachable are
+    queued on disk instead, and the command succeeds. Run flush to send
+    them once the service is back.
+
+    With --agent, the agent uploads with its own settings, so --jobs,
+    --keep-going, --no-hash-cache, --shard-size, --progress and --spool
+    cannot be used.
     """
 
+    if spool_by_path and shard_size:
+        raise click.UsageError("--spool-by-path cannot be used with "
+                               "--shard-size")
+    if agent_socket:
+        # The agent uploads with its own workers, hash cache and retries
+        unsupported = [option for option, used in (
+            ('--jobs', jobs != 1), ('--keep-going', not fail_fast),
+            ('--no-hash-cache', not hash_cache), ('--shard-size', shard_size),
+            ('--progress', progress), ('--spool', spool),
+            ('--spool-by-path', spool_by_path)) if used]
+        if unsupported:
+            raise click.UsageError(
+                "{options} cannot be used with --agent or "
+                "PROTECODESC_AGENT".format(options=", ".join(unsupported)))
     if not group:
-        group = ClientConfig().get_default_group()
+        group = get_config().get_default_group()
+    if agent_socket:
+        _agent_scan(_agent_client(agent_socket), file, group=group,
+                    wait=not background, dedupe=dedupe,
+                    reproducible=reproducible, compress_level=compress_level,
+                    timeout=timeout)
+        return
+    if hash_cache:
+        from protecodesc.cache import HashCache
+        appcheck.hash_cache = HashCache()
 
     file_count = len(file)
+    from concurrent.futures import ThreadPoolExecutor
     click.echo('Uploading {count} objects...'.format(count=file_count))
+    progress = appcheck.progress = _upload_progress(progress)
     upload_shasums = []
-    for i, f in enumerate(file):
-        display_name = click.format_filename(f)
-        click.echo(display_name)
-
-        if os.path.isdir(f):
-            # Upload directory as ZIP
-            logger.info("Zipping directory...")
-            zip_name = "{dirname}.zip".format(
-                dirname=os.path.basename(display_name.rstrip(os.path.sep)))
-            with NamedTemporaryFile() as tmp_file:
-                with ZipFile(tmp_file.name, 'w') as zip_file:
-                    zip_directory(f, zip_file)
-                res = appcheck.upload_file(tmp_file.name,
-                                           display_name=zip_name,
-                                           group=group)
-        else:
-            # Regular file, upload as is
-            res = appcheck.upload_file(f, group=group)
+    sharded = []  # (name, shard SHA1s) of directories uploaded in shards
+    uploaded = 0
+    failed = []
+    spooled = 0
+    scanned_before = 0
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        # Uploads run in parallel, output is written in argument order
+        futures = [executor.submit(_upload_artifact, appcheck, f, group,
+                                   dedupe, reproducible, compress_level,
+                                   shard_size=shard_size and shard_size * 2**20,
+                                   shard_jobs=shard_jobs)
+                   for f in file]
+        for f, future in zip(file, futures):
+            display_name = click.format_filename(f)
+            _clear_progress(progress)
+            click.echo(display_name)
+            try:
+                res = future.result()
+            except exceptions.InvalidLoginError:
+                for pending in futures:
+                    pending.cancel()
+                raise
+            except exceptions.ConnectionFailure as e:
+                _clear_progress(progress)
+                if not spool:
+                    failed.append(display_name)
+                    click.echo(" - FAILED: {error}".format(error=e))
+                    if fail_fast:
+                        for pending in futures:
+                            pending.cancel()
+                        break
+                    continue
+                _spool_upload(f, group, copy=not spool_by_path,
+                              reproducible=reproducible,
+                              compress_level=compress_level, error=e,
+                              shard_size=shard_size and shard_size * 2**20)
+                spooled += 1
+                continue
+            except exceptions.AppcheckException as e:
+                _clear_progress(progress)
+                failed.append(display_name)
+                click.echo(" - FAILED: {error}".format(error=e))
+                if fail_fast:
+                    for pending in futures:
+                        pending.cancel()
+                    break
+                continue
 
-        if res['results']['status'] == ProtecodeSC.STATUS_READY:
-            status = 'READY; scanned before'
-        else:
-            status = 'queued for scanning'
-        report_url = res['results']['report_url']
-        sha1_checksum = res['results']['sha1sum']
-        upload_shasums.append(sha1_checksum)
-        click.echo(" - SHA1: {sha1}".format(sha1=sha1_checksum))
-        click.echo(" - {url} ({status})".format(url=report_url,
-                                                status=status))
-
-    if not background:
+            uploaded += 1
+            _clear_progress(progress)
+            if shard_size and os.path.isdir(f):
+                shard_sha1s = []
+                for shard in res:
+                    shard_sha1s.append(shard['results']['sha1sum'])
+                    click.echo(" - {name}: {sha1} ({status})".format(
+                        name=shard['results']['filename'],
+                        sha1=shard['results']['sha1sum'],
+                        status='READY' if shard['results']['status'] ==
+                        appcheck.STATUS_READY else 'queued'))
+                if all(shard['results']['status'] == appcheck.STATUS_READY
+                       for shard in res):
+                    scanned_before += 1
+                sharded.append((display_name, shard_sha1s))
+                continue
+            if res['results']['status'] == appcheck.STATUS_READY:
+                status = 'READY; scanned before'
+                scanned_before += 1
+            else:
+                status = 'queued for scanning'
+            report_url = res['results']['report_url']
+            sha1_checksum = res['results']['sha1sum']
+            upload_shasums.append(sha1_checksum)
+            click.echo(" - SHA1: {sha1}".format(sha1=sha1_checksum))
+            click.echo(" - {url} ({status})".format(url=report_url,
+                                                    status=status))
+
+    if progress is not None:
+        progress.close()
+    skipped = file_count - uploaded - len(failed) - spooled
+    click.echo()
+    click.echo("Summary: {uploaded} uploaded, {before} scanned before, "
+               "{failed} failed, {skipped} skipped"
+               .format(uploaded=uploaded - scanned_before,
+                       before=scanned_before, failed=len(failed),
+                       skipped=skipped) +
+               (", {spooled} spooled".format(spooled=spooled)
+                if spooled else ""))
+    stats = appcheck.connection_stats()
+    click.echo("Connections: {connections} opened for {requests} requests "
+               "({reused} reused)".format(**stats))
+
+    if not background and (upload_shasums or sharded):
         click.echo()
+        click.echo("Waiting for {count} results...".format(
+            count=len(upload_shasums) + len(sharded)))
         click.echo("="*50)
-        for sha1 in upload_shasums:
-            _print_result(appcheck, id_or_sha1=sha1, json_output=False,
-                          wait=True)
-            click.echo("="*50)
+        _print_results(appcheck, upload_shasums, json_output=False,
+                       timeout=timeout, separator=True, sharded=sharded)
+
+    if failed:
+        raise click.ClickException(
+            "{count} of {total} uploads failed".format(count=len(failed),
+                                                       total=file_count))
+
+
+def _upload_progress(enabled):
+    """UploadProgress if enabled, or by default on a terminal, else None"""
+    if enabled is None:
+        enabled = sys.stderr.isatty()
+    if not enabled:
+        return None
+    from protecodesc.utils import UploadProgress
+    return UploadProgress()
+
+
+def _clear_progress(progress):
+    if progress is not None:
+        progress.clear()
+
+
+def _spool_upload(path, group, copy, reproducible, compress_level, error,
+                  shard_size=None):
+    """Queue upload that failed for flush to send later
+
+    A directory is queued as one entry per shard if shard_size is given,
+    with the same archive names as upload_directory_shards uses.
+    """
+    import sqlite3
+    from protecodesc.spool import UploadSpool
+    spool = UploadSpool()
+    try:
+        if os.path.isdir(path) and shard_size:
+            from protecodesc.utils import shard_archive_name, shard_directory
+            name = os.path.basename(os.path.abspath(path))
+            shards = shard_directory(path, shard_size)
+            for index, files in enumerate(shards, start=1):
+                spool.add(path, group=group,
+                          display_name=shard_archive_name(name, index,
+                                                          len(shards)),
+                          reproducible=True, compresslevel=compress_level,
+                          files=files)
+        else:
+            spool.add(path, group=group, copy=copy,
+                      reproducible=reproducible, compresslevel=compress_level)
+    except (EnvironmentError, sqlite3.Error) as e:
+        raise click.ClickException(
+            "Could not spool {path}: {spool_error} (upload failed: "
+            "{error})".format(path=click.format_filename(path),
+                              spool_error=e, error=error))
+    click.echo(" - SPOOLED: {error}".format(error=error))
 
 
 @cli.add_command
-@click.argument('id_or_sha1', 'Analysis ID or file SHA1 hash')
+@click.option('--jobs', '-j', help="Upload N objects in parallel; default: 4",
+              metavar="N", type=click.IntRange(1, None), default=4)
+@click.option('--hash-cache/--no-hash-cache', default=True,
+              help="Reuse checksums of unchanged files; default: enabled")
+@click.option('list_only', '--list', is_flag=True,
+              help="Show queued uploads without sending them")
+@progress_option
 @click.command()
 @use_appcheck
-def delete(appcheck, id_or_sha1):
-    """Delete scan result"""
+def flush(appcheck, jobs, hash_cache, list_only, progress):
+    """Send uploads queued by scan --spool.
+
+    Uploads still failing stay queued for the next flush, and uploads of
+    paths that no longer exist are dropped. Objects scanned before are not
+    uploaded again.
+    """
+    from protecodesc.spool import UploadSpool
+    spool = UploadSpool()
+    if list_only:
+        for entry in spool.entries():
+            click.echo(u"{id:>5}  {name}  {path}{error}".format(
+                id=entry['id'], name=entry['display_name'],
+                path=click.format_filename(entry['path']),
+                error=u"  ({attempts} failed: {last_error})".format(**entry)
+                if entry['attempts'] else u""))
+        return
+    if hash_cache:
+        from protecodesc.cache import HashCache
+        appcheck.hash_cache = HashCache()
+    progress = appcheck.progress = _upload_progress(progress)
+    sent = 0
+    failed = 0
+    for entry, data, error in spool.flush(appcheck, workers=jobs):
+        _clear_progress(progress)
+        click.echo(click.format_filename(entry['path']))
+        if error is not None:
+            failed += 1
+            click.echo(" - FAILED: {error}".format(error=error))
+            continue
+        sent += 1
+        res = data['results']
+        click.echo(" - SHA1: {sha1}".format(sha1=res['sha1sum']))
+        click.echo(" - {url}".format(url=res['report_url']))
+    if progress is not None:
+        progress.close()
+    remaining = len(spool)
+    click.echo("Summary: {sent} sent, {failed} failed, {remaining} still "
+               "queued".format(sent=sent, failed=failed, remaining=remaining))
+    if remaining:
+        raise click.ClickException("{count} uploads still queued".format(
+            count=remaining))
+
 
-    click.confirm('Really delete all data for result?'.format(id=id_or_sha1), abort=True)
+def _agent_client(agent_socket):
+    from protecodesc.agent import AgentClient
+    return AgentClient(agent_socket)
+
+
+def _print_agent_result(client, id_or_sha1, json_output, wait=False):
     try:
-        appcheck.delete(id_or_sha1)
+        data = client.result(id_or_sha1, wait=wait)
     except exceptions.ResultNotFound:
-        click.echo("Result was not found")
+        click.echo("Result not found")
+        return
+    except exceptions.PollTimeout as e:
+        raise click.ClickException("Timed out waiting for results. {error}"
+                                   .format(error=e))
+    if json_output:
+        click.echo(json.dumps(data))
         return
+    res = data.get('results', {})
+    _echo_result(res, _summarize_components(res.get('components', [])))
+
+
+def _agent_scan(client, paths, group, wait, dedupe, reproducible,
+                compress_level, timeout=None):
+    """Scan paths through agent, print results in argument order
+
+    :param timeout: Seconds to wait for results after upload [optional]
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    failed = []
+    # The agent limits concurrency; a thread per path only waits
+    with ThreadPoolExecutor(max_workers=len(paths)) as executor:
+        futures = [executor.submit(client.scan, path, group=group,
+                                   dedupe=dedupe, reproducible=reproducible,
+                                   compress_level=compress_level, wait=wait,
+                                   wait_timeout=timeout)
+                   for path in paths]
+        for path, future in zip(paths, futures):
+            display_name = click.format_filename(path)
+            click.echo(display_name)
+            try:
+                data = future.result()
+            except exceptions.AgentError:
+                raise
+            except exceptions.AppcheckException as e:
+                failed.append(display_name)
+                click.echo(" - FAILED: {error}".format(error=e))
+                continue
+            res = data['results']
+            click.echo(" - SHA1: {sha1}".format(sha1=res['sha1sum']))
+            click.echo(" - {url}".format(url=res['report_url']))
+            if wait:
+                _echo_result(res, _summarize_components(
+                    res.get('components', [])))
+                click.echo("="*50)
+    if failed:
+        raise click.ClickException(
+            "{count} of {total} uploads failed".format(count=len(failed),
+                                                       total=len(paths)))
+
+
+@cli.add_command
+@click.option('--socket', 'socket_path', default=AGENT_SOCKET,
+              type=click.Path(dir_okay=False),
+              help="Listen on Unix socket PATH; default: {path}".format(
+                  path=AGENT_SOCKET))
+@click.option('--jobs', '-j', help="Run N jobs concurrently; default: 4",
+              metavar="N", type=click.IntRange(1, None), default=4)
+@click.option('--hash-cache/--no-hash-cache', default=True,
+              help="Reuse checksums of unchanged files; default: enabled")
+@click.command()
+@use_appcheck
+def agent(appcheck, socket_path, jobs, hash_cache):
+    """Run scan, result and rescan jobs for other commands.
+
+    Keeps one logged-in client with open connections, and shares uploads
+    and result polling between commands. Send jobs with scan, result or
+    rescan --agent SOCKET, or set PROTECODESC_AGENT=SOCKET.
+    """
+    from protecodesc.agent import Agent
+    import signal
+    if hash_cache:
+        from protecodesc.cache import HashCache
+        appcheck.hash_cache = HashCache()
+    server = Agent(appcheck, socket_path, max_jobs=jobs)
+    # Clean up the socket on kill as well as on Ctrl-C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    click.echo("Agent listening on {path}".format(path=socket_path))
+    try:
+        server.serve_forever()
+    except exceptions.AgentError as e:
+        raise click.ClickException(str(e))
+
+
+@cli.add_command
+@click.argument('directory', type=click.Path(exists=True, file_okay=False))
+@click.option('--group', help="Upload to group id GROUP (see group)",
+              metavar="GROUP", type=int)
+@click.option('--interval', help="Seconds between walks of DIRECTORY when "
+              "polling; default: 10", metavar="SECONDS", type=float,
+              default=10)
+@click.option('--debounce', help="Upload files only after they have not "
+              "changed for SECONDS; default: 2", metavar="SECONDS",
+              type=float, default=2)
+@click.option('--jobs', '-j', help="Upload N files in parallel; default: 1",
+              metavar="N", type=click.IntRange(1, None), default=1)
+@click.option('--inotify/--polling', default=True,
+              help="Notice changes with inotify if available, or by walking "
+                   "DIRECTORY periodically")
+@click.option('--once', is_flag=True,
+              help="Upload changes since the last run and exit")
+@click.command()
+@use_appcheck
+def watch(appcheck, directory, group, interval, debounce, jobs, inotify,
+          once):
+    """Scan new and changed files in a directory.
+
+    Files are uploaded once they have not changed for a while. Files that
+    were already scanned are remembered between runs, so a restarted watch
+    only uploads what changed meanwhile.
+    """
+    from protecodesc.cache import HashCache, WatchState
+    from protecodesc.watch import Watcher
+    if not group:
+        group = get_config().get_default_group()
+    appcheck.hash_cache = HashCache()
+    watcher = Watcher(appcheck, directory, WatchState(), group=group,
+                      interval=interval, debounce=debounce, workers=jobs,
+                      use_inotify=inotify)
+    if not once:
+        click.echo("Watching {dir} ({method})".format(
+            dir=click.format_filename(directory),
+            method='inotify' if watcher.using_inotify else 'polling'))
+    failed = 0
+    try:
+        for path, data, error in watcher.run(once=once):
+            display_name = click.format_filename(path)
+            if error is not None:
+                failed += 1
+                click.echo("{path} - FAILED: {error}".format(
+                    path=display_name, error=error))
+                continue
+            res = data['results']
+            if res['status'] == appcheck.STATUS_READY:
+                status = 'READY; scanned before'
+            else:
+                status = 'queued for scanning'
+            click.echo("{path} - SHA1: {sha1} - {url} ({status})".format(
+                path=display_name, sha1=res['sha1sum'],
+                url=res['report_url'], status=status))
+    finally:
+        watcher.close()
+    if failed:
+        raise click.ClickException("{count} uploads failed".format(
+            count=failed))
+
+
+@cli.add_command
+@click.argument('path', nargs=-1, required=True, type=click.Path(exists=True))
+@click.option('--jobs', '-j', help="Hash with N processes; default: number of CPUs",
+              metavar="N", type=click.IntRange(1, None))
+@click.option('--hash-cache/--no-hash-cache', default=False,
+              help="Reuse checksums of unchanged files; default: disabled")
+@click.option('--benchmark', is_flag=True,
+              help="Report hashing throughput in MB/s")
+@click.command()
+def sha1sum(path, jobs, hash_cache, benchmark):
+    """Compute SHA1 checksums of files.
+
+    Directories are searched recursively. The checksums are the ones used
+    to find earlier scan results.
+    """
+    from protecodesc.cache import HashCache
+    from protecodesc.utils import file_finder, hash_files
+    cache = HashCache() if hash_cache else None
+    total_bytes = 0
+    start = time.time()
+    for file_path, sha1 in hash_files(file_finder(path), workers=jobs,
+                                      cache=cache):
+        total_bytes += os.path.getsize(file_path)
+        click.echo(u"{sha1}  {path}".format(
+            sha1=sha1, path=click.format_filename(file_path)))
+    elapsed = time.time() - start
+    if benchmark:
+        mb = total_bytes / 2**20
+        click.echo("Hashed {mb:.1f} MB in {seconds:.2f} s ({rate:.1f} MB/s)"
+                   .format(mb=mb, seconds=elapsed,
+                           rate=mb / elapsed if elapsed > 0 else 0), err=True)
+
+
+@cli.add_command
+@click.argument('id_or_sha1', nargs=-1)
+@click.option('--yes', '-y', is_flag=True, help="Do not ask for confirmation")
+@bulk_options
+@click.command()
+@use_appcheck
+def delete(appcheck, id_or_sha1, yes, input_file, jobs, rate, report_file):
+    """Delete scan results.
+
+    IDs or SHA1 hashes are given as arguments or read from --input FILE,
+    one per line. Deleting is confirmed once for all of them; use --yes
+    when reading IDs from stdin.
+    """
+    ids = _read_ids(id_or_sha1, input_file)
+    if not yes:
+        if len(ids) == 1:
+            question = 'Really delete all data for result?'
+        else:
+            question = 'Really delete all data for {count} results?'.format(
+                count=len(ids))
+        click.confirm(question, abort=True)
+    _, failed = _run_bulk(appcheck.delete, ids, jobs, rate, report_file,
+                          "Deleted {id}", metrics=appcheck.metrics)
+    if failed:
+        raise click.ClickException("{count} of {total} deletes failed".format(
+            count=failed, total=len(ids)))
 
 
 @cli.add_command
 @click.command()
 def login():
     """Save username/password and configure server address"""
-    config = ClientConfig()
+    config = get_config()
     if click.confirm("Use Protecode SC managed service https://protecode-sc.com/?"):
         config.set_host(DEFAULT_APPCHECK_HOST)
     else:
@@ -308,14 +1258,14 @@ def login():
 @click.command()
 def logout():
     """Forget saved username and password"""
-    config = ClientConfig()
+    config = get_config()
     config.forget_credentials()
 
 
 def update_login_credentials():
     username = click.prompt("Login username/email-address")
     password = click.prompt("Login password", hide_input=True)
-    config = ClientConfig()
+    config = get_config()
     if click.confirm('Save information and do not ask again?'):
         config.set_credentials(username, password)
         click.echo("Saved login details.")
@@ -351,6 +1301,10 @@ def main(retries=2):
             click.echo("Out of retries, aborting.")
     except KeyboardInterrupt:
         pass
+    except exceptions.AgentError as e:
+        # Raised by commands using --agent when the agent is unreachable
+        click.echo("Error: {error}".format(error=e), err=True)
+        sys.exit(1)
     except exceptions.ConnectionFailure as e:
         click.echo(e)
         sys.exit(1)
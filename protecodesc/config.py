@@ -1,7 +1,7 @@
 # Copyright (c) 2015 Codenomicon Ltd.
 # License: MIT
 
-import keyring
+import os
 import os.path
 
 try:
@@ -12,7 +12,18 @@ except ImportError:  # Python 2
 
 # Where to store settings
 USER_CONFIG_FILE = os.path.expanduser('~/.protecodesc')
+# Where to store local caches
+USER_CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+    'protecodesc')
+# Where a running agent listens for jobs
+AGENT_SOCKET = os.path.join(
+    os.environ.get('XDG_RUNTIME_DIR') or USER_CACHE_DIR,
+    'protecodesc-agent.sock')
 KEYRING_SERVICE = 'protecodesc'
+# Credentials from environment take precedence and skip keyring
+ENV_USERNAME = 'PROTECODESC_USERNAME'
+ENV_PASSWORD = 'PROTECODESC_PASSWORD'
 SECTION = 'protecodesc'
 DEFAULT_HOST = "https://protecode-sc.com"
 
@@ -20,18 +31,33 @@ class ClientConfig:
 
     def __init__(self, config_files=(USER_CONFIG_FILE,)):
         self._config = configparser.ConfigParser()
+        self._credentials = None
 
         # Read config files
         self._config.read(config_files)
 
     def credentials(self):
-        """Get stored username and password"""
-        try:
-            username = self._config.get(SECTION, 'username')
-            password = keyring.get_password(KEYRING_SERVICE, username)
-        except configparser.NoSectionError:
-            username, password = None, None
-        return username, password
+        """Get username and password
+
+        Taken from PROTECODESC_USERNAME and PROTECODESC_PASSWORD if both
+        are set, otherwise from config file and keyring. Keyring is queried
+        only once per ClientConfig.
+        """
+        username = os.environ.get(ENV_USERNAME)
+        password = os.environ.get(ENV_PASSWORD)
+        if username and password:
+            return username, password
+        if self._credentials is None:
+            try:
+                username = self._config.get(SECTION, 'username')
+            except (configparser.NoSectionError, configparser.NoOptionError):
+                username = None
+            password = None
+            if username:
+                import keyring  # slow to import and discover backends
+                password = keyring.get_password(KEYRING_SERVICE, username)
+            self._credentials = username, password
+        return self._credentials
 
     def get_host(self):
         """Return Appcheck alternate host address or None for default
@@ -68,10 +94,13 @@ class ClientConfig:
             self._config.add_section(SECTION)
         self._config.set(SECTION, 'username', username)
         self._config.write(open(USER_CONFIG_FILE, 'w'))
+        import keyring
         keyring.set_password(KEYRING_SERVICE, username, password)
+        self._credentials = username, password
 
     def forget_credentials(self):
         """Forget saved credentials"""
         prev_username, prev_password = self.credentials()
+        import keyring
         keyring.set_password(KEYRING_SERVICE, prev_username, '')
         self.set_credentials('', '')
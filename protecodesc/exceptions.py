@@ -20,3 +20,15 @@ class ResultNotFound(AppcheckException):
 
 class InvalidLoginError(AppcheckException):
     """Login was rejected"""
+
+
+class PollTimeout(AppcheckException):
+    """Scan results were not ready before timeout"""
+
+
+class CircuitOpenError(ConnectionFailure):
+    """Requests refused after too many consecutive failures"""
+
+
+class AgentError(AppcheckException):
+    """Agent is not running or could not run a job"""
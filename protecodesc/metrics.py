@@ -0,0 +1,202 @@
+# Copyright (c) 2015 Codenomicon Ltd.
+# License: MIT
+
+from __future__ import absolute_import, division, print_function
+
+from contextlib import contextmanager
+import json
+import threading
+import time
+
+try:
+    from urllib.parse import urlparse
+except ImportError:  # Python 2
+    from urlparse import urlparse
+
+# Upper bounds of latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+                   120, 300)
+METRIC_PREFIX = 'protecodesc'
+
+
+def endpoint_label(url):
+    """API endpoint of request URL, e.g. 'upload' or 'app'"""
+    parts = [p for p in urlparse(url or '').path.split('/') if p]
+    if len(parts) >= 2 and parts[0] == 'api':
+        return parts[1]
+    return 'other'
+
+
+class Histogram(object):
+    """Cumulative histogram of durations"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+    def as_dict(self):
+        return {'count': self.count,
+                'sum': self.sum,
+                'buckets': [[bound, count] for bound, count
+                            in zip(self.buckets, self.counts)]}
+
+
+class Metrics(object):
+    """Timing and traffic metrics of a ProtecodeSC client
+
+    Collects per-endpoint request latency histograms, request and byte
+    counts, retries, time spent sleeping between retries and polls, and
+    durations of local operations such as hashing. Safe to use from many
+    threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = {}  # (endpoint, status) -> count
+        self.latency = {}  # endpoint -> Histogram
+        self.bytes_sent = {}  # endpoint -> bytes
+        self.bytes_received = {}  # endpoint -> bytes
+        self.retries = {}  # endpoint -> count
+        self.sleep = {}  # reason -> seconds
+        self.operations = {}  # operation -> Histogram
+
+    @staticmethod
+    def _add(counter, key, value=1):
+        counter[key] = counter.get(key, 0) + value
+
+    def observe_response(self, response, *args, **kwargs):
+        """Record a requests response; usable as a requests response hook"""
+        endpoint = endpoint_label(response.request.url)
+        sent = int(response.request.headers.get('Content-Length') or 0)
+        received = int(response.headers.get('Content-Length') or 0)
+        with self._lock:
+            self._add(self.requests, (endpoint, response.status_code))
+            self.latency.setdefault(endpoint, Histogram()).observe(
+                response.elapsed.total_seconds())
+            self._add(self.bytes_sent, endpoint, sent)
+            self._add(self.bytes_received, endpoint, received)
+
+    def add_bytes_sent(self, endpoint, size):
+        """Record request body bytes not known from Content-Length"""
+        with self._lock:
+            self._add(self.bytes_sent, endpoint, size)
+
+    def count_retry(self, endpoint):
+        with self._lock:
+            self._add(self.retries, endpoint)
+
+    def add_sleep(self, reason, seconds):
+        with self._lock:
+            self._add(self.sleep, reason, seconds)
+
+    def observe_operation(self, operation, seconds):
+        with self._lock:
+            self.operations.setdefault(operation, Histogram()).observe(seconds)
+
+    @contextmanager
+    def timer(self, operation):
+        """Time the block as operation"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe_operation(operation, time.time() - start)
+
+    def as_dict(self):
+        with self._lock:
+            endpoints = set(self.latency) | set(self.retries)
+            return {
+                'endpoints': dict(
+                    (endpoint, {
+                        'requests': dict(
+                            (str(status), count) for (e, status), count
+                            in self.requests.items() if e == endpoint),
+                        'latency_seconds': self.latency.get(
+                            endpoint, Histogram()).as_dict(),
+                        'bytes_sent': self.bytes_sent.get(endpoint, 0),
+                        'bytes_received': self.bytes_received.get(endpoint, 0),
+                        'retries': self.retries.get(endpoint, 0)})
+                    for endpoint in endpoints),
+                'sleep_seconds': dict(self.sleep),
+                'operations': dict((name, histogram.as_dict()) for
+                                   name, histogram in self.operations.items())}
+
+    def to_prometheus(self):
+        """Metrics in Prometheus text exposition format"""
+        lines = []
+
+        def metric(name, kind, help_text):
+            lines.append('# HELP {prefix}_{name} {help}'.format(
+                prefix=METRIC_PREFIX, name=name, help=help_text))
+            lines.append('# TYPE {prefix}_{name} {kind}'.format(
+                prefix=METRIC_PREFIX, name=name, kind=kind))
+
+        def sample(name, labels, value):
+            label_text = ','.join('{k}="{v}"'.format(k=k, v=v)
+                                  for k, v in labels)
+            lines.append('{prefix}_{name}{{{labels}}} {value}'.format(
+                prefix=METRIC_PREFIX, name=name, labels=label_text,
+                value=value))
+
+        def histogram(name, label, histograms):
+            for key, h in sorted(histograms.items()):
+                for bound, count in zip(h.buckets, h.counts):
+                    sample(name + '_bucket', [(label, key), ('le', bound)],
+                           count)
+                sample(name + '_bucket', [(label, key), ('le', '+Inf')],
+                       h.count)
+                sample(name + '_sum', [(label, key)], h.sum)
+                sample(name + '_count', [(label, key)], h.count)
+
+        with self._lock:
+            metric('requests_total', 'counter', 'HTTP requests by status')
+            for (endpoint, status), count in sorted(self.requests.items()):
+                sample('requests_total', [('endpoint', endpoint),
+                                          ('status', status)], count)
+            metric('request_duration_seconds', 'histogram',
+                   'HTTP request latency')
+            histogram('request_duration_seconds', 'endpoint', self.latency)
+            metric('request_bytes_sent_total', 'counter',
+                   'HTTP request body bytes')
+            for endpoint, size in sorted(self.bytes_sent.items()):
+                sample('request_bytes_sent_total', [('endpoint', endpoint)],
+                       size)
+            metric('request_bytes_received_total', 'counter',
+                   'HTTP response body bytes')
+            for endpoint, size in sorted(self.bytes_received.items()):
+                sample('request_bytes_received_total',
+                       [('endpoint', endpoint)], size)
+            metric('retries_total', 'counter', 'HTTP request retries')
+            for endpoint, count in sorted(self.retries.items()):
+                sample('retries_total', [('endpoint', endpoint)], count)
+            metric('sleep_seconds_total', 'counter',
+                   'Time spent waiting between retries and polls')
+            for reason, seconds in sorted(self.sleep.items()):
+                sample('sleep_seconds_total', [('reason', reason)], seconds)
+            metric('operation_duration_seconds', 'histogram',
+                   'Duration of local operations')
+            histogram('operation_duration_seconds', 'operation',
+                      self.operations)
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path, fmt='json'):
+        """Write metrics to file
+
+        :param path: Output file
+        :param fmt: 'json' or 'prometheus' (textfile collector format)
+        """
+        if fmt == 'prometheus':
+            text = self.to_prometheus()
+        else:
+            text = json.dumps(self.as_dict(), indent=2, sort_keys=True) + '\n'
+        with open(path, 'w') as f:
+            f.write(text)
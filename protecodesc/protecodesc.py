@@ -3,11 +3,24 @@
 
 from __future__ import absolute_import, division, print_function
 
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import heapq
+import json
 import logging
+import multiprocessing
+import random
+import threading
 import time
 import os.path
+from tempfile import TemporaryFile
+from zipfile import ZIP_DEFLATED, ZIP_STORED
 from protecodesc import exceptions
-from protecodesc.utils import TimeoutHTTPAdapter, file_sha1
+from protecodesc.metrics import Metrics, endpoint_label
+from protecodesc.retry import MAX_HTTP_RETRIES, RetryPolicy
+from protecodesc.utils import (JSONArrayStream, TimeoutHTTPAdapter,
+                               file_sha1, shard_archive_name,
+                               shard_directory, zip_directory_stream)
 
 import re
 import requests
@@ -16,8 +29,15 @@ import requests.adapters
 
 logger = logging.getLogger(__name__)
 
-MAX_HTTP_RETRIES = 3  # attempts
 HTTP_TIMEOUT = 60  # seconds
+HTTP_POOL_HOSTS = 4  # hosts with pooled connections
+HTTP_POOL_MAXSIZE = 10  # connections kept open per host
+HTTP_KEEPALIVE_IDLE = 60  # seconds
+APPS_PAGE_SIZE = 100  # apps per list request
+RESULT_CHUNK_SIZE = 2**16  # bytes per read of streamed results
+POLL_INITIAL_DELAY = 2  # seconds
+POLL_MAX_DELAY = 60  # seconds
+POLL_BACKOFF = 1.5  # delay multiplier
 
 # From Appcheck API documentation
 # https://appcheck.codenomicon.com/help/appcheck-api/
@@ -36,24 +56,68 @@ class ProtecodeSC(object):
     STATUS_BUSY = 'B'
     STATUS_READY = 'R'
 
-    def __init__(self, creds, host, insecure=False):
+    def __init__(self, creds, host, insecure=False, hash_cache=None,
+                 result_cache=None, component_cache=None, workers=1,
+                 pool_maxsize=None, pool_block=False,
+                 keepalive_idle=HTTP_KEEPALIVE_IDLE, metrics=None,
+                 retry_policy=None, progress=None):
         """
 
         :param creds: Tuple (username, password)
         :param host: URI to appliance ('https://appliance.example.com'
                      [optional]
+        :param hash_cache: HashCache for file checksums [optional]
+        :param result_cache: ResultCache for completed results [optional]
+        :param component_cache: ComponentCache for component information
+                                [optional]
+        :param workers: Number of threads using this client concurrently;
+                        the connection pool is sized to match
+        :param pool_maxsize: Connections kept open per host; default:
+                             workers, at least HTTP_POOL_MAXSIZE
+        :param pool_block: Wait for a free pooled connection instead of
+                           opening an extra one that is not kept
+        :param keepalive_idle: Seconds before TCP keep-alive probes on idle
+                               connections, or None to disable
+        :param metrics: Metrics collecting request timings [optional]
+        :param retry_policy: RetryPolicy, may be shared by many clients
+                             to share its retry budget and circuit breaker
+                             [optional]
+        :param progress: UploadProgress reporting bytes sent by uploads
+                         [optional]
         """
         super(ProtecodeSC, self).__init__()
         self.host = host
         self.creds = creds
+        self.hash_cache = hash_cache
+        self.result_cache = result_cache
+        self.component_cache = component_cache
+        self.progress = progress
         self.session = requests.Session()
         self.session.verify = not insecure
 
-        # Set timeout for session
-        adapter = TimeoutHTTPAdapter()
-        adapter.timeout = HTTP_TIMEOUT
-        self.session.mount('http://', adapter)
-        self.session.mount('https://', adapter)
+        # Set timeout and connection pool for session
+        if pool_maxsize is None:
+            pool_maxsize = max(HTTP_POOL_MAXSIZE, workers)
+        self.adapter = TimeoutHTTPAdapter(pool_connections=HTTP_POOL_HOSTS,
+                                          pool_maxsize=pool_maxsize,
+                                          pool_block=pool_block,
+                                          keepalive_idle=keepalive_idle)
+        self.adapter.timeout = HTTP_TIMEOUT
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.session.hooks['response'].append(self.metrics.observe_response)
+        self.retry_policy = (retry_policy if retry_policy is not None
+                             else RetryPolicy())
+
+    def connection_stats(self):
+        """Connection reuse statistics
+
+        Returns dict with keys connections (opened), requests (sent) and
+        reused (requests sent over an already open connection).
+        """
+        return self.adapter.connection_stats()
 
     def _uri(self, target, **params):
         """Resolve URI
@@ -64,93 +128,360 @@ class ProtecodeSC(object):
         params.setdefault('host', self.host)
         return route.format(**params)
 
-    @staticmethod
-    def _retry_request(func, f_args, f_kwargs,
-                       max_retries=MAX_HTTP_RETRIES):
-        """Upload with retry on failure
+    def _retry_request(self, func, f_args, f_kwargs, max_retries=None):
+        """Send request with retry on failure
 
         Calls func(*args, **kwargs) and returns its output.
 
-        If function returns an error we can retry, call function again,
-        up to max_retries times.
+        If the request fails to connect or times out, or the response
+        status is one retry_policy retries, call function again after a
+        delay, up to max_retries attempts in total.
         :param func: Function that sends HTTP request with requests
-        :param f_args: arguments for func
+        :param f_args: arguments for func; the first one is the URI
         :param f_kwargs: keyword arguments for func
-        :param max_retries: number of retries before exception
+        :param max_retries: number of attempts before exception; default:
+                            retry_policy.max_retries
         """
-        for attempt in range(max_retries):
+        policy = self.retry_policy
+        if max_retries is None:
+            max_retries = policy.max_retries
+        endpoint = endpoint_label(f_args[0] if f_args else None)
+        policy.budget.deposit()
+        attempt = 0
+        while True:
+            # Retries are part of the request let through by the breaker,
+            # unless other requests have opened it meanwhile
+            if attempt == 0:
+                allowed = policy.breaker.allow()
+            else:
+                allowed = not policy.breaker.is_open()
+            if not allowed:
+                raise exceptions.CircuitOpenError(
+                    "Server is failing, {reason}".format(
+                        reason=policy.breaker.describe()))
+            response = None
             try:
-                if attempt > 0:
-                    retry_delay = min(30, pow(2, attempt))
-                    time.sleep(retry_delay)
-                return func(*f_args, **f_kwargs)
+                response = func(*f_args, **f_kwargs)
             except (requests.exceptions.ConnectionError,
                     requests.exceptions.HTTPError,
                     requests.exceptions.Timeout) as e:
                 logger.warning(u"Connection failed: {exception}".format(exception=e))
-        else:  # No more retries
-            error = "Out of HTTP request retry attempts"
-            raise exceptions.OutOfRetriesError(error)
+            except BaseException:
+                policy.breaker.release()
+                raise
+            if response is not None and not policy.should_retry(
+                    response.status_code):
+                if policy.breaker.is_failure(response.status_code):
+                    policy.breaker.record_failure()
+                else:
+                    policy.breaker.record_success()
+                return response
+            if response is not None:
+                logger.warning(u"Server busy or failing: status {code}".format(
+                    code=response.status_code))
+                response.close()
+
+            attempt += 1
+            retry_delay = None
+            if attempt < max_retries:
+                retry_delay = policy.delay(attempt, response)
+            if retry_delay is None or not policy.budget.withdraw():
+                break
+            self.metrics.count_retry(endpoint)
+            self.metrics.add_sleep('retry', retry_delay)
+            time.sleep(retry_delay)
+
+        if response is None or policy.breaker.is_failure(
+                response.status_code):
+            policy.breaker.record_failure()
+        else:
+            policy.breaker.release()
+        error = "Out of HTTP request retry attempts"
+        if response is not None:
+            error = "{error} (status {code})".format(
+                error=error, code=response.status_code)
+        raise exceptions.OutOfRetriesError(error)
+
+    def _upload(self, display_name, group, body):
+        """Send upload request, return result data
+
+        :param display_name: Name of uploaded file
+        :param group: Group ID to upload to [optional]
+        :param body: Function returning request body; called again for
+                     every retry
+        """
+        display_name = re.sub("[^\w._-]", "_", display_name)
+        uri = self._uri('upload', filename=display_name)
+        headers = {}
+        if group:
+            headers['Group'] = str(group)
+
+        progress = self.progress
+        transfer = None
+        if progress is not None:
+            transfer = progress.start(display_name)
 
-    def upload_file(self, file_path, display_name=None, group=None, poll=False):
+        def _upload_body(uri):
+            """Upload body, implementation"""
+            data = body()
+            if progress is not None:
+                data = progress.wrap(transfer, data)
+            return self.session.put(uri, data=data, auth=self.creds,
+                                    headers=headers)
+
+        try:
+            r = self._retry_request(_upload_body, [uri], {})
+        finally:
+            if progress is not None:
+                progress.finish(transfer)
+        assert isinstance(r, requests.Response)
+        self._raise_for_status(r)
+        return r.json()
+
+    def upload_file(self, file_path, display_name=None, group=None, poll=False,
+                    dedupe=True):
         """Upload file to Appcheck
 
         :param file_path: File to upload
         :param display_name: Name of uploaded file [optional]
+        :param group: Group ID to upload to [optional]
+        :param poll: Wait until the scan is ready
+        :param dedupe: Return existing result instead of uploading a file
+                       that has been scanned before
+        :return: Result data as returned by get_result
         """
         if not display_name:
             display_name = os.path.basename(file_path)
-        display_name = re.sub("[^\w._-]", "_", display_name)
-        uri = self._uri('upload', filename=display_name)
-        headers = {}
-        if group:
-            headers['Group'] = group
 
-        def _upload_file():
-            """Upload file, implementation"""
-            with open(file_path, 'rb') as file_fd:
-                return self.session.put(uri, data=file_fd, auth=self.creds,
-                                        headers=headers)
+        if dedupe:
+            # Check if file already scanned by SHA1 - don't upload duplicates
+            try:
+                with self.metrics.timer('hash'):
+                    scanned_sha1 = file_sha1(file_path,
+                                             cache=self.hash_cache)
+                return self.get_result(id_or_sha1=scanned_sha1)
+            except exceptions.ResultNotFound:  # upload as new
+                pass
+
+        with open(file_path, 'rb') as file_fd:
+            def _rewind():
+                file_fd.seek(0)
+                return file_fd
+            data = self._upload(display_name, group, _rewind)
+        if poll:
+            data = self._poll_result(data)
+        return data
+
+    def upload_directory(self, dir_path, display_name=None, group=None,
+                         dedupe=True, reproducible=False, compresslevel=0,
+                         zip_workers=None):
+        """Upload directory to Appcheck as ZIP archive
+
+        The archive is hashed while it is built. With dedupe, it is spooled
+        to an anonymous temporary file so that an existing result can be
+        returned before uploading. Without dedupe, the archive is streamed
+        directly into the upload request and nothing is written to disk.
+
+        :param dir_path: Directory to upload
+        :param display_name: Name of uploaded archive [optional]
+        :param group: Group ID to upload to [optional]
+        :param dedupe: Return existing result instead of uploading an archive
+                       that has been scanned before
+        :param reproducible: Build a reproducible archive, so an unchanged
+                             directory matches its earlier result
+        :param compresslevel: Deflate level 1-9, or 0 to store files
+                              uncompressed
+        :param zip_workers: Number of compression threads; default: number
+                            of CPUs
+        :return: Result data as returned by get_result
+        """
+        if not display_name:
+            display_name = "{dirname}.zip".format(
+                dirname=os.path.basename(dir_path.rstrip(os.path.sep)))
+
+        def _zip_stream():
+            return zip_directory_stream(
+                dir_path, compression=ZIP_DEFLATED if compresslevel else
+                ZIP_STORED, reproducible=reproducible,
+                compresslevel=compresslevel or None, workers=zip_workers)
+
+        return self._upload_zip(display_name, group, dedupe, _zip_stream)
+
+    def _upload_zip(self, display_name, group, dedupe, zip_stream):
+        """Upload archive produced by zip_stream(), see upload_directory"""
+
+        def _counted_zip_stream():
+            # Streamed body has no Content-Length for the response hook
+            for chunk in zip_stream():
+                self.metrics.add_bytes_sent('upload', len(chunk))
+                yield chunk
+
+        if not dedupe:
+            return self._upload(display_name, group, _counted_zip_stream)
+
+        with TemporaryFile() as tmp_file:
+            digest = hashlib.sha1()
+            with self.metrics.timer('zip'):
+                for chunk in zip_stream():
+                    digest.update(chunk)
+                    tmp_file.write(chunk)
+            try:
+                return self.get_result(id_or_sha1=digest.hexdigest())
+            except exceptions.ResultNotFound:  # upload as new
+                pass
+
+            def _rewind():
+                tmp_file.seek(0)
+                return tmp_file
+            return self._upload(display_name, group, _rewind)
+
+    def upload_directory_shards(self, dir_path, max_size, display_name=None,
+                                group=None, dedupe=True, compresslevel=0,
+                                zip_workers=None, workers=4):
+        """Upload directory to Appcheck as ZIP archives of bounded size
+
+        The directory is split by shard_directory() and each shard is
+        uploaded as a reproducible archive named like
+        "name-001-of-012.zip". The split is stable, so with dedupe only
+        shards with changed files are uploaded again.
+
+        :param dir_path: Directory to upload
+        :param max_size: Maximum total size of files in a shard, in bytes
+        :param display_name: Name of uploaded archives without extension
+                             [optional]
+        :param group: Group ID to upload to [optional]
+        :param dedupe: Return existing result instead of uploading a shard
+                       that has been scanned before
+        :param compresslevel: Deflate level 1-9, or 0 to store files
+                              uncompressed
+        :param zip_workers: Number of compression threads per shard;
+                            default: number of CPUs divided by workers
+        :param workers: Number of shards uploaded in parallel
+        :return: List of result data as returned by get_result, one for
+                 each shard
+        """
+        if not display_name:
+            display_name = os.path.basename(dir_path.rstrip(os.path.sep))
+        with self.metrics.timer('shard'):
+            shards = shard_directory(dir_path, max_size)
+        # Shards zip in parallel, so share the CPUs between them instead of
+        # starting a full set of compression threads for each
+        workers = max(1, min(workers, len(shards)))
+        if zip_workers is None:
+            zip_workers = max(1, multiprocessing.cpu_count() // workers)
+
+        def _upload_shard(args):
+            index, files = args
+            name = shard_archive_name(display_name, index, len(shards))
+
+            def _zip_stream():
+                return zip_directory_stream(
+                    dir_path, compression=ZIP_DEFLATED if compresslevel else
+                    ZIP_STORED, reproducible=True,
+                    compresslevel=compresslevel or None, workers=zip_workers,
+                    files=files)
+            return self._upload_zip(name, group, dedupe, _zip_stream)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(_upload_shard,
+                                     enumerate(shards, start=1)))
+
+    def _poll_result(self, data):
+        """Poll result until it is no longer busy
+
+        :param data: Result data as returned by get_result
+        """
+        results = data.get('results', {})
+        if results.get('status', '') != ProtecodeSC.STATUS_BUSY:
+            return data
+        for _, data in self.poll_results([results.get('sha1sum')]):
+            return data
 
-        # Check if file already scanned by SHA1 - don't upload duplicates
-        try:
-            scanned_sha1 = file_sha1(file_path)
-            result = self.get_result(id_or_sha1=scanned_sha1)
-            return result
+    def poll_results(self, ids, timeout=None):
+        """Wait for scan results, yield them as soon as each is ready
 
-        except exceptions.ResultNotFound:  # upload as new
-            r = self._retry_request(_upload_file, [], {})
-            assert isinstance(r, requests.Response)
-            self._raise_for_status(r)
-            result = r.json().get('results', {})
-
-        while poll and result.get('status', '') == ProtecodeSC.STATUS_BUSY:
-            logger.debug("Polling..")
-            data = self.get_result(id_or_sha1=scanned_sha1)
-            result = data.get('results', {})
-            if result.get('status', '') == ProtecodeSC.STATUS_BUSY:
-                time.sleep(5)
-                continue
-            break
+        Yields tuples (id_or_sha1, data), where data is as returned by
+        get_result or None if the result was not found.
 
-        return result
+        :param ids: scan IDs or SHA1 checksums (hex strings)
+        :param timeout: Overall timeout in seconds [optional]
+        :raises PollTimeout: if results are not ready before timeout
+        """
+        poller = ResultPoller(self, timeout=timeout)
+        for id_or_sha1 in ids:
+            poller.add(id_or_sha1)
+        return poller.results()
 
-    def get_result(self, id_or_sha1):
+    def get_result(self, id_or_sha1, refresh=False):
         """Get scan result
 
+        Completed results are served from result_cache when available.
+
         :param id_or_sha1: scan ID or SHA1 checksum (hex string)
+        :param refresh: Bypass result_cache and fetch the result again
         """
+        if self.result_cache is not None and not refresh:
+            data = self.result_cache.get(id_or_sha1)
+            if data is not None:
+                return data
         uri = self._uri('result', id_or_sha1=id_or_sha1)
         r = self._retry_request(self.session.get, [uri], {'auth': self.creds})
         assert isinstance(r, requests.Response)
         self._raise_for_status(r)
-        return r.json()
+        data = r.json()
+        if self.result_cache is not None:
+            if data.get('results', {}).get('status') == ProtecodeSC.STATUS_READY:
+                self.result_cache.put(data)
+            else:
+                self.result_cache.invalidate(id_or_sha1)
+        return data
+
+    def stream_result(self, id_or_sha1, raw_file=None, refresh=False,
+                      cache=True):
+        """Get scan result without loading it into memory at once
+
+        Returns a ResultStream yielding the components of the result.
+        After iterating it, its `document` attribute holds the rest of the
+        result data. A completed result in result_cache is used if
+        available, and a completed result fetched from the server is added
+        to the cache once iterated.
+
+        :param id_or_sha1: scan ID or SHA1 checksum (hex string)
+        :param raw_file: File object to copy the raw JSON to [optional]
+        :param refresh: Bypass result_cache and fetch the result again
+        :param cache: Use result_cache; disable when streaming many
+                      results that are not looked at again
+        """
+        data = None
+        result_cache = self.result_cache if cache else None
+        if result_cache is not None and not refresh:
+            data = result_cache.get(id_or_sha1)
+        if data is not None:
+            chunks = [json.dumps(data).encode('utf-8')]
+            result_cache = None  # cached already
+        else:
+            uri = self._uri('result', id_or_sha1=id_or_sha1)
+            r = self._retry_request(self.session.get, [uri],
+                                    {'auth': self.creds, 'stream': True})
+            self._raise_for_status(r)
+            chunks = r.iter_content(RESULT_CHUNK_SIZE)
+        if raw_file is not None:
+            chunks = self._tee(chunks, raw_file)
+        return ResultStream(chunks, result_cache=result_cache)
+
+    @staticmethod
+    def _tee(chunks, raw_file):
+        for chunk in chunks:
+            raw_file.write(chunk)
+            yield chunk
 
     def rescan(self, id_or_sha1):
         """Request a rescan for result
 
         :param id_or_sha1: scan ID or SHA1 checksum (hex string)
         """
+        if self.result_cache is not None:
+            self.result_cache.invalidate(id_or_sha1)
         uri = self._uri('rescan', id_or_sha1=id_or_sha1)
         r = self._retry_request(self.session.post, [uri], {'auth': self.creds})
         assert isinstance(r, requests.Response)
@@ -162,11 +493,51 @@ class ProtecodeSC(object):
 
         :param id_or_sha1: scan ID or SHA1 checksum (hex string)
         """
+        if self.result_cache is not None:
+            self.result_cache.invalidate(id_or_sha1)
         uri = self._uri('result', id_or_sha1=id_or_sha1)
         r = self._retry_request(self.session.delete, [uri], {'auth': self.creds})
         self._raise_for_status(r)
         return r.json()
 
+    def list_apps(self, group=None, page_size=APPS_PAGE_SIZE):
+        """List apps, optionally only those in group
+
+        Apps are fetched one page at a time and yielded as they arrive, so
+        memory use does not grow with the number of apps.
+
+        :param group: Group ID [optional]
+        :param page_size: Apps per request
+        """
+        if group:
+            uri = self._uri('apps-group', group=group)
+        else:
+            uri = self._uri('apps')
+        params = {'page': 1, 'per_page': page_size}
+        previous_first = None
+        while uri:
+            r = self._retry_request(self.session.get, [uri],
+                                    {'auth': self.creds, 'params': params})
+            self._raise_for_status(r)
+            data = r.json()
+            products = data.get('products', [])
+            if not products:
+                break
+            first = products[0].get('id')
+            if first is not None and first == previous_first:
+                break  # server does not paginate; page was seen already
+            previous_first = first
+            for product in products:
+                yield product
+
+            if data.get('next'):
+                # Next page link includes its own query parameters
+                uri, params = data['next'], None
+            elif len(products) >= page_size and params is not None:
+                params = dict(params, page=params['page'] + 1)
+            else:
+                break
+
     def list_groups(self):
         """List groups"""
         uri = self._uri('groups')
@@ -176,26 +547,269 @@ class ProtecodeSC(object):
 
     def component(self, component, version=None):
         """Get component information
+
+        Served from component_cache when available.
+
         :param component: component
         :param version: version
         """
+        if self.component_cache is not None:
+            data = self.component_cache.get(component, version)
+            if data is not None:
+                return data
         uri = self._uri('components', component=component)
         if version:
             uri = "{base}?version={version}".format(base=uri, version=version)
         r = self._retry_request(self.session.get, [uri], {'auth': self.creds})
         self._raise_for_status(r)
-        return r.json()
+        data = r.json()
+        if self.component_cache is not None:
+            self.component_cache.put(component, version, data)
+        return data
+
+    def components(self, pairs, workers=8):
+        """Get information for many components concurrently
+
+        Duplicate (component, version) pairs are looked up only once.
+        Yields tuples ((component, version), data) in order of first
+        appearance, where data is None if the component was not found.
+
+        :param pairs: Iterable of (component, version) tuples
+        :param workers: Number of concurrent requests
+        """
+        def _lookup(pair):
+            try:
+                return self.component(*pair)
+            except exceptions.ResultNotFound:
+                return None
+
+        unique = []
+        seen = set()
+        for pair in pairs:
+            pair = (pair[0], pair[1] or None)
+            if pair not in seen:
+                seen.add(pair)
+                unique.append(pair)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for pair, data in zip(unique, executor.map(_lookup, unique)):
+                yield pair, data
 
     @staticmethod
     def _raise_for_status(response):
         """Check status code and raise error if not success
         :param response: Requests response object
         """
-        if response.status_code == 200:
+        ProtecodeSC._check_status(response.status_code)
+
+    @staticmethod
+    def _check_status(status_code):
+        """Raise error for HTTP status code if not success"""
+        if status_code == 200:
             pass
-        elif response.status_code in [401, 403]:
+        elif status_code in [401, 403]:
             raise exceptions.InvalidLoginError("Access forbidden")
-        elif response.status_code == 404:
+        elif status_code == 404:
             raise exceptions.ResultNotFound("Object was not found")
         else:
-            raise exceptions.AppcheckException("Unhandled status code {code}".format(code=response.status_code))
+            raise exceptions.AppcheckException("Unhandled status code {code}".format(code=status_code))
+
+
+class ResultStream(JSONArrayStream):
+    """Components of a result, parsed as the response arrives
+
+    Errors reading or parsing the response are raised as
+    ConnectionFailure and AppcheckException. If a result_cache is given,
+    the response is also kept as received up to the cache's
+    max_entry_size, and a ready result is stored in the cache after
+    iteration.
+    """
+
+    def __init__(self, chunks, result_cache=None):
+        self.result_cache = result_cache
+        self._raw = None
+        if result_cache is not None:
+            self._raw = []
+            chunks = self._keep_raw(chunks, result_cache.max_entry_size)
+        super(ResultStream, self).__init__(chunks, ('results', 'components'))
+
+    def _keep_raw(self, chunks, max_size):
+        size = 0
+        for chunk in chunks:
+            if self._raw is not None:
+                size += len(chunk)
+                if size > max_size:
+                    self._raw = None  # too large to cache
+                else:
+                    self._raw.append(chunk)
+            yield chunk
+
+    def __iter__(self):
+        elements = super(ResultStream, self).__iter__()
+        while True:
+            try:
+                component = next(elements)
+            except StopIteration:
+                break
+            except requests.exceptions.RequestException as e:
+                raise exceptions.ConnectionFailure(
+                    "Reading result failed: {error}".format(error=e))
+            except ValueError as e:
+                raise exceptions.AppcheckException(
+                    "Invalid result: {error}".format(error=e))
+            yield component
+        if self._raw is None:
+            return
+        results = self.document.get('results', {})
+        if results.get('status') == ProtecodeSC.STATUS_READY:
+            text = b''.join(self._raw).decode('utf-8')
+            self._raw = None
+            self.result_cache.put(self.document, text=text)
+
+
+class ResultPoller(object):
+    """Poll many scan results together
+
+    Every outstanding result has its own schedule: it is first checked
+    immediately, then with a delay that grows by `backoff` up to
+    `max_delay`, randomized to avoid polling in lockstep. Results are
+    yielded in the order they become ready. Results may be added from
+    other threads while iterating.
+    """
+
+    def __init__(self, appcheck, timeout=None,
+                 initial_delay=POLL_INITIAL_DELAY, max_delay=POLL_MAX_DELAY,
+                 backoff=POLL_BACKOFF):
+        """
+
+        :param appcheck: ProtecodeSC instance
+        :param timeout: Overall timeout in seconds [optional]
+        """
+        self.appcheck = appcheck
+        self.timeout = timeout
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.backoff = backoff
+        self._queue = []  # heap of (due time, sequence, id_or_sha1, delay)
+        self._sequence = 0
+        self._deadline = None
+        self._condition = threading.Condition()
+        self._closed = False
+
+    def __len__(self):
+        return len(self._queue)
+
+    def add(self, id_or_sha1, delay=0):
+        """Start polling result
+
+        :param id_or_sha1: scan ID or SHA1 checksum (hex string)
+        :param delay: Seconds until first check
+        """
+        with self._condition:
+            self._schedule(id_or_sha1, delay, self.initial_delay)
+            self._condition.notify()
+
+    def discard(self, ids):
+        """Stop polling results, e.g. after their waiters gave up
+
+        :param ids: scan IDs or SHA1 checksums (hex strings)
+        """
+        ids = set(ids)
+        with self._condition:
+            self._queue = [entry for entry in self._queue
+                           if entry[2] not in ids]
+            heapq.heapify(self._queue)
+
+    def close(self):
+        """Stop polling; results() returns as soon as possible"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def _schedule(self, id_or_sha1, wait, delay):
+        due = time.time() + wait
+        if self._deadline is not None:
+            # Last check of a busy result happens at the deadline
+            due = min(due, self._deadline)
+        self._sequence += 1
+        heapq.heappush(self._queue, (due, self._sequence, id_or_sha1, delay))
+
+    def _next_delay(self, delay):
+        """Jittered delay before next check, and growth for the one after"""
+        wait = delay / 2 + random.uniform(0, delay / 2)
+        return wait, min(self.max_delay, delay * self.backoff)
+
+    def pending(self):
+        """IDs or SHA1s of results not yet ready"""
+        with self._condition:
+            return [entry[2] for entry in sorted(self._queue)]
+
+    def _next_due(self, follow):
+        """Wait until a result is due for checking and remove it
+
+        Returns (id_or_sha1, delay), or None when there is nothing left
+        to poll.
+        """
+        with self._condition:
+            while not self._closed:
+                if not self._queue:
+                    if not follow:
+                        return None
+                    self._condition.wait()
+                    continue
+                due, _, id_or_sha1, delay = self._queue[0]
+                now = time.time()
+                if due > now:
+                    # May be woken early by add() or close()
+                    self._condition.wait(due - now)
+                    self.appcheck.metrics.add_sleep('poll', time.time() - now)
+                    continue
+                heapq.heappop(self._queue)
+                return id_or_sha1, delay
+            return None
+
+    def results(self, follow=False):
+        """Yield (id_or_sha1, data) as results become ready
+
+        data is None if the result was not found.
+
+        :param follow: Keep waiting for results added later, until close()
+                       is called. Connection failures are logged and the
+                       result is checked again later instead of raising.
+        :raises PollTimeout: if results are not ready before timeout
+        """
+        if self.timeout is not None:
+            with self._condition:
+                self._deadline = time.time() + self.timeout
+                self._queue = [(min(entry[0], self._deadline),) + entry[1:]
+                               for entry in self._queue]
+                heapq.heapify(self._queue)
+        while True:
+            due = self._next_due(follow)
+            if due is None:
+                return
+            id_or_sha1, delay = due
+            try:
+                data = self.appcheck.get_result(id_or_sha1=id_or_sha1)
+            except exceptions.ResultNotFound:
+                yield id_or_sha1, None
+                continue
+            except exceptions.ConnectionFailure as e:
+                if not follow:
+                    raise
+                logger.warning("Polling {id_or_sha1} failed: {error}".format(
+                    id_or_sha1=id_or_sha1, error=e))
+                status = ProtecodeSC.STATUS_BUSY  # check again later
+            else:
+                status = data.get('results', {}).get('status', '')
+            if status == ProtecodeSC.STATUS_BUSY:
+                logger.debug("Polling {id_or_sha1}..".format(
+                    id_or_sha1=id_or_sha1))
+                wait, delay = self._next_delay(delay)
+                with self._condition:
+                    self._schedule(id_or_sha1, wait, delay)
+                if self._deadline is not None and time.time() >= self._deadline:
+                    raise exceptions.PollTimeout(
+                        "Results not ready: {ids}".format(
+                            ids=", ".join(str(i) for i in self.pending())))
+                continue
+            yield id_or_sha1, data
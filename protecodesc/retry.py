@@ -0,0 +1,259 @@
+# Copyright (c) 2015 Codenomicon Ltd.
+# License: MIT
+
+from __future__ import absolute_import, division, print_function
+
+from email.utils import mktime_tz, parsedate_tz
+import random
+import threading
+import time
+
+MAX_HTTP_RETRIES = 3  # attempts
+RETRY_BACKOFF_BASE = 1  # seconds
+RETRY_MAX_DELAY = 30  # seconds
+RETRY_AFTER_MAX = 300  # seconds; longer Retry-After gives up instead
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+RETRY_BUDGET_RATIO = 0.2  # retries earned per request
+RETRY_BUDGET_MIN = 10  # retries always available
+BREAKER_FAILURE_THRESHOLD = 5  # consecutive failures
+BREAKER_RESET_TIMEOUT = 30  # seconds
+RATE_LIMIT_BURST = 1  # requests sent at once after being idle
+
+
+def parse_retry_after(value, now=None):
+    """Seconds to wait from Retry-After header value, or None
+
+    :param value: Delay in seconds or HTTP date
+    :param now: Current time for HTTP dates [optional]
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+    if now is None:
+        now = time.time()
+    return max(0, mktime_tz(parsed) - now)
+
+
+class RetryBudget(object):
+    """Retries shared by all requests of a client
+
+    Every request earns `ratio` retries, and retrying spends one. When
+    many concurrent requests fail, the budget runs out and they fail fast
+    instead of multiplying the load on a struggling server.
+    """
+
+    def __init__(self, ratio=RETRY_BUDGET_RATIO, min_retries=RETRY_BUDGET_MIN):
+        """
+
+        :param ratio: Retries earned per request
+        :param min_retries: Retries available before any are earned, and
+                            the most that are kept unused
+        """
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self._lock = threading.Lock()
+        self._tokens = float(min_retries)
+        self._max_tokens = float(max(min_retries, 1))
+
+    def deposit(self):
+        with self._lock:
+            self._tokens = min(self._max_tokens, self._tokens + self.ratio)
+
+    def withdraw(self):
+        """Spend a retry, return False if none are left"""
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class CircuitBreaker(object):
+    """Stop sending requests to a server that keeps failing
+
+    After `failure_threshold` consecutive failed requests the circuit
+    opens and requests are refused for `reset_timeout` seconds. Then a
+    single trial request is let through: success closes the circuit,
+    failure opens it again. A request counts once however many times it
+    was retried.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=BREAKER_FAILURE_THRESHOLD,
+                 reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CircuitBreaker.CLOSED
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial = False
+
+    def allow(self):
+        """Return True if a request may be sent now"""
+        with self._lock:
+            if self.state == CircuitBreaker.CLOSED:
+                return True
+            if self.state == CircuitBreaker.OPEN:
+                if time.time() - self._opened_at < self.reset_timeout:
+                    return False
+                self.state = CircuitBreaker.HALF_OPEN
+                self._trial = False
+            if self._trial:
+                return False  # trial request still in flight
+            self._trial = True
+            return True
+
+    @staticmethod
+    def is_failure(status_code):
+        """Return True if response status means the server is failing"""
+        return status_code == 429 or status_code >= 500
+
+    def describe(self):
+        """Why requests are refused, for error messages"""
+        if self.state == CircuitBreaker.HALF_OPEN:
+            return "waiting for a trial request to succeed"
+        return "not sending requests for {seconds:.0f} seconds".format(
+            seconds=self.retry_in())
+
+    def is_open(self):
+        """Return True if requests are being refused"""
+        with self._lock:
+            return self.state == CircuitBreaker.OPEN
+
+    def retry_in(self):
+        """Seconds until the circuit lets a trial request through"""
+        with self._lock:
+            if self.state != CircuitBreaker.OPEN:
+                return 0
+            return max(0, self._opened_at + self.reset_timeout - time.time())
+
+    def record_success(self):
+        with self._lock:
+            self.state = CircuitBreaker.CLOSED
+            self._failures = 0
+            self._trial = False
+
+    def release(self):
+        """Forget a request that failed before reaching the server
+
+        Local errors, e.g. an unreadable upload body, say nothing about
+        the server, but a trial request must still free its slot.
+        """
+        with self._lock:
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if (self.state == CircuitBreaker.HALF_OPEN or
+                    self._failures >= self.failure_threshold):
+                self.state = CircuitBreaker.OPEN
+                self._opened_at = time.time()
+                self._trial = False
+
+
+class RateLimiter(object):
+    """Limit how often requests are started, shared by many threads
+
+    Requests are spaced 1/rate seconds apart. After being idle, up to
+    `burst` requests may start at once.
+    """
+
+    def __init__(self, rate, burst=RATE_LIMIT_BURST):
+        """
+
+        :param rate: Requests per second
+        :param burst: Requests allowed to start together
+        """
+        self.interval = 1.0 / rate
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._next = 0  # theoretical start time of the next request
+
+    def acquire(self):
+        """Wait until a request may start, return seconds waited"""
+        with self._lock:
+            now = time.time()
+            start = max(self._next, now)
+            self._next = start + self.interval
+            wait = start - (self.burst - 1) * self.interval - now
+        if wait <= 0:
+            return 0
+        time.sleep(wait)
+        return wait
+
+
+class RetryPolicy(object):
+    """When and how long to wait before retrying a HTTP request
+
+    Failed requests are retried with exponential backoff, randomized so
+    that clients do not retry in lockstep. Responses with a status in
+    `retry_statuses` are retried too, waiting as long as their
+    Retry-After header asks. Retries are limited by a RetryBudget and a
+    CircuitBreaker shared by all requests using the policy. The default
+    budget always has enough retries for one request to use all of
+    max_retries.
+    """
+
+    def __init__(self, max_retries=MAX_HTTP_RETRIES,
+                 backoff_base=RETRY_BACKOFF_BASE, max_delay=RETRY_MAX_DELAY,
+                 retry_after_max=RETRY_AFTER_MAX, retry_statuses=RETRY_STATUSES,
+                 budget=None, breaker=None):
+        """
+
+        :param max_retries: Attempts per request, including the first
+        :param backoff_base: Delay before the first retry in seconds;
+                             doubled for each further retry
+        :param max_delay: Longest backoff delay in seconds
+        :param retry_after_max: Longest Retry-After delay to wait for;
+                                longer ones fail the request
+        :param retry_statuses: HTTP status codes to retry
+        :param budget: RetryBudget [optional]
+        :param breaker: CircuitBreaker [optional]
+        """
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.max_delay = max_delay
+        self.retry_after_max = retry_after_max
+        self.retry_statuses = frozenset(retry_statuses)
+        if budget is None:
+            budget = RetryBudget(
+                min_retries=max(RETRY_BUDGET_MIN, max_retries - 1))
+        self.budget = budget
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+
+    def backoff(self, attempt):
+        """Jittered delay before retry number attempt (1 for first retry)"""
+        delay = min(self.max_delay, self.backoff_base * pow(2, attempt - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def should_retry(self, status_code):
+        """Return True if response status is worth retrying"""
+        return status_code in self.retry_statuses
+
+    def delay(self, attempt, response=None):
+        """Seconds to wait before retry, or None to give up
+
+        :param attempt: Retry number, 1 for the first retry
+        :param response: Failed response, None after a connection error;
+                         only its headers are used
+        """
+        backoff = self.backoff(attempt)
+        if response is None:
+            return backoff
+        retry_after = parse_retry_after(response.headers.get('Retry-After'))
+        if retry_after is None:
+            return backoff
+        if retry_after > self.retry_after_max:
+            return None
+        # Spread clients told to come back at the same moment
+        return retry_after + random.uniform(0, self.backoff_base)
@@ -0,0 +1,179 @@
+# Copyright (c) 2015 Codenomicon Ltd.
+# License: MIT
+
+from __future__ import absolute_import, division, print_function
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import logging
+
+from protecodesc import exceptions
+from protecodesc.protecodesc import ProtecodeSC
+from protecodesc.store import summarize_result
+
+logger = logging.getLogger(__name__)
+
+
+def summarize_app(appcheck, app):
+    """Fetch result of app and reduce it to what a rollup needs
+
+    Returns dict with keys id, name, status and components, a list of
+    (lib, version, license, number of vulnerabilities) tuples.
+
+    :param appcheck: ProtecodeSC instance
+    :param app: App as yielded by ProtecodeSC.list_apps
+    """
+    summary = summarize_result(appcheck, app)
+    return {'id': app.get('id'),
+            'name': app.get('name'),
+            'status': summary['status'],
+            'components': [(lib, version, license, len(vulns))
+                           for lib, version, license, vulns
+                           in summary['components']]}
+
+
+class GroupRollup(object):
+    """Vulnerability and license rollup over many apps"""
+
+    def __init__(self):
+        self.apps = 0
+        self.ready = 0
+        self.failed = []
+        self.vulnerable_apps = 0
+        self.vulnerable_components = 0
+        self.components = {}  # (lib, version) -> counts
+        self.licenses = {}  # name -> number of components
+
+    def add(self, summary):
+        """Add app summary from summarize_app"""
+        self.apps += 1
+        if summary['status'] != ProtecodeSC.STATUS_READY:
+            return
+        self.ready += 1
+        app_vulnerable = False
+        for lib, version, license, vulns in summary['components']:
+            counts = self.components.setdefault(
+                (lib, version), {'apps': 0, 'vulnerable_apps': 0, 'vulns': 0})
+            counts['apps'] += 1
+            if vulns:
+                counts['vulnerable_apps'] += 1
+                counts['vulns'] += vulns
+                self.vulnerable_components += 1
+                app_vulnerable = True
+            self.licenses[license] = self.licenses.get(license, 0) + 1
+        if app_vulnerable:
+            self.vulnerable_apps += 1
+
+    def add_failure(self, app, error):
+        self.apps += 1
+        self.failed.append({'id': app.get('id'), 'name': app.get('name'),
+                            'error': str(error)})
+
+    def component_rows(self):
+        """Component rows, most widely vulnerable first"""
+        rows = [dict(lib=lib, version=version, **counts)
+                for (lib, version), counts in self.components.items()]
+        rows.sort(key=lambda r: (-r['vulnerable_apps'], -r['apps'],
+                                 r['lib'] or '', r['version'] or ''))
+        return rows
+
+    def report(self):
+        """Rollup as JSON-serializable dict"""
+        return {'apps': self.apps,
+                'ready': self.ready,
+                'vulnerable_apps': self.vulnerable_apps,
+                'vulnerable_components': self.vulnerable_components,
+                'failed': self.failed,
+                'licenses': self.licenses,
+                'components': self.component_rows()}
+
+
+def rollup_group(appcheck, group, workers=8):
+    """Fetch all results in group concurrently and aggregate them
+
+    At most a few results per worker are in flight at any time, so memory
+    use does not grow with the size of the group.
+
+    :param appcheck: ProtecodeSC instance
+    :param group: Group ID
+    :param workers: Number of concurrent result requests
+    """
+    rollup = GroupRollup()
+    apps = iter(appcheck.list_apps(group=group))
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            for app in apps:
+                pending.append((app, executor.submit(summarize_app,
+                                                     appcheck, app)))
+                if len(pending) >= 4 * workers:
+                    break
+            if not pending:
+                break
+            app, future = pending.popleft()
+            try:
+                rollup.add(future.result())
+            except exceptions.InvalidLoginError:
+                raise
+            except exceptions.AppcheckException as e:
+                logger.info(u"Result of app {id} failed: {exception}"
+                            .format(id=app.get('id'), exception=e))
+                rollup.add_failure(app, e)
+    return rollup
+
+
+# Most severe first
+VERDICT_ORDER = ('Vulns', 'Verify', 'Pass')
+
+
+def merge_results(name, results):
+    """Combine results of archive shards into one result
+
+    Returns result data shaped like get_result output: components of all
+    shards, once per (lib, version), the most severe verdict, and status
+    busy until every shard is ready. The shards are listed under
+    results.shards.
+
+    :param name: File name of combined result
+    :param results: Result data of shards as returned by get_result
+    """
+    components = {}
+    shards = []
+    status = ProtecodeSC.STATUS_READY
+    verdict = None
+    vulnerable_shards = 0
+    for data in results:
+        res = data.get('results', {})
+        shard_verdict = res.get('summary', {}).get('verdict', {}).get('short')
+        shards.append({'filename': res.get('filename'),
+                       'sha1sum': res.get('sha1sum'),
+                       'report_url': res.get('report_url'),
+                       'status': res.get('status'),
+                       'verdict': shard_verdict})
+        if res.get('status') != ProtecodeSC.STATUS_READY:
+            status = ProtecodeSC.STATUS_BUSY
+        if shard_verdict == 'Vulns':
+            vulnerable_shards += 1
+        if shard_verdict in VERDICT_ORDER and (
+                verdict is None or VERDICT_ORDER.index(shard_verdict) <
+                VERDICT_ORDER.index(verdict)):
+            verdict = shard_verdict
+        for c in res.get('components', []):
+            key = (c.get('lib'), c.get('version'))
+            # Keep the entry listing most vulnerabilities
+            if key not in components or len(c.get('vulns') or []) > \
+                    len(components[key].get('vulns') or []):
+                components[key] = c
+    detailed = "{vulnerable} of {total} shards contain known " \
+               "vulnerabilities".format(vulnerable=vulnerable_shards,
+                                        total=len(shards))
+    return {'results': {'filename': name,
+                        'sha1sum': None,
+                        'report_url': None,
+                        'status': status,
+                        'components': [components[key] for key
+                                       in sorted(components, key=lambda k: (
+                                           k[0] or '', k[1] or ''))],
+                        'summary': {'verdict': {'short': verdict or '??',
+                                                'detailed': detailed}},
+                        'shards': shards}}
@@ -0,0 +1,233 @@
+# Copyright (c) 2015 Codenomicon Ltd.
+# License: MIT
+
+from __future__ import absolute_import, division, print_function
+
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+import os.path
+import shutil
+import tempfile
+import time
+from zipfile import ZIP_DEFLATED, ZIP_STORED
+
+from protecodesc import exceptions
+from protecodesc.cache import _SQLiteCache
+from protecodesc.config import USER_CACHE_DIR
+
+logger = logging.getLogger(__name__)
+
+SPOOL_DIR = os.path.join(USER_CACHE_DIR, 'spool')
+SPOOL_CLAIM_TIMEOUT = 60 * 60  # seconds before an unfinished flush is retried
+
+
+class UploadSpool(_SQLiteCache):
+    """Durable queue of uploads to send once the service is reachable
+
+    An entry records the path, display name and group of an upload. By
+    default a copy of the artifact is kept in the spool, so it can be
+    uploaded after the original is gone, e.g. when a build workspace is
+    cleaned. Directories are copied as ZIP archives. A directory queued by
+    path is zipped at flush with the archive options it was queued with,
+    so the archive matches what the failed upload would have sent.
+
+    Entries being uploaded are claimed, so several flushes may run at
+    once without uploading the same entry twice.
+    """
+
+    SCHEMA = ('CREATE TABLE IF NOT EXISTS spool ('
+              'id INTEGER PRIMARY KEY AUTOINCREMENT, path TEXT, copy TEXT, '
+              'display_name TEXT, group_id TEXT, reproducible INTEGER, '
+              'compresslevel INTEGER, queued REAL, '
+              'attempts INTEGER DEFAULT 0, last_error TEXT, claimed REAL)',)
+
+    def __init__(self, path=None, spool_dir=SPOOL_DIR):
+        """
+
+        :param path: Queue database; default: queue.sqlite in spool_dir
+        :param spool_dir: Directory for copies of artifacts
+        """
+        super(UploadSpool, self).__init__(
+            path or os.path.join(spool_dir, 'queue.sqlite'))
+        self.spool_dir = spool_dir
+
+    def add(self, path, display_name=None, group=None, copy=True,
+            reproducible=True, compresslevel=0, files=None):
+        """Queue file or directory for upload, return entry ID
+
+        :param path: File or directory to upload
+        :param display_name: Name of uploaded file [optional]
+        :param group: Group ID to upload to [optional]
+        :param copy: Keep a copy of the artifact in the spool
+        :param reproducible: Zip directory reproducibly
+        :param compresslevel: Deflate level 1-9 for directory, or 0 to
+                              store files uncompressed
+        :param files: Copy only these files below directory, e.g. a shard
+                      from shard_directory(); requires copy [optional]
+        """
+        if files is not None and not copy:
+            raise ValueError("Only copied directories can be split")
+        path = os.path.abspath(path)
+        if not display_name:
+            if os.path.isdir(path):
+                display_name = "{dirname}.zip".format(
+                    dirname=os.path.basename(path.rstrip(os.path.sep)))
+            else:
+                display_name = os.path.basename(path)
+        copy_path = None
+        if copy:
+            copy_path = self._copy(path, reproducible, compresslevel, files)
+        try:
+            with self._lock:
+                db = self._connect()
+                with db:
+                    cursor = db.execute(
+                        'INSERT INTO spool (path, copy, display_name, '
+                        'group_id, reproducible, compresslevel, queued) '
+                        'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                        (path, copy_path, display_name,
+                         None if group is None else str(group),
+                         int(reproducible), compresslevel, time.time()))
+                return cursor.lastrowid
+        except Exception:
+            if copy_path is not None:
+                os.unlink(copy_path)
+            raise
+
+    def _copy(self, path, reproducible, compresslevel, files=None):
+        """Copy artifact into the spool directory, return path of copy"""
+        from protecodesc.utils import zip_directory_stream
+        if not os.path.isdir(self.spool_dir):
+            os.makedirs(self.spool_dir)
+        fd, tmp_path = tempfile.mkstemp(dir=self.spool_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file:
+                if os.path.isdir(path):
+                    for chunk in zip_directory_stream(
+                            path, compression=ZIP_DEFLATED if compresslevel
+                            else ZIP_STORED, reproducible=reproducible,
+                            compresslevel=compresslevel or None,
+                            files=files):
+                        tmp_file.write(chunk)
+                else:
+                    with open(path, 'rb') as src:
+                        shutil.copyfileobj(src, tmp_file)
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+            # Only complete copies get their final name
+            copy_path = tmp_path[:-len('.tmp')]
+            os.rename(tmp_path, copy_path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+        return copy_path
+
+    def entries(self):
+        """Queued uploads as dicts, oldest first"""
+        keys = ('id', 'path', 'copy', 'display_name', 'group',
+                'reproducible', 'compresslevel', 'queued', 'attempts',
+                'last_error')
+        with self._lock:
+            db = self._connect()
+            rows = db.execute('SELECT id, path, copy, display_name, '
+                              'group_id, reproducible, compresslevel, '
+                              'queued, attempts, last_error '
+                              'FROM spool ORDER BY id').fetchall()
+        return [dict(zip(keys, row)) for row in rows]
+
+    def __len__(self):
+        with self._lock:
+            db = self._connect()
+            return db.execute('SELECT COUNT(*) FROM spool').fetchone()[0]
+
+    def claim(self, entry_id):
+        """Reserve entry for uploading, return False if another has it"""
+        now = time.time()
+        with self._lock:
+            db = self._connect()
+            with db:
+                cursor = db.execute(
+                    'UPDATE spool SET claimed = ? WHERE id = ? AND '
+                    '(claimed IS NULL OR claimed < ?)',
+                    (now, entry_id, now - SPOOL_CLAIM_TIMEOUT))
+            return cursor.rowcount == 1
+
+    def release(self, entry_id, error):
+        """Return claimed entry to the queue after a failed upload"""
+        with self._lock:
+            db = self._connect()
+            with db:
+                db.execute('UPDATE spool SET claimed = NULL, '
+                           'attempts = attempts + 1, last_error = ? '
+                           'WHERE id = ?', (str(error), entry_id))
+
+    def remove(self, entry):
+        """Remove uploaded entry and its copy"""
+        with self._lock:
+            db = self._connect()
+            with db:
+                db.execute('DELETE FROM spool WHERE id = ?', (entry['id'],))
+        if entry['copy']:
+            try:
+                os.unlink(entry['copy'])
+            except OSError as e:
+                logger.warning(u"Removing spooled copy failed: {exception}"
+                               .format(exception=e))
+
+    def flush(self, appcheck, workers=4):
+        """Upload queued entries with dedupe
+
+        Yields tuples (entry, data, error) in queue order, where data is
+        as returned by upload_file and error is the exception if the
+        upload failed. Uploaded entries are removed, entries whose
+        artifact no longer exists are dropped, and other failed entries
+        stay queued for the next flush.
+
+        :param appcheck: ProtecodeSC instance
+        :param workers: Number of parallel uploads
+        """
+        def _upload(entry):
+            path = entry['copy'] or entry['path']
+            group = entry['group']
+            if os.path.isdir(path):
+                return appcheck.upload_directory(
+                    path, display_name=entry['display_name'], group=group,
+                    dedupe=True, reproducible=bool(entry['reproducible']),
+                    compresslevel=entry['compresslevel'] or 0)
+            return appcheck.upload_file(
+                path, display_name=entry['display_name'], group=group,
+                dedupe=True)
+
+        def _flush(entry):
+            if not self.claim(entry['id']):
+                return None, None  # taken by another flush
+            try:
+                data = _upload(entry)
+            except exceptions.InvalidLoginError as e:
+                self.release(entry['id'], e)
+                raise
+            except exceptions.AppcheckException as e:
+                self.release(entry['id'], e)
+                return None, e
+            except (IOError, OSError) as e:
+                if os.path.exists(entry['copy'] or entry['path']):
+                    self.release(entry['id'], e)
+                else:
+                    self.remove(entry)  # can never be uploaded
+                return None, e
+            self.remove(entry)
+            return data, None
+
+        entries = self.entries()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_flush, entry) for entry in entries]
+            try:
+                for entry, future in zip(entries, futures):
+                    data, error = future.result()
+                    if data is None and error is None:
+                        continue
+                    yield entry, data, error
+            finally:
+                for future in futures:
+                    future.cancel()
@@ -0,0 +1,314 @@
+# Copyright (c) 2015 Codenomicon Ltd.
+# License: MIT
+
+from __future__ import absolute_import, division, print_function
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import logging
+import os.path
+import time
+
+from protecodesc import exceptions
+from protecodesc.cache import _SQLiteCache
+from protecodesc.config import USER_CACHE_DIR
+
+logger = logging.getLogger(__name__)
+
+RESULT_STORE_FILE = os.path.join(USER_CACHE_DIR, 'store.sqlite')
+RESULT_STORE_MAX_AGE = 24 * 60 * 60  # seconds before a result is refetched
+
+
+def app_fingerprint(app):
+    """Checksum of an app as listed by list_apps
+
+    The listing of an app changes when a new version is uploaded. A
+    rescan or an update of vulnerability data may not change it, so a
+    stored result is also fetched again when it was rescanned or gets
+    old.
+    """
+    text = json.dumps(app, sort_keys=True).encode('utf-8')
+    return hashlib.sha1(text).hexdigest()
+
+
+def _vuln_id(vuln):
+    info = vuln.get('vuln', vuln)
+    return info.get('cve') or info.get('id')
+
+
+def summarize_result(appcheck, app):
+    """Fetch result of app and reduce it to what the store and rollups use
+
+    Returns dict with keys status, verdict, filename, report_url and
+    components, a list of (lib, version, license, vulnerability IDs)
+    tuples. The ID of a vulnerability is None if it has none.
+
+    :param appcheck: ProtecodeSC instance
+    :param app: App as yielded by ProtecodeSC.list_apps
+    """
+    from protecodesc.utils import clean_version
+    id_or_sha1 = app.get('sha1sum') or app['id']
+    stream = appcheck.stream_result(id_or_sha1=id_or_sha1, cache=False)
+    components = []
+    for c in stream:
+        version = c.get('version')
+        vulns = [_vuln_id(v) for v in c.get('vulns') or []]
+        components.append((c.get('lib'),
+                           clean_version(version) if version else None,
+                           (c.get('license') or {}).get('name', 'UNKNOWN'),
+                           vulns))
+    results = stream.document.get('results', {})
+    return {'status': results.get('status'),
+            'verdict': results.get('summary', {}).get('verdict', {})
+                              .get('short'),
+            'filename': results.get('filename'),
+            'report_url': results.get('report_url'),
+            'components': components}
+
+
+class ResultStore(_SQLiteCache):
+    """Local copy of scan results, indexed for queries across apps
+
+    Keeps the components of every synced app with their versions,
+    licenses and vulnerability IDs, so questions like "which apps ship
+    openssl 1.0.2" are answered without fetching results again.
+    """
+
+    SCHEMA = ('CREATE TABLE IF NOT EXISTS apps ('
+              'id INTEGER PRIMARY KEY, name TEXT, sha1 TEXT, group_id TEXT, '
+              'fingerprint TEXT, status TEXT, verdict TEXT, filename TEXT, '
+              'report_url TEXT, synced REAL)',
+              'CREATE INDEX IF NOT EXISTS apps_group ON apps (group_id)',
+              'CREATE TABLE IF NOT EXISTS components ('
+              'id INTEGER PRIMARY KEY, app_id INTEGER, lib TEXT, '
+              'version TEXT, license TEXT, vulns INTEGER)',
+              'CREATE INDEX IF NOT EXISTS components_app '
+              'ON components (app_id)',
+              'CREATE INDEX IF NOT EXISTS components_lib '
+              'ON components (lib COLLATE NOCASE, version)',
+              'CREATE INDEX IF NOT EXISTS components_license '
+              'ON components (license COLLATE NOCASE)',
+              'CREATE TABLE IF NOT EXISTS vulns ('
+              'component_id INTEGER, vuln_id TEXT)',
+              'CREATE INDEX IF NOT EXISTS vulns_component '
+              'ON vulns (component_id)',
+              'CREATE INDEX IF NOT EXISTS vulns_id '
+              'ON vulns (vuln_id COLLATE NOCASE)')
+
+    def __init__(self, path=RESULT_STORE_FILE):
+        super(ResultStore, self).__init__(path)
+
+    def fingerprints(self):
+        """Dict of app ID: (fingerprint, status, synced) of stored apps"""
+        with self._lock:
+            db = self._connect()
+            rows = db.execute('SELECT id, fingerprint, status, synced '
+                              'FROM apps')
+            return dict((row[0], tuple(row[1:])) for row in rows)
+
+    def invalidate(self, ids):
+        """Make sync fetch results again, e.g. after a rescan
+
+        Stored components stay available to queries until then.
+
+        :param ids: Scan IDs or SHA1 checksums (hex strings)
+        """
+        with self._lock:
+            db = self._connect()
+            with db:
+                db.executemany('UPDATE apps SET fingerprint = NULL '
+                               'WHERE id = ? OR sha1 = ?',
+                               [(str(i), str(i)) for i in ids])
+
+    def app_ids(self, group=None):
+        """IDs of stored apps, optionally only those synced from group"""
+        with self._lock:
+            db = self._connect()
+            if group is None:
+                rows = db.execute('SELECT id FROM apps')
+            else:
+                rows = db.execute('SELECT id FROM apps WHERE group_id = ?',
+                                  (str(group),))
+            return [row[0] for row in rows]
+
+    def put(self, app, summary, fingerprint, group=None):
+        """Store app and its result, replacing what was stored before
+
+        :param app: App as yielded by ProtecodeSC.list_apps
+        :param summary: Result summary from summarize_result
+        :param fingerprint: app_fingerprint of app
+        :param group: Group ID the app was listed in [optional]
+        """
+        with self._lock:
+            db = self._connect()
+            with db:
+                if group is None:
+                    row = db.execute('SELECT group_id FROM apps WHERE id = ?',
+                                     (app['id'],)).fetchone()
+                    group = row[0] if row else None
+                self._delete(db, [app['id']])
+                db.execute('INSERT INTO apps (id, name, sha1, group_id, '
+                           'fingerprint, status, verdict, filename, '
+                           'report_url, synced) '
+                           'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                           (app['id'], app.get('name'), app.get('sha1sum'),
+                            None if group is None else str(group),
+                            fingerprint, summary['status'],
+                            summary['verdict'], summary['filename'],
+                            summary['report_url'], time.time()))
+                for lib, version, license, vulns in summary['components']:
+                    cursor = db.execute(
+                        'INSERT INTO components (app_id, lib, version, '
+                        'license, vulns) VALUES (?, ?, ?, ?, ?)',
+                        (app['id'], lib, version, license, len(vulns)))
+                    db.executemany('INSERT INTO vulns (component_id, '
+                                   'vuln_id) VALUES (?, ?)',
+                                   [(cursor.lastrowid, v) for v in vulns
+                                    if v])
+
+    def remove(self, app_ids):
+        """Forget apps, e.g. after they were deleted from the server"""
+        with self._lock:
+            db = self._connect()
+            with db:
+                self._delete(db, app_ids)
+
+    @staticmethod
+    def _delete(db, app_ids):
+        params = [(app_id,) for app_id in app_ids]
+        db.executemany('DELETE FROM vulns WHERE component_id IN '
+                       '(SELECT id FROM components WHERE app_id = ?)', params)
+        db.executemany('DELETE FROM components WHERE app_id = ?', params)
+        db.executemany('DELETE FROM apps WHERE id = ?', params)
+
+    def query(self, component=None, version=None, license=None, vuln=None,
+              vulnerable=False, group=None):
+        """Find components of stored apps
+
+        Yields a dict with keys id, name, sha1sum, report_url, lib,
+        version, license and vulns (number of vulnerabilities) for each
+        component matching all given criteria. Names are matched
+        ignoring case.
+
+        :param component: Component name
+        :param version: Component version; may contain * wildcards
+        :param license: License name
+        :param vuln: Vulnerability ID, e.g. CVE-2016-2107
+        :param vulnerable: Only components with known vulnerabilities
+        :param group: Only apps synced from group
+        """
+        where = []
+        params = []
+        if component is not None:
+            where.append('c.lib = ? COLLATE NOCASE')
+            params.append(component)
+        if version is not None:
+            where.append('c.version GLOB ?' if '*' in version
+                         else 'c.version = ?')
+            params.append(version)
+        if license is not None:
+            where.append('c.license = ? COLLATE NOCASE')
+            params.append(license)
+        if vuln is not None:
+            where.append('c.id IN (SELECT component_id FROM vulns '
+                         'WHERE vuln_id = ? COLLATE NOCASE)')
+            params.append(vuln)
+        if vulnerable:
+            where.append('c.vulns > 0')
+        if group is not None:
+            where.append('a.group_id = ?')
+            params.append(str(group))
+        sql = ('SELECT a.id, a.name, a.sha1, a.report_url, c.lib, '
+               'c.version, c.license, c.vulns '
+               'FROM components c JOIN apps a ON a.id = c.app_id')
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY a.id, c.lib, c.version'
+        with self._lock:
+            db = self._connect()
+            rows = db.execute(sql, params).fetchall()
+        keys = ('id', 'name', 'sha1sum', 'report_url', 'lib', 'version',
+                'license', 'vulns')
+        for row in rows:
+            yield dict(zip(keys, row))
+
+    def stats(self):
+        """Number of stored apps and components"""
+        with self._lock:
+            db = self._connect()
+            apps = db.execute('SELECT COUNT(*) FROM apps').fetchone()[0]
+            components = db.execute(
+                'SELECT COUNT(*) FROM components').fetchone()[0]
+        return {'apps': apps, 'components': components}
+
+
+def sync_results(appcheck, store, group=None, workers=8, full=False,
+                 max_age=RESULT_STORE_MAX_AGE):
+    """Mirror results of all apps, or apps in group, into store
+
+    Only results of apps whose listing changed since the last sync, that
+    were not ready then, were invalidated or were synced more than
+    max_age seconds ago are fetched. Apps no longer listed are removed
+    from the store. Returns counts of apps listed, fetched, unchanged,
+    removed and failed.
+
+    :param appcheck: ProtecodeSC instance
+    :param store: ResultStore
+    :param group: Group ID [optional]
+    :param workers: Number of concurrent result requests
+    :param full: Fetch all results, changed or not
+    :param max_age: Seconds before a stored result is fetched again
+    """
+    # Imported here so that queries do not load requests
+    from protecodesc.protecodesc import ProtecodeSC
+    stats = {'apps': 0, 'fetched': 0, 'unchanged': 0, 'removed': 0,
+             'failed': 0}
+    stored = store.fingerprints()
+    listed = set()
+    synced_after = time.time() - max_age
+
+    def _changed(apps):
+        for app in apps:
+            stats['apps'] += 1
+            listed.add(app['id'])
+            fingerprint = app_fingerprint(app)
+            previous = stored.get(app['id'])
+            if (not full and previous is not None and
+                    previous[:2] == (fingerprint, ProtecodeSC.STATUS_READY) and
+                    previous[2] >= synced_after):
+                stats['unchanged'] += 1
+                continue
+            yield app, fingerprint
+
+    changed = _changed(appcheck.list_apps(group=group))
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            # Fetch a few results per worker ahead
+            for app, fingerprint in changed:
+                pending.append((app, fingerprint, executor.submit(
+                    summarize_result, appcheck, app)))
+                if len(pending) >= 4 * workers:
+                    break
+            if not pending:
+                break
+            app, fingerprint, future = pending.popleft()
+            try:
+                summary = future.result()
+            except exceptions.InvalidLoginError:
+                raise
+            except exceptions.AppcheckException as e:
+                logger.info(u"Result of app {id} failed: {exception}"
+                            .format(id=app.get('id'), exception=e))
+                stats['failed'] += 1
+                continue
+            store.put(app, summary, fingerprint, group=group)
+            stats['fetched'] += 1
+
+    gone = [app_id for app_id in store.app_ids(group=group)
+            if app_id not in listed]
+    store.remove(gone)
+    stats['removed'] = len(gone)
+    return stats
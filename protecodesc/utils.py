@@ -3,14 +3,34 @@
 
 from __future__ import absolute_import, division, print_function
 
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import codecs
 import datetime
 import hashlib
+import itertools
 import logging
+import mmap
+import multiprocessing
 import os
 import os.path
 import json
+import re
+import stat
 import requests
+import requests.adapters
+import socket
 import sys
+import threading
+import time
+import zlib
+from zipfile import (ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED,
+                     ZIP64_LIMIT)
+
+try:
+    from urllib3.connection import HTTPConnection
+except ImportError:  # Older requests with bundled urllib3
+    from requests.packages.urllib3.connection import HTTPConnection
 
 try:  # Python3
     from itertools import zip_longest, filterfalse
@@ -20,23 +40,81 @@ except ImportError:
 
 logger = logging.getLogger(__name__)
 
+HASH_BLOCK_SIZE = 2**20  # 1MB buffered reads
+HASH_MMAP_THRESHOLD = 64 * 2**20  # memory-map files from this size up
+HASH_MMAP_BLOCK_SIZE = 64 * 2**20
+HASH_PARALLEL_MIN_SIZE = 16 * 2**20  # bytes worth starting processes for
+
+
+def _keepalive_socket_options(idle):
+    """Socket options enabling TCP keep-alive probes after idle seconds"""
+    options = [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+    # Not available on every platform
+    for name, value in (('TCP_KEEPIDLE', idle), ('TCP_KEEPALIVE', idle),
+                        ('TCP_KEEPINTVL', max(1, idle // 4)),
+                        ('TCP_KEEPCNT', 4)):
+        if hasattr(socket, name):
+            options.append((socket.IPPROTO_TCP, getattr(socket, name), value))
+    return options
+
 
 class TimeoutHTTPAdapter(requests.adapters.HTTPAdapter):
     """HTTP Adapter with timeout support
 
     This is used so that every request doesn't have to explicitly set
     timeout value.
+
+    With keepalive_idle set, TCP keep-alive is enabled on pooled
+    connections so that idle connections to the server stay usable.
     """
 
     # Default timeout
     timeout = 10
 
+    __attrs__ = requests.adapters.HTTPAdapter.__attrs__ + ['keepalive_idle']
+
+    def __init__(self, keepalive_idle=None, **kwargs):
+        """
+
+        :param keepalive_idle: Seconds of idle time before TCP keep-alive
+                               probes are sent [optional]
+        :param kwargs: pool_connections, pool_maxsize, pool_block,
+                       max_retries as for requests HTTPAdapter
+        """
+        self.keepalive_idle = keepalive_idle
+        super(TimeoutHTTPAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.keepalive_idle:
+            kwargs['socket_options'] = (
+                HTTPConnection.default_socket_options +
+                _keepalive_socket_options(self.keepalive_idle))
+        super(TimeoutHTTPAdapter, self).init_poolmanager(*args, **kwargs)
+
     def send(self, request, timeout=None, **kwargs):
         if timeout is None:
             timeout = self.timeout
         return super(TimeoutHTTPAdapter, self).send(
             request, timeout=timeout, **kwargs)
 
+    def connection_stats(self):
+        """Connections opened and requests sent through the adapter
+
+        Returns dict with keys connections, requests and reused, the number
+        of requests that reused an open connection.
+        """
+        connections = requests_sent = 0
+        pools = self.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            connections += pool.num_connections
+            requests_sent += pool.num_requests
+        return {'connections': connections,
+                'requests': requests_sent,
+                'reused': max(0, requests_sent - connections)}
+
 
 class DateTimeEncoder(json.JSONEncoder):
     def default(self, obj):
@@ -50,17 +128,104 @@ class DateTimeEncoder(json.JSONEncoder):
             return super(DateTimeEncoder, self).default(obj)
 
 
-def file_sha1(fname):
+def _sha1_hexdigest(fname, block_size=HASH_BLOCK_SIZE):
+    """SHA1 of file contents, memory-mapped for large files"""
     digest = hashlib.sha1()
     with open(fname, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size >= HASH_MMAP_THRESHOLD:
+            try:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (mmap.error, ValueError, OSError):
+                mapped = None
+            if mapped is not None:
+                try:
+                    view = memoryview(mapped)
+                    for offset in range(0, len(view), HASH_MMAP_BLOCK_SIZE):
+                        digest.update(view[offset:offset+HASH_MMAP_BLOCK_SIZE])
+                    view.release()
+                finally:
+                    mapped.close()
+                return digest.hexdigest()
         while True:
-            block = f.read(2**10)  # 1kB
+            block = f.read(block_size)
             if not block:
                 break
             digest.update(block)
     return digest.hexdigest()
 
 
+def _stat_unchanged(st, st_after):
+    return (st_after.st_size, st_after.st_mtime, st_after.st_ino) == \
+        (st.st_size, st.st_mtime, st.st_ino)
+
+
+def file_sha1(fname, cache=None):
+    """SHA1 checksum of file as hex string
+
+    :param fname: File to hash
+    :param cache: HashCache used to skip hashing unchanged files [optional]
+    """
+    if cache is not None:
+        st = os.stat(fname)
+        cached = cache.get(fname, st)
+        if cached:
+            return cached
+    sha1 = _sha1_hexdigest(fname)
+    # Only store checksum if file did not change while hashing
+    if cache is not None and _stat_unchanged(st, os.stat(fname)):
+        cache.put(fname, sha1, st)
+    return sha1
+
+
+def hash_files(paths, workers=None, cache=None):
+    """SHA1 checksums of many files using a process pool
+
+    Yields tuples (path, sha1) in the order of paths.
+
+    for path, sha1 in hash_files(file_finder(['build/'])):
+        print(sha1, path)
+
+    Files are hashed in this process if there are less than
+    HASH_PARALLEL_MIN_SIZE bytes to hash.
+
+    :param paths: Files to hash
+    :param workers: Number of processes; default: number of CPUs
+    :param cache: HashCache used to skip hashing unchanged files [optional]
+    """
+    paths = list(paths)
+    stats = {}
+    todo = []
+    known = {}
+    for path in paths:
+        if cache is not None:
+            st = os.stat(path)
+            cached = cache.get(path, st)
+            if cached:
+                known[path] = cached
+                continue
+            stats[path] = st
+        todo.append(path)
+
+    if (len(todo) > 1 and workers != 1 and
+            sum(os.path.getsize(p) for p in todo) >= HASH_PARALLEL_MIN_SIZE):
+        workers = workers or multiprocessing.cpu_count()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            chunksize = max(1, len(todo) // (workers * 4))
+            digests = executor.map(_sha1_hexdigest, todo, chunksize=chunksize)
+            known.update(zip(todo, digests))
+    else:
+        known.update((path, _sha1_hexdigest(path)) for path in todo)
+
+    if cache is not None:
+        for path in todo:
+            if _stat_unchanged(stats[path], os.stat(path)):
+                cache.put(path, known[path], stats[path])
+        cache.flush()
+    for path in paths:
+        yield path, known[path]
+
+
 def file_finder(paths):
     for path in paths:
         # Handle root in case individual file given
@@ -104,19 +269,657 @@ def generator_progress(it, msg="Progress: {i:8d}"):
     sys.stderr.write("\r\n")
 
 
-def zip_directory(path, zip_file):
-    """Zip directory contents recursively
+PROGRESS_INTERVAL = 0.5  # seconds between updates on a terminal
+PROGRESS_LOG_INTERVAL = 10  # seconds between updates written to a log
+PROGRESS_RATE_WINDOW = 5  # seconds of history used for throughput
+PROGRESS_STALL_TIME = 30  # seconds without bytes sent reported as stalled
 
-    with zipfile.ZipFile('foo.zip', 'w') as zip_file:
-        zip_directory('src/directory/', zip_file)
+
+def format_size(size):
+    """Human readable size, e.g. 12.3 MB"""
+    if size < 1024:
+        return "{size:d} B".format(size=int(size))
+    for unit in ('KB', 'MB', 'GB'):
+        size /= 1024
+        if size < 1024:
+            break
+    return "{size:.1f} {unit}".format(size=size, unit=unit)
+
+
+def format_duration(seconds):
+    """Duration as H:MM:SS"""
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "{h:d}:{m:02d}:{s:02d}".format(h=hours, m=minutes, s=seconds)
+
+
+class ProgressReader(object):
+    """File object wrapper that reports bytes read to an UploadProgress
+
+    It has the length of the rest of the wrapped file, so requests still
+    sends a Content-Length header instead of a chunked body.
+    """
+
+    def __init__(self, fd, progress, key, length, block_size=2**16):
+        self.fd = fd
+        self.progress = progress
+        self.key = key
+        self.length = length
+        self.block_size = block_size
+
+    def read(self, size=-1):
+        data = self.fd.read(size)
+        if data:
+            self.progress.add(self.key, len(data))
+        return data
+
+    def __iter__(self):
+        return generator_reader(self, self.block_size)
+
+    def __len__(self):
+        return self.length
+
+
+class UploadProgress(object):
+    """Report bytes sent, throughput and ETA of concurrent uploads
+
+    Each upload is registered with start() and its body wrapped with
+    wrap(), which counts bytes as they are sent. A background thread
+    writes one line summarizing all uploads every `interval` seconds. On a
+    terminal the line is redrawn in place; otherwise, e.g. in a build log,
+    a new line is written each time. Uploads that send nothing for
+    PROGRESS_STALL_TIME seconds are reported as stalled.
     """
 
+    def __init__(self, stream=None, interval=None):
+        """
+
+        :param stream: Where to write progress; default: stderr
+        :param interval: Seconds between updates; default: 0.5 on a
+                         terminal, 10 otherwise
+        """
+        self.stream = stream or sys.stderr
+        self.tty = bool(getattr(self.stream, 'isatty', None) and
+                        self.stream.isatty())
+        if interval is None:
+            interval = PROGRESS_INTERVAL if self.tty else PROGRESS_LOG_INTERVAL
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._keys = itertools.count()
+        self._transfers = {}  # key -> [bytes sent, total bytes or None]
+        self._done = 0
+        self._done_bytes = 0
+        self._sent = 0  # bytes sent in all attempts, for throughput
+        self._samples = deque()  # (time, self._sent)
+        self._last_sent = time.time()
+        self._started = None
+        self._width = 0
+        self._closed = threading.Event()
+        self._thread = None
+
+    def start(self, name):
+        """Register upload, return its key"""
+        with self._lock:
+            key = next(self._keys)
+            self._transfers[key] = [0, None]
+            if self._thread is None:
+                self._started = self._last_sent = time.time()
+                self._thread = threading.Thread(target=self._report_loop)
+                self._thread.daemon = True
+                self._thread.start()
+            return key
+
+    def wrap(self, key, body):
+        """Count bytes of upload body as they are sent
+
+        Called for each attempt; progress of a failed attempt is discarded.
+
+        :param key: Key from start()
+        :param body: File object or iterable of chunks
+        :return: Body to send instead
+        """
+        if hasattr(body, 'read'):
+            try:
+                length = os.fstat(body.fileno()).st_size - body.tell()
+            except (AttributeError, IOError, OSError):
+                length = None
+            if length is not None:
+                self._restart(key, length)
+                return ProgressReader(body, self, key, length)
+            body = generator_reader(body)
+        self._restart(key, None)
+        return self._count(key, body)
+
+    def _count(self, key, chunks):
+        for chunk in chunks:
+            self.add(key, len(chunk))
+            yield chunk
+
+    def _restart(self, key, total):
+        with self._lock:
+            self._transfers[key] = [0, total]
+
+    def add(self, key, size):
+        """Record size bytes sent by upload key"""
+        with self._lock:
+            self._transfers[key][0] += size
+            self._sent += size
+            self._last_sent = time.time()
+
+    def finish(self, key):
+        """Unregister upload, successful or not"""
+        with self._lock:
+            sent, _ = self._transfers.pop(key)
+            self._done += 1
+            self._done_bytes += sent
+
+    def _status(self, now, final=False):
+        """Progress line, call with lock held
+
+        :param final: Report average throughput of all uploads instead of
+                      recent throughput
+        """
+        self._samples.append((now, self._sent))
+        while now - self._samples[0][0] > PROGRESS_RATE_WINDOW:
+            self._samples.popleft()
+        first_time, first_sent = self._samples[0]
+        if final:
+            first_time, first_sent = self._started, 0
+        rate = (self._sent - first_sent) / (now - first_time) \
+            if now > first_time else 0
+        sent = self._done_bytes + sum(t[0] for t in self._transfers.values())
+        totals = [t[1] for t in self._transfers.values()]
+        text = "Uploaded {sent}".format(sent=format_size(sent))
+        if self._transfers and None not in totals:
+            total = self._done_bytes + sum(totals)
+            text += " of {total} ({percent:.0f}%)".format(
+                total=format_size(total),
+                percent=100.0 * sent / total if total else 100)
+        text += " at {rate}/s".format(rate=format_size(rate))
+        if self._transfers and None not in totals and rate > 0:
+            text += ", ETA {eta}".format(eta=format_duration(
+                sum(t[1] - t[0] for t in self._transfers.values()) / rate))
+        text += "; {active} active, {done} done".format(
+            active=len(self._transfers), done=self._done)
+        if self._transfers and now - self._last_sent >= PROGRESS_STALL_TIME:
+            text += "; stalled for {seconds}".format(
+                seconds=format_duration(now - self._last_sent))
+        return text
+
+    def _write(self, text):
+        if self.tty:
+            padding = " " * max(0, self._width - len(text))
+            self.stream.write("\r" + text + padding)
+            self._width = len(text)
+        else:
+            self.stream.write(text + "\n")
+        self.stream.flush()
+
+    def _report_loop(self):
+        while not self._closed.wait(self.interval):
+            with self._lock:
+                if not self._transfers:
+                    continue
+                self._write(self._status(time.time()))
+
+    def clear(self):
+        """Erase progress line, e.g. before writing other output"""
+        with self._lock:
+            if self.tty and self._width:
+                self.stream.write("\r" + " " * self._width + "\r")
+                self.stream.flush()
+                self._width = 0
+
+    def close(self):
+        """Stop reporting, write final totals if anything was uploaded"""
+        self._closed.set()
+        if self._thread is not None:
+            self._thread.join()
+        with self._lock:
+            if self._done or self._transfers:
+                self._write(self._status(time.time(), final=True))
+                if self.tty:
+                    self.stream.write("\n")
+                    self._width = 0
+
+
+# Timestamp of entries in reproducible archives, the earliest ZIP supports
+REPRODUCIBLE_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+# Already compressed formats, stored in archives without compression
+STORED_EXTENSIONS = frozenset([
+    '.7z', '.aar', '.apk', '.bz2', '.cab', '.deb', '.ear', '.gz', '.ipa',
+    '.jar', '.jpeg', '.jpg', '.lz4', '.lzma', '.mp3', '.mp4', '.png', '.rar',
+    '.rpm', '.tbz2', '.tgz', '.txz', '.war', '.whl', '.xz', '.zip', '.zst'])
+# Entries up to this size are compressed in memory by worker threads
+PARALLEL_ZIP_MAX_ENTRY_SIZE = 16 * 2**20
+# Most bytes of files read ahead for worker threads at once
+PARALLEL_ZIP_MAX_PENDING_SIZE = 64 * 2**20
+# A file ends a shard with probability 1/SHARD_BOUNDARY_MODULUS, once the
+# shard has reached SHARD_MIN_FILL of its maximum size
+SHARD_BOUNDARY_MODULUS = 64
+SHARD_MIN_FILL = 0.25
+
+
+def _zip_entries(path, sort=False):
+    """Regular files below path to include in a ZIP archive
+
+    :param sort: Walk directories and files in sorted order
+    """
     for root, dirs, files in os.walk(path):
+        if sort:
+            dirs.sort()
+            files = sorted(files)
         for file in files:
             file_path = os.path.join(root, file)
             file_is_file = os.path.isfile(file_path)
             file_is_link = os.path.islink(file_path)
             if file_is_file and not file_is_link:
-                zip_file.write(file_path)
+                yield file_path
             else:
                 logger.debug('Ignored non-file {0}'.format(file_path))
+
+
+def _reproducible_zip_info(path, file_path, compression):
+    """ZipInfo for file_path that does not depend on time or platform
+
+    The entry is named relative to the parent of path, has a fixed
+    timestamp, Unix attributes normalized to 0644 or 0755 and no extra
+    fields.
+    """
+    base = os.path.dirname(os.path.normpath(path))
+    arcname = os.path.relpath(file_path, base).replace(os.path.sep, '/')
+    st = os.stat(file_path)
+    zinfo = ZipInfo(arcname, date_time=REPRODUCIBLE_DATE_TIME)
+    zinfo.create_system = 3  # Unix
+    mode = 0o755 if st.st_mode & 0o111 else 0o644
+    zinfo.external_attr = (stat.S_IFREG | mode) << 16
+    zinfo.file_size = st.st_size
+    zinfo.compress_type = compression
+    return zinfo
+
+
+def _entry_compression(file_path, compression):
+    """Compression type for file_path, stored if it is already compressed"""
+    extension = os.path.splitext(file_path)[1].lower()
+    if extension in STORED_EXTENSIONS:
+        return ZIP_STORED
+    return compression
+
+
+def _compress_entry(file_path, zinfo, compresslevel):
+    """Read and compress file for entry zinfo, return compressed data
+
+    Sets size and CRC of zinfo. Run in worker threads; zlib releases the
+    GIL while compressing.
+    """
+    with open(file_path, 'rb') as f:
+        data = f.read()
+    zinfo.file_size = len(data)
+    zinfo.CRC = zlib.crc32(data) & 0xffffffff
+    if zinfo.compress_type == ZIP_DEFLATED:
+        if compresslevel is None:
+            compresslevel = zlib.Z_DEFAULT_COMPRESSION
+        compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+        data = compressor.compress(data) + compressor.flush()
+    zinfo.compress_size = len(data)
+    return data
+
+
+def _can_append_compressed(zip_file):
+    """Return True if _zip_append_compressed works with zip_file"""
+    return (all(hasattr(zip_file, name) for name in
+                ('fp', 'filelist', 'NameToInfo', 'start_dir')) and
+            hasattr(ZipInfo, 'FileHeader'))
+
+
+def _zip_append_compressed(zip_file, zinfo, data):
+    """Append entry compressed by _compress_entry to zip_file
+
+    ZipFile has no public API for adding precompressed data, so this uses
+    its internals; check _can_append_compressed first. This only works
+    for a ZipFile writing to an unseekable stream, which ZipFile itself
+    only ever appends to.
+    """
+    zinfo.flag_bits = 0
+    zinfo.header_offset = zip_file.fp.tell()
+    zip_file.fp.write(zinfo.FileHeader(False))
+    zip_file.fp.write(data)
+    zip_file.filelist.append(zinfo)
+    zip_file.NameToInfo[zinfo.filename] = zinfo
+    zip_file.start_dir = zip_file.fp.tell()
+
+
+def _zip_write(zip_file, file_path, zinfo, block_size=2**16):
+    """Write file_path to zip_file as entry zinfo, yield after each block"""
+    with open(file_path, 'rb') as src, \
+            zip_file.open(zinfo, 'w',
+                          force_zip64=zinfo.file_size > ZIP64_LIMIT) as dest:
+        for block in generator_reader(src, block_size):
+            dest.write(block)
+            yield
+
+
+def zip_directory(path, zip_file, reproducible=False):
+    """Zip directory contents recursively
+
+    with zipfile.ZipFile('foo.zip', 'w') as zip_file:
+        zip_directory('src/directory/', zip_file)
+
+    :param reproducible: Create the same archive for the same directory
+                         contents; see zip_directory_stream
+    """
+
+    for file_path in _zip_entries(path, sort=reproducible):
+        if reproducible:
+            zinfo = _reproducible_zip_info(path, file_path,
+                                           zip_file.compression)
+            for _ in _zip_write(zip_file, file_path, zinfo):
+                pass
+        else:
+            zip_file.write(file_path)
+
+
+class _ChunkBuffer(object):
+    """Write-only file object that collects written data until drained
+
+    It is deliberately not seekable, so ZipFile writes data descriptors
+    after each entry instead of seeking back to patch local headers.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def zip_directory_stream(path, compression=ZIP_STORED, block_size=2**16,
+                         reproducible=False, compresslevel=None, workers=None,
+                         files=None):
+    """Zip directory contents recursively, yield the archive in chunks
+
+    The archive has the same entries as zip_directory() creates, but it is
+    produced on the fly without a temporary file, so it can be hashed,
+    written or sent while it is being built.
+
+    Entries are read and compressed by a pool of worker threads and added
+    to the archive in order, reading ahead at most
+    PARALLEL_ZIP_MAX_PENDING_SIZE bytes. Files with STORED_EXTENSIONS are
+    stored without compression. The archive does not depend on the number
+    of workers. Without compression, entries are added one at a time.
+
+    for chunk in zip_directory_stream('src/directory/'):
+        digest.update(chunk)
+
+    :param compression: ZIP_STORED or ZIP_DEFLATED
+    :param reproducible: Sort entries, name them relative to the parent of
+                         path and normalize timestamps and permissions, so
+                         unchanged contents give an identical archive and
+                         SHA1 wherever and whenever they are zipped
+    :param compresslevel: Deflate level 1-9 [optional]
+    :param workers: Number of compression threads; default: number of CPUs
+    :param files: Zip only these files below path, in this order, e.g. a
+                  shard from shard_directory() [optional]
+    """
+    workers = workers or multiprocessing.cpu_count()
+    buf = _ChunkBuffer()
+    if files is None:
+        files = _zip_entries(path, sort=reproducible)
+
+    def _entries():
+        for file_path in files:
+            entry_compression = _entry_compression(file_path, compression)
+            if reproducible:
+                zinfo = _reproducible_zip_info(path, file_path,
+                                               entry_compression)
+            else:
+                zinfo = ZipInfo.from_file(file_path)
+                zinfo.compress_type = entry_compression
+            zinfo._compresslevel = compresslevel
+            yield file_path, zinfo
+
+    def _write(zip_file, file_path, zinfo, data):
+        if data is None:
+            # Large file, or ZipFile internals changed: compress while
+            # streaming
+            for _ in _zip_write(zip_file, file_path, zinfo, block_size):
+                chunk = buf.drain()
+                if chunk:
+                    yield chunk
+        else:
+            _zip_append_compressed(zip_file, zinfo, data)
+            yield buf.drain()
+
+    with ZipFile(buf, 'w', compression) as zip_file:
+        append = _can_append_compressed(zip_file)
+        if compression == ZIP_STORED or not append:
+            for file_path, zinfo in _entries():
+                data = None
+                if append and zinfo.file_size <= PARALLEL_ZIP_MAX_ENTRY_SIZE:
+                    data = _compress_entry(file_path, zinfo, compresslevel)
+                for chunk in _write(zip_file, file_path, zinfo, data):
+                    yield chunk
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                entries = _entries()
+                pending = deque()
+                pending_size = 0
+                while True:
+                    # Keep workers busy with the entries following the
+                    # current one
+                    for file_path, zinfo in entries:
+                        future = None
+                        size = zinfo.file_size
+                        if size <= PARALLEL_ZIP_MAX_ENTRY_SIZE:
+                            future = executor.submit(_compress_entry,
+                                                     file_path, zinfo,
+                                                     compresslevel)
+                            pending_size += size
+                        pending.append((file_path, zinfo, future, size))
+                        if (len(pending) >= 2 * workers or pending_size >=
+                                PARALLEL_ZIP_MAX_PENDING_SIZE):
+                            break
+                    if not pending:
+                        break
+                    file_path, zinfo, future, size = pending.popleft()
+                    data = None
+                    if future is not None:
+                        data = future.result()
+                        pending_size -= size
+                    for chunk in _write(zip_file, file_path, zinfo, data):
+                        yield chunk
+    data = buf.drain()
+    if data:
+        yield data
+
+
+def _is_shard_boundary(path, file_path):
+    rel_path = os.path.relpath(file_path, path)
+    if not isinstance(rel_path, bytes):
+        rel_path = rel_path.encode('utf-8', 'replace')
+    return zlib.crc32(rel_path) % SHARD_BOUNDARY_MODULUS == 0
+
+
+def shard_directory(path, max_size):
+    """Split files below path into shards of at most max_size bytes
+
+    Files are taken in sorted order. A shard ends after a file whose
+    relative path hashes to a boundary, once the shard is SHARD_MIN_FILL
+    full, or before a file that would make it larger than max_size. As
+    boundaries depend on paths rather than positions, adding, removing or
+    changing files changes only the shards around them, and the other
+    shards keep their contents and SHA1. A file larger than max_size gets
+    a shard of its own.
+
+    Returns list of shards, each a list of file paths.
+
+    :param path: Directory to split
+    :param max_size: Maximum total size of files in a shard, in bytes
+    """
+    min_size = max_size * SHARD_MIN_FILL
+    shards = []
+    shard = []
+    shard_size = 0
+    for file_path in _zip_entries(path, sort=True):
+        file_size = os.path.getsize(file_path)
+        if shard and shard_size + file_size > max_size:
+            shards.append(shard)
+            shard, shard_size = [], 0
+        shard.append(file_path)
+        shard_size += file_size
+        if shard_size >= min_size and _is_shard_boundary(path, file_path):
+            shards.append(shard)
+            shard, shard_size = [], 0
+    if shard:
+        shards.append(shard)
+    return shards
+
+
+def shard_archive_name(name, index, count):
+    """File name of shard index (from 1) of count, e.g. src-001-of-012.zip"""
+    return "{name}-{index:03d}-of-{count:03d}.zip".format(
+        name=name, index=index, count=count)
+
+
+class JSONArrayStream(object):
+    """Incrementally parse a JSON document, yield elements of one array
+
+    The array is found by a path of object keys, e.g. ('results',
+    'components'). Its elements are decoded and yielded one at a time as
+    the document arrives, so the whole array is never held in memory.
+    After iteration, `document` holds the rest of the document with the
+    array replaced by an empty list.
+
+    stream = JSONArrayStream(response.iter_content(2**16),
+                             ('results', 'components'))
+    for component in stream:
+        ...
+    status = stream.document['results']['status']
+    """
+
+    _whitespace = re.compile(r'[ \t\n\r]*')
+
+    def __init__(self, chunks, path):
+        """
+
+        :param chunks: Iterable of bytes making up the document
+        :param path: Keys leading to the array
+        """
+        self._chunks = iter(chunks)
+        self._decode = codecs.getincrementaldecoder('utf-8')().decode
+        self._decoder = json.JSONDecoder()
+        self._buf = u''
+        self._pos = 0
+        self._eof = False
+        self.path = tuple(path)
+        self.document = None
+
+    def __iter__(self):
+        document = {}
+        for element in self._object(self.path, document):
+            yield element
+        self.document = document
+
+    def _read(self):
+        """Read next chunk into buffer, return False at end of document"""
+        if self._eof:
+            return False
+        if self._pos > len(self._buf) // 2:
+            self._buf = self._buf[self._pos:]
+            self._pos = 0
+        for chunk in self._chunks:
+            text = self._decode(chunk)
+            if text:
+                self._buf += text
+                return True
+        self._buf += self._decode(b'', True)
+        self._eof = True
+        return False
+
+    def _peek(self):
+        """Next non-whitespace character, or '' at end of document"""
+        while True:
+            self._pos = self._whitespace.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._read():
+                return u''
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise ValueError("Expected {char!r} at offset {pos} of JSON "
+                             "stream".format(char=char, pos=self._pos))
+        self._pos += 1
+
+    def _value(self):
+        """Decode the next complete JSON value"""
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+            except ValueError:
+                # Incomplete; read until the pending text has doubled to
+                # avoid decoding a large value over and over again
+                needed = 2 * (len(self._buf) - self._pos) + 1
+                more = False
+                while len(self._buf) - self._pos < needed and self._read():
+                    more = True
+                if not more:
+                    raise
+                continue
+            if end == len(self._buf) and self._read():
+                continue  # a number may continue in the next chunk
+            self._pos = end
+            return value
+
+    def _object(self, path, into):
+        """Parse object into dict `into`, yield array elements on path"""
+        self._expect(u'{')
+        if self._peek() == u'}':
+            self._pos += 1
+            return
+        while True:
+            key = self._value()
+            self._expect(u':')
+            if path and key == path[0]:
+                if len(path) == 1:
+                    into[key] = []
+                    for element in self._array():
+                        yield element
+                else:
+                    into[key] = {}
+                    for element in self._object(path[1:], into[key]):
+                        yield element
+            else:
+                into[key] = self._value()
+            char = self._peek()
+            self._pos += 1
+            if char == u'}':
+                return
+            if char != u',':
+                raise ValueError("Expected ',' or '}}' at offset {pos} of "
+                                 "JSON stream".format(pos=self._pos - 1))
+
+    def _array(self):
+        self._expect(u'[')
+        if self._peek() == u']':
+            self._pos += 1
+            return
+        while True:
+            yield self._value()
+            char = self._peek()
+            self._pos += 1
+            if char == u']':
+                return
+            if char != u',':
+                raise ValueError("Expected ',' or ']' at offset {pos} of "
+                                 "JSON stream".format(pos=self._pos - 1))
@@ -0,0 +1,262 @@
+# Copyright (c) 2015 Codenomicon Ltd.
+# License: MIT
+
+from __future__ import absolute_import, division, print_function
+
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+import os.path
+import time
+
+try:
+    import inotify_simple
+except ImportError:  # Optional dependency: pip install protecodesc[watch]
+    inotify_simple = None
+
+from protecodesc import exceptions
+from protecodesc.cache import stat_mtime_ns
+from protecodesc.utils import file_finder
+
+logger = logging.getLogger(__name__)
+
+WATCH_INTERVAL = 10  # seconds between walks of the tree when polling
+WATCH_DEBOUNCE = 2  # seconds a file must stay unchanged before upload
+WATCH_RETRY_DELAY = 60  # seconds before retrying a failed upload
+
+
+def _signature(st):
+    return st.st_size, stat_mtime_ns(st), st.st_ino
+
+
+class Watcher(object):
+    """Upload new and changed files under a directory
+
+    Changes are noticed with inotify when inotify_simple is installed, and
+    otherwise by walking the tree every `interval` seconds and comparing
+    file sizes, modification times and inodes. A file is uploaded once it
+    has not changed for `debounce` seconds, so partially written files are
+    not scanned. Uploads use dedupe, so content scanned before is not sent
+    again.
+
+    The state of uploaded files is kept in a WatchState, so after a
+    restart only files changed in the meantime are uploaded.
+    """
+
+    if inotify_simple is not None:
+        INOTIFY_FLAGS = (inotify_simple.flags.CLOSE_WRITE |
+                         inotify_simple.flags.MOVED_TO |
+                         inotify_simple.flags.MOVED_FROM |
+                         inotify_simple.flags.CREATE |
+                         inotify_simple.flags.DELETE)
+
+    def __init__(self, appcheck, root, state, group=None,
+                 interval=WATCH_INTERVAL, debounce=WATCH_DEBOUNCE,
+                 workers=1, use_inotify=True):
+        """
+
+        :param appcheck: ProtecodeSC instance
+        :param root: Directory to watch
+        :param state: WatchState
+        :param group: Group ID to upload to [optional]
+        :param interval: Seconds between walks of the tree when polling
+        :param debounce: Seconds a file must stay unchanged before upload
+        :param workers: Number of parallel uploads
+        :param use_inotify: Use inotify if available
+        """
+        self.appcheck = appcheck
+        self.root = os.path.abspath(root)
+        self.state = state
+        self.group = group
+        self.interval = interval
+        self.debounce = debounce
+        self.workers = workers
+        self._known = state.snapshot(self.root)  # path -> signature
+        self._pending = {}  # path -> (signature, upload time)
+        self._inotify = None
+        self._watches = {}  # inotify watch descriptor -> directory
+        if use_inotify and inotify_simple is not None:
+            self._start_inotify()
+
+    @property
+    def using_inotify(self):
+        return self._inotify is not None
+
+    def close(self):
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+
+    def _start_inotify(self):
+        try:
+            self._inotify = inotify_simple.INotify()
+            self._watch_tree(self.root)
+        except OSError as e:
+            # E.g. not Linux, or out of inotify watches
+            logger.warning("Using polling, inotify failed: {error}".format(
+                error=e))
+            self.close()
+
+    def _watch_tree(self, top):
+        for dirpath, _, _ in os.walk(top):
+            wd = self._inotify.add_watch(dirpath, self.INOTIFY_FLAGS)
+            self._watches[wd] = dirpath
+
+    def _check(self, path, now):
+        """Queue file for upload if it differs from when last uploaded"""
+        try:
+            st = os.stat(path)
+        except OSError:
+            self._forget(path)
+            return
+        signature = _signature(st)
+        if self._known.get(path) == signature:
+            self._pending.pop(path, None)
+            return
+        pending = self._pending.get(path)
+        if pending is None or pending[0] != signature:
+            # A file not modified for a while is complete already
+            upload_at = min(now, st.st_mtime) + self.debounce
+            self._pending[path] = (signature, upload_at)
+
+    def _forget(self, path):
+        self._pending.pop(path, None)
+        if self._known.pop(path, None) is not None:
+            self.state.remove([path])
+
+    def poll(self):
+        """Walk the tree, queue new and changed files, forget deleted ones"""
+        now = time.time()
+        seen = set()
+        for path in file_finder([self.root]):
+            seen.add(path)
+            self._check(path, now)
+        gone = [path for path in self._known if path not in seen]
+        for path in gone:
+            del self._known[path]
+        if gone:
+            self.state.remove(gone)
+        for path in [path for path in self._pending if path not in seen]:
+            del self._pending[path]
+
+    def _read_events(self, timeout):
+        """Wait up to timeout seconds for inotify events and handle them"""
+        flags = inotify_simple.flags
+        events = self._inotify.read(timeout=int(timeout * 1000))
+        now = time.time()
+        for event in events:
+            if event.mask & flags.Q_OVERFLOW:
+                logger.warning("Missed inotify events, walking the tree")
+                self.poll()
+                continue
+            directory = self._watches.get(event.wd)
+            if directory is None or not event.name:
+                continue
+            path = os.path.join(directory, event.name)
+            if event.mask & flags.ISDIR:
+                if event.mask & (flags.CREATE | flags.MOVED_TO):
+                    self._watch_tree(path)
+                    for file_path in file_finder([path]):
+                        self._check(file_path, now)
+                else:
+                    prefix = os.path.join(path, '')
+                    for file_path in [p for p in set(self._known) |
+                                      set(self._pending)
+                                      if p.startswith(prefix)]:
+                        self._forget(file_path)
+                continue
+            if event.mask & (flags.DELETE | flags.MOVED_FROM):
+                self._forget(path)
+            elif not os.path.islink(path):
+                self._check(path, now)
+
+    def _upload(self, path, signature):
+        data = self.appcheck.upload_file(path, group=self.group, dedupe=True)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return data  # deleted meanwhile
+        if _signature(st) == signature:
+            self.state.put(path, signature, data['results']['sha1sum'])
+            self._known[path] = signature
+        else:
+            self._check(path, time.time())  # changed during upload
+        return data
+
+    def upload_due(self, retry=True):
+        """Upload queued files that have settled
+
+        Yields tuples (path, data, error), where data is as returned by
+        upload_file and error is the exception if the upload failed.
+
+        :param retry: Queue failed uploads again, to be retried after
+                      WATCH_RETRY_DELAY seconds
+        """
+        now = time.time()
+        due = []
+        for path, (signature, upload_at) in list(self._pending.items()):
+            if upload_at > now:
+                continue
+            del self._pending[path]
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if _signature(st) != signature:
+                self._check(path, now)  # still being written
+                continue
+            due.append((path, signature))
+        if not due:
+            return
+
+        def _upload(item):
+            try:
+                return self._upload(*item), None
+            except exceptions.InvalidLoginError:
+                raise
+            except (exceptions.AppcheckException, IOError, OSError) as e:
+                return None, e
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for (path, signature), (data, error) in zip(
+                    due, executor.map(_upload, due)):
+                if error is not None and retry:
+                    self._pending[path] = (signature,
+                                           time.time() + WATCH_RETRY_DELAY)
+                yield path, data, error
+
+    def _next_wakeup(self, next_walk):
+        wakeup = next_walk
+        if self._pending:
+            wakeup = min(wakeup, min(upload_at for _, upload_at
+                                     in self._pending.values()))
+        return max(0, wakeup - time.time())
+
+    def run(self, once=False):
+        """Upload changes as they happen
+
+        Yields tuples (path, data, error) as upload_due.
+
+        :param once: Upload changes since the last run and return; failed
+                     uploads are not retried, but uploaded again on the
+                     next run
+        """
+        self.poll()
+        next_walk = time.time() + self.interval
+        while True:
+            for result in self.upload_due(retry=not once):
+                yield result
+            if once and not self._pending:
+                return
+            if not self.using_inotify and time.time() >= next_walk:
+                self.poll()
+                next_walk = time.time() + self.interval
+                continue
+            if once:
+                next_walk = float('inf')
+            wait = self._next_wakeup(next_walk)
+            if self.using_inotify:
+                self._read_events(min(wait, self.interval))
+            else:
+                time.sleep(wait)
+
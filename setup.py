@@ -15,9 +15,12 @@ setup(name='protecodesc',
       author='Antti Hayrynen',
       author_email='hayrynen@synopsys.com',
       version=version,
-      packages=find_packages(exclude=['tests']),
+      packages=find_packages(exclude=['tests', 'benchmarks']),
       zip_safe=False,
+      python_requires='>=3.7',
       install_requires=['click', 'requests', 'keyring'],
+      extras_require={'aio': ['aiohttp>=3.0'],
+                      'watch': ['inotify_simple; sys_platform == "linux"']},
       entry_points="""
           [console_scripts]
           protecodesc = protecodesc.cli:main
@@ -28,10 +31,14 @@ setup(name='protecodesc',
           "License :: OSI Approved :: MIT License",
           "Operating System :: OS Independent",
           "Programming Language :: Python",
-          "Programming Language :: Python :: 2",
-          "Programming Language :: Python :: 2.7",
           "Programming Language :: Python :: 3",
-          "Programming Language :: Python :: 3.5",
+          "Programming Language :: Python :: 3 :: Only",
+          "Programming Language :: Python :: 3.7",
+          "Programming Language :: Python :: 3.8",
+          "Programming Language :: Python :: 3.9",
+          "Programming Language :: Python :: 3.10",
+          "Programming Language :: Python :: 3.11",
+          "Programming Language :: Python :: 3.12",
           "Topic :: Security",
           "Topic :: Software Development",
           "Topic :: Software Development :: Libraries",
@@ -0,0 +1,8 @@
+# Copyright (c) 2015 Codenomicon Ltd.
+# License: MIT
+"""Tests for protecodesc
+
+Run from the repository root:
+
+    python -m pytest tests
+"""
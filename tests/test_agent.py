@@ -0,0 +1,141 @@
+# Copyright (c) 2015 Codenomicon Ltd.
+# License: MIT
+
+from __future__ import absolute_import, division, print_function
+
+import threading
+import time
+
+import pytest
+
+from protecodesc import exceptions
+from protecodesc.agent import Agent, AgentClient
+from protecodesc.metrics import Metrics
+from protecodesc.protecodesc import ProtecodeSC, ResultPoller
+
+
+class FakeAppcheck(object):
+    """Serves results from memory; uploads take upload_time seconds"""
+
+    STATUS_BUSY = ProtecodeSC.STATUS_BUSY
+    STATUS_READY = ProtecodeSC.STATUS_READY
+
+    def __init__(self, busy_polls=0, upload_time=0):
+        self.metrics = Metrics()
+        self.busy_polls = busy_polls
+        self.upload_time = upload_time
+        self.uploads = []
+        self.rescans = []
+
+    def _data(self, sha1):
+        if sha1 == 'missing':
+            raise exceptions.ResultNotFound("Object was not found")
+        status = self.STATUS_READY
+        if self.busy_polls is None or self.busy_polls > 0:
+            status = self.STATUS_BUSY
+            if self.busy_polls:
+                self.busy_polls -= 1
+        return {'results': {'sha1sum': sha1, 'status': status}}
+
+    def upload_file(self, path, group=None, dedupe=True):
+        time.sleep(self.upload_time)
+        self.uploads.append(path)
+        return self._data('ab' * 20)
+
+    def get_result(self, id_or_sha1):
+        return self._data(id_or_sha1)
+
+    def rescan(self, id_or_sha1):
+        self.rescans.append(id_or_sha1)
+
+    def connection_stats(self):
+        return {'connections': 0, 'requests': 0, 'reused': 0}
+
+
+@pytest.fixture
+def run_agent(tmpdir):
+    agents = []
+
+    def _run(appcheck):
+        agent = Agent(appcheck, str(tmpdir.join('agent.sock')))
+        agent._poller = ResultPoller(appcheck, initial_delay=0.01,
+                                     max_delay=0.02)
+        thread = threading.Thread(target=agent.serve_forever)
+        thread.daemon = True
+        thread.start()
+        agents.append((agent, thread))
+        client = AgentClient(agent.socket_path, timeout=5)
+        for _ in range(100):
+            try:
+                client.status()
+                break
+            except exceptions.AgentError:
+                time.sleep(0.01)
+        return client
+    yield _run
+    for agent, thread in agents:
+        agent.shutdown()
+        thread.join(5)
+
+
+def test_status(run_agent):
+    status = run_agent(FakeAppcheck()).status()
+    assert status['jobs'] == 0
+    assert status['waiting'] == 0
+
+
+def test_scan_file(run_agent, tmpdir):
+    appcheck = FakeAppcheck()
+    client = run_agent(appcheck)
+    path = tmpdir.join('file.bin')
+    path.write_binary(b'data')
+    data = client.scan(str(path))
+    assert data['results']['status'] == FakeAppcheck.STATUS_READY
+    assert appcheck.uploads == [str(path)]
+
+
+def test_scan_missing_path(run_agent, tmpdir):
+    client = run_agent(FakeAppcheck())
+    with pytest.raises(exceptions.AgentError):
+        client.scan(str(tmpdir.join('missing')))
+
+
+def test_result_waits_until_ready(run_agent):
+    client = run_agent(FakeAppcheck(busy_polls=3))
+    data = client.result('cd' * 20, wait=True, wait_timeout=5)
+    assert data['results']['status'] == FakeAppcheck.STATUS_READY
+
+
+def test_result_wait_timeout(run_agent):
+    client = run_agent(FakeAppcheck(busy_polls=None))
+    with pytest.raises(exceptions.PollTimeout):
+        client.result('cd' * 20, wait=True, wait_timeout=0.1)
+
+
+def test_wait_timeout_excludes_upload(run_agent, tmpdir):
+    client = run_agent(FakeAppcheck(upload_time=0.3))
+    path = tmpdir.join('file.bin')
+    path.write_binary(b'data')
+    data = client.scan(str(path), wait=True, wait_timeout=0.1)
+    assert data['results']['status'] == FakeAppcheck.STATUS_READY
+
+
+def test_rescan(run_agent):
+    appcheck = FakeAppcheck()
+    client = run_agent(appcheck)
+    client.rescan('cd' * 20)
+    assert appcheck.rescans == ['cd' * 20]
+
+
+def test_errors_keep_their_type(run_agent):
+    client = run_agent(FakeAppcheck())
+    with pytest.raises(exceptions.ResultNotFound):
+        client.result('missing')
+    with pytest.raises(exceptions.AgentError):
+        client.request('unknown')
+
+
+def test_no_agent(tmpdir):
+    client = AgentClient(str(tmpdir.join('agent.sock')))
+    with pytest.raises(exceptions.AgentError):
+        client.status()
@@ -0,0 +1,55 @@
+# Copyright (c) 2015 Codenomicon Ltd.
+# License: MIT
+
+from __future__ import absolute_import, division, print_function
+
+from protecodesc.cache import HashCache
+from protecodesc.utils import file_sha1, hash_files
+
+
+def _files(tmpdir, count):
+    paths = []
+    for i in range(count):
+        path = tmpdir.join('f{0}'.format(i))
+        path.write_binary(str(i).encode('ascii'))
+        paths.append(str(path))
+    return paths
+
+
+def test_checksums_persist_after_close(tmpdir):
+    paths = _files(tmpdir, 5)
+    db = str(tmpdir.join('sha1.sqlite'))
+    cache = HashCache(db)
+    sha1s = dict(hash_files(paths, workers=1, cache=cache))
+    cache.close()
+    cache = HashCache(db)
+    assert dict((p, cache.get(p)) for p in paths) == sha1s
+
+
+def test_pending_checksum_returned(tmpdir):
+    path, = _files(tmpdir, 1)
+    cache = HashCache(str(tmpdir.join('sha1.sqlite')))
+    sha1 = file_sha1(path, cache=cache)
+    assert cache.get(path) == sha1
+
+
+def test_changed_file_misses(tmpdir):
+    path, = _files(tmpdir, 1)
+    cache = HashCache(str(tmpdir.join('sha1.sqlite')))
+    file_sha1(path, cache=cache)
+    with open(path, 'ab') as f:
+        f.write(b'more')
+    assert cache.get(path) is None
+    cache.flush()
+    assert cache.get(path) is None
+
+
+def test_evicts_least_recently_used(tmpdir):
+    paths = _files(tmpdir, 10)
+    db = str(tmpdir.join('sha1.sqlite'))
+    cache = HashCache(db, max_entries=4, batch_size=3)
+    for path in paths:
+        file_sha1(path, cache=cache)
+    cache.close()
+    cache = HashCache(db)
+    assert [p for p in paths if cache.get(p)] == paths[-4:]
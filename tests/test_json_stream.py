@@ -0,0 +1,93 @@
+# Copyright (c) 2015 Codenomicon Ltd.
+# License: MIT
+
+from __future__ import absolute_import, division, print_function
+
+import json
+
+import pytest
+
+from protecodesc.utils import JSONArrayStream
+
+PATH = ('results', 'components')
+
+
+def _chunks(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def _stream(document, size):
+    data = json.dumps(document, ensure_ascii=False).encode('utf-8')
+    return JSONArrayStream(_chunks(data, size), PATH)
+
+
+def test_chunk_boundaries():
+    """Elements split at every offset decode the same"""
+    components = [{'lib': u'a "quoted" \\ lib', 'version': u'1.0'},
+                  {'lib': u'näytö', 'license': {'name': u'MIT'}},
+                  {'lib': u'x\ny\tz☃', 'vulns': []},
+                  {'size': 1234567890, 'ratio': -1.5e-3}]
+    document = {'meta': {'code': 200},
+                'results': {'status': 'R', 'components': components,
+                            'summary': {'verdict': {'short': 'Pass'}}}}
+    for size in range(1, 24):
+        stream = _stream(document, size)
+        assert list(stream) == components
+        assert stream.document == {
+            'meta': {'code': 200},
+            'results': {'status': 'R', 'components': [],
+                        'summary': {'verdict': {'short': 'Pass'}}}}
+
+
+def test_nested_arrays():
+    components = [[1, [2, [3]]], {'a': [[], [{}]]}, []]
+    document = {'results': {'components': components}}
+    for size in (1, 2, 5):
+        assert list(_stream(document, size)) == components
+
+
+def test_empty_array():
+    stream = _stream({'results': {'components': []}}, 3)
+    assert list(stream) == []
+    assert stream.document == {'results': {'components': []}}
+
+
+def test_missing_key():
+    document = {'results': {'status': 'B', 'other': [1, 2]}}
+    stream = _stream(document, 4)
+    assert list(stream) == []
+    assert stream.document == document
+
+
+def test_truncated_document():
+    data = json.dumps({'results': {'components': [{'lib': 'a'},
+                                                  {'lib': 'b'}]}})
+    stream = JSONArrayStream(_chunks(data[:-8].encode('utf-8'), 7), PATH)
+    with pytest.raises(ValueError):
+        list(stream)
+
+
+def _result_stream(document, tmpdir, max_entry_size):
+    from protecodesc.cache import ResultCache
+    from protecodesc.protecodesc import ResultStream
+    cache = ResultCache(path=str(tmpdir.join('results.sqlite')),
+                        max_entry_size=max_entry_size)
+    data = json.dumps(document).encode('utf-8')
+    return cache, ResultStream(_chunks(data, 5), result_cache=cache)
+
+
+def test_result_stream_caches_response(tmpdir):
+    document = {'results': {'id': 7, 'sha1sum': 'ab' * 20, 'status': 'R',
+                            'components': [{'lib': 'a'}, {'lib': 'b'}]}}
+    cache, stream = _result_stream(document, tmpdir, 2**20)
+    assert list(stream) == [{'lib': 'a'}, {'lib': 'b'}]
+    assert cache.get(7) == document
+    assert cache.get('ab' * 20) == document
+
+
+def test_result_stream_skips_large_response(tmpdir):
+    document = {'results': {'id': 7, 'status': 'R',
+                            'components': [{'lib': 'x' * 100}] * 10}}
+    cache, stream = _result_stream(document, tmpdir, 500)
+    assert len(list(stream)) == 10
+    assert cache.get(7) is None
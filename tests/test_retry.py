@@ -0,0 +1,178 @@
+# Copyright (c) 2015 Codenomicon Ltd.
+# License: MIT
+
+from __future__ import absolute_import, division, print_function
+
+import pytest
+import requests.exceptions
+
+from protecodesc import exceptions, retry
+from protecodesc.protecodesc import ProtecodeSC
+from protecodesc.retry import (CircuitBreaker, RetryBudget, RetryPolicy,
+                               parse_retry_after)
+
+
+class FakeClock(object):
+
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+class FakeResponse(object):
+
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def close(self):
+        pass
+
+
+def _request(responses):
+    """Function returning or raising the given outcomes in turn"""
+    calls = []
+
+    def _send(uri):
+        calls.append(uri)
+        outcome = responses[min(len(calls), len(responses)) - 1]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+    return _send, calls
+
+
+def _client(**kwargs):
+    policy = RetryPolicy(backoff_base=0, **kwargs)
+    return ProtecodeSC(creds=('user', 'pass'), host='http://localhost',
+                       retry_policy=policy)
+
+
+def test_parse_retry_after():
+    assert parse_retry_after(' 120 ') == 120
+    assert parse_retry_after('Thu, 01 Jan 1970 00:01:40 GMT', now=40) == 60
+    assert parse_retry_after('Thu, 01 Jan 1970 00:01:40 GMT', now=400) == 0
+    assert parse_retry_after('soon') is None
+    assert parse_retry_after(None) is None
+
+
+def test_policy_backoff_bounds():
+    policy = RetryPolicy(backoff_base=2, max_delay=10)
+    for attempt, delay in ((1, 2), (2, 4), (3, 8), (4, 10), (10, 10)):
+        for _ in range(20):
+            assert delay / 2 <= policy.backoff(attempt) <= delay
+
+
+def test_policy_delay_retry_after():
+    policy = RetryPolicy(backoff_base=1, retry_after_max=60)
+    assert 5 <= policy.delay(1, FakeResponse(503, {'Retry-After': '5'})) <= 6
+    assert policy.delay(1, FakeResponse(503, {'Retry-After': '61'})) is None
+    assert 0.5 <= policy.delay(1, FakeResponse(503)) <= 1
+
+
+def test_policy_should_retry():
+    policy = RetryPolicy()
+    assert policy.should_retry(503)
+    assert policy.should_retry(429)
+    assert not policy.should_retry(404)
+    assert not policy.should_retry(501)
+
+
+def test_budget_spends_and_earns():
+    budget = RetryBudget(ratio=0.5, min_retries=2)
+    assert budget.withdraw()
+    assert budget.withdraw()
+    assert not budget.withdraw()
+    budget.deposit()
+    assert not budget.withdraw()
+    budget.deposit()
+    assert budget.withdraw()
+    for _ in range(10):
+        budget.deposit()
+    assert [budget.withdraw() for _ in range(3)] == [True, True, False]
+
+
+def test_default_budget_covers_max_retries():
+    budget = RetryPolicy(max_retries=20).budget
+    assert all(budget.withdraw() for _ in range(19))
+
+
+def test_breaker_opens_after_threshold(monkeypatch):
+    clock = FakeClock(1000.0)
+    monkeypatch.setattr(retry, 'time', clock)
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30)
+    for _ in range(2):
+        assert breaker.allow()
+        breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_success()
+    for _ in range(3):
+        assert breaker.allow()
+        breaker.record_failure()
+    assert breaker.is_open()
+    assert not breaker.allow()
+    assert breaker.retry_in() == 30
+    clock.now += 30
+    assert breaker.allow()  # trial request
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow()
+    assert breaker.describe() == "waiting for a trial request to succeed"
+    breaker.record_failure()
+    assert breaker.is_open()
+    clock.now += 30
+    assert breaker.allow()
+    breaker.release()
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow()
+
+
+def test_breaker_failure_statuses():
+    assert CircuitBreaker.is_failure(429)
+    assert CircuitBreaker.is_failure(503)
+    assert not CircuitBreaker.is_failure(404)
+    assert not CircuitBreaker.is_failure(200)
+
+
+def test_retries_up_to_max_retries():
+    appcheck = _client(max_retries=8)
+    send, calls = _request([FakeResponse(503)])
+    with pytest.raises(exceptions.OutOfRetriesError):
+        appcheck._retry_request(send, ['/api/apps/'], {})
+    assert len(calls) == 8
+    assert appcheck.retry_policy.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_request_counts_once_for_breaker():
+    appcheck = _client(max_retries=3,
+                       breaker=CircuitBreaker(failure_threshold=2))
+    send, calls = _request([FakeResponse(503)])
+    with pytest.raises(exceptions.OutOfRetriesError):
+        appcheck._retry_request(send, ['/api/apps/'], {})
+    assert not appcheck.retry_policy.breaker.is_open()
+    with pytest.raises(exceptions.OutOfRetriesError):
+        appcheck._retry_request(send, ['/api/apps/'], {})
+    assert len(calls) == 6
+    with pytest.raises(exceptions.CircuitOpenError):
+        appcheck._retry_request(send, ['/api/apps/'], {})
+    assert len(calls) == 6
+
+
+def test_retried_request_succeeds():
+    appcheck = _client(max_retries=3)
+    ok = FakeResponse(200)
+    send, calls = _request([requests.exceptions.ConnectionError('down'),
+                            FakeResponse(503), ok])
+    assert appcheck._retry_request(send, ['/api/apps/'], {}) is ok
+    assert len(calls) == 3
+
+
+def test_local_error_does_not_count():
+    appcheck = _client(breaker=CircuitBreaker(failure_threshold=1))
+    send, calls = _request([IOError('unreadable')])
+    with pytest.raises(IOError):
+        appcheck._retry_request(send, ['/api/apps/'], {})
+    assert appcheck.retry_policy.breaker.allow()
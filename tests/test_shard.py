@@ -0,0 +1,62 @@
+# Copyright (c) 2015 Codenomicon Ltd.
+# License: MIT
+
+from __future__ import absolute_import, division, print_function
+
+import os
+
+import pytest
+
+from protecodesc.utils import shard_directory
+
+FILE_SIZE = 1000
+MAX_SIZE = 20 * FILE_SIZE
+
+
+@pytest.fixture
+def tree(tmpdir):
+    root = tmpdir.mkdir('src')
+    for i in range(400):
+        root.join('dir{0:02d}'.format(i // 40)).ensure(dir=True).join(
+            'file{0:03d}.c'.format(i)).write_binary(b'x' * FILE_SIZE)
+    return str(root)
+
+
+def _shards(path):
+    return [tuple(os.path.relpath(f, path) for f in shard)
+            for shard in shard_directory(path, MAX_SIZE)]
+
+
+def test_shards_cover_files_within_limit(tree):
+    shards = _shards(tree)
+    files = [f for shard in shards for f in shard]
+    assert len(files) == len(set(files)) == 400
+    assert files == sorted(files)
+    assert all(len(shard) * FILE_SIZE <= MAX_SIZE for shard in shards)
+
+
+def test_changed_file_keeps_other_shards(tree):
+    before = _shards(tree)
+    changed = os.path.join(tree, 'dir05', 'file217.c')
+    with open(changed, 'ab') as f:
+        f.write(b'y' * 100)
+    after = _shards(tree)
+    assert len(set(before) - set(after)) <= 2
+    assert len(set(after) - set(before)) <= 2
+
+
+def test_added_file_keeps_other_shards(tree):
+    before = _shards(tree)
+    with open(os.path.join(tree, 'dir03', 'file150a.c'), 'wb') as f:
+        f.write(b'z' * FILE_SIZE)
+    after = _shards(tree)
+    assert len(before) > 10
+    assert len(set(before) - set(after)) <= 2
+    assert len(set(after) - set(before)) <= 2
+
+
+def test_large_file_gets_own_shard(tree):
+    large = os.path.join(tree, 'dir01', 'large.bin')
+    with open(large, 'wb') as f:
+        f.write(b'x' * (MAX_SIZE + 1))
+    assert (os.path.relpath(large, tree),) in _shards(tree)
@@ -0,0 +1,72 @@
+# Copyright (c) 2015 Codenomicon Ltd.
+# License: MIT
+
+from __future__ import absolute_import, division, print_function
+
+import json
+
+from protecodesc.store import ResultStore, sync_results
+from protecodesc.utils import JSONArrayStream
+
+
+class FakeAppcheck(object):
+    """Lists apps and streams their results from memory"""
+
+    def __init__(self, apps, components):
+        self.apps = apps
+        self.components = components
+        self.fetched = []
+
+    def list_apps(self, group=None):
+        return iter(self.apps)
+
+    def stream_result(self, id_or_sha1, cache=True, **kwargs):
+        self.fetched.append(id_or_sha1)
+        document = {'results': {'status': 'R',
+                                'components': self.components}}
+        return JSONArrayStream([json.dumps(document).encode('utf-8')],
+                               ('results', 'components'))
+
+
+def _setup(tmpdir):
+    apps = [{'id': 1, 'name': 'a', 'sha1sum': 'aa' * 20},
+            {'id': 2, 'name': 'b', 'sha1sum': 'bb' * 20}]
+    components = [{'lib': 'openssl', 'version': '1.0.2',
+                   'license': None, 'vulns': [{'vuln': {'cve': 'CVE-1'}}]}]
+    appcheck = FakeAppcheck(apps, components)
+    store = ResultStore(str(tmpdir.join('store.sqlite')))
+    sync_results(appcheck, store, workers=2)
+    appcheck.fetched = []
+    return appcheck, store
+
+
+def test_unchanged_not_fetched(tmpdir):
+    appcheck, store = _setup(tmpdir)
+    stats = sync_results(appcheck, store, workers=2)
+    assert stats['unchanged'] == 2
+    assert appcheck.fetched == []
+    rows = list(store.query(vuln='cve-1'))
+    assert [row['id'] for row in rows] == [1, 2]
+    assert rows[0]['license'] == 'UNKNOWN'
+
+
+def test_invalidated_fetched(tmpdir):
+    appcheck, store = _setup(tmpdir)
+    store.invalidate(['bb' * 20])
+    stats = sync_results(appcheck, store, workers=2)
+    assert stats['fetched'] == 1
+    assert appcheck.fetched == ['bb' * 20]
+
+
+def test_old_results_fetched(tmpdir):
+    appcheck, store = _setup(tmpdir)
+    stats = sync_results(appcheck, store, workers=2, max_age=0)
+    assert stats['fetched'] == 2
+
+
+def test_removed_apps_forgotten(tmpdir):
+    appcheck, store = _setup(tmpdir)
+    appcheck.apps = appcheck.apps[:1]
+    stats = sync_results(appcheck, store, workers=2)
+    assert stats['removed'] == 1
+    assert store.app_ids() == [1]
@@ -0,0 +1,91 @@
+# Copyright (c) 2015 Codenomicon Ltd.
+# License: MIT
+
+from __future__ import absolute_import, division, print_function
+
+import io
+import os
+import random
+import zipfile
+from zipfile import ZIP_DEFLATED, ZIP_STORED
+
+import pytest
+
+from protecodesc import utils
+from protecodesc.utils import zip_directory_stream
+
+
+@pytest.fixture
+def tree(tmpdir):
+    rand = random.Random(0)
+    root = tmpdir.mkdir('src')
+    contents = {'empty.txt': b'',
+                'text.txt': b'hello world\n' * 5000,
+                'sub/random.bin': bytes(bytearray(
+                    rand.getrandbits(8) for _ in range(300000))),
+                'sub/deeper/stored.jar': b'PK' + b'x' * 10000}
+    for name, data in contents.items():
+        path = root.join(*name.split('/'))
+        path.dirpath().ensure(dir=True)
+        path.write_binary(data)
+    return str(root), contents
+
+
+def _archive(path, workers, compression=ZIP_DEFLATED):
+    return b''.join(zip_directory_stream(
+        path, compression=compression, reproducible=True, compresslevel=6,
+        workers=workers))
+
+
+@pytest.mark.parametrize('compression', [ZIP_DEFLATED, ZIP_STORED])
+def test_archive_readable(tree, compression):
+    path, contents = tree
+    with zipfile.ZipFile(io.BytesIO(_archive(path, 4, compression))) as zf:
+        assert zf.testzip() is None
+        names = dict((name.split('/', 1)[1], name) for name in zf.namelist())
+        assert sorted(names) == sorted(contents)
+        for name, data in contents.items():
+            assert zf.read(names[name]) == data
+        stored = zf.getinfo(names['sub/deeper/stored.jar'])
+        assert stored.compress_type == ZIP_STORED
+
+
+def test_archive_independent_of_workers(tree):
+    path, _ = tree
+    archives = set(_archive(path, workers) for workers in (1, 2, 3, 8))
+    assert len(archives) == 1
+
+
+def test_archive_reproducible(tree):
+    path, _ = tree
+    first = _archive(path, 2)
+    for name in ('text.txt', os.path.join('sub', 'random.bin')):
+        os.utime(os.path.join(path, name), (0, 0))
+    assert _archive(path, 2) == first
+
+
+def test_pending_size_limit(tree, monkeypatch):
+    path, _ = tree
+    expected = _archive(path, 4)
+    monkeypatch.setattr(utils, 'PARALLEL_ZIP_MAX_PENDING_SIZE', 1)
+    assert _archive(path, 4) == expected
+
+
+def test_stored_without_pool(tree, monkeypatch):
+    path, contents = tree
+    expected = _archive(path, 4, ZIP_STORED)
+
+    def _no_pool(*args, **kwargs):
+        raise AssertionError("thread pool started for stored archive")
+    monkeypatch.setattr(utils, 'ThreadPoolExecutor', _no_pool)
+    assert _archive(path, 4, ZIP_STORED) == expected
+
+
+@pytest.mark.parametrize('compression', [ZIP_DEFLATED, ZIP_STORED])
+def test_archive_without_zipfile_internals(tree, monkeypatch, compression):
+    path, contents = tree
+    monkeypatch.setattr(utils, '_can_append_compressed', lambda zf: False)
+    with zipfile.ZipFile(io.BytesIO(_archive(path, 4, compression))) as zf:
+        assert zf.testzip() is None
+        assert sorted(zf.read(name) for name in zf.namelist()) == \
+            sorted(contents.values())